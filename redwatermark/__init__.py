@@ -5,40 +5,164 @@ from redwatermark.eligibility import (
     build_eligible_token_set,
     build_red_blue_partition,
 )
-from redwatermark.filters import OddityFlags, detect_oddities
-from redwatermark.model import ModelInterface, ModelOutput
+from redwatermark.partition import VocabPartition, load_or_build_partition, load_partition
+from redwatermark.filters import OddityFlags, detect_oddities, detect_oddities_batch
+from redwatermark.model import BatchDecodeSession, DecodeSession, ModelInterface, ModelOutput
 from redwatermark.scoring import ScoreWeights, score_candidate
-from redwatermark.teacher import RedBiasConfig, RedBiasedTeacher
-from redwatermark.training import DPOPair, SFTExample, build_dpo_pairs, build_sft_dataset
-from redwatermark.pipeline import PipelineOutputs, run_pipeline
-from redwatermark.regularizer import kl_divergence, red_mass, red_regularizer
-from redwatermark.rl import RewardWeights, compute_episode_reward, reward
-from redwatermark.hf_model import HFModel, HFModelConfig
+from redwatermark.teacher import EarlyRejectionConfig, GenerationResult, RedBiasConfig, RedBiasedTeacher
+from redwatermark.cache import CachedGeneration, GenerationCache, generation_key
+from redwatermark.training import (
+    DPOPair,
+    SFTExample,
+    build_dpo_pairs,
+    build_dpo_pairs_from_table,
+    build_sft_dataset,
+    build_sft_dataset_from_table,
+    mine_dpo_pairs,
+)
+from redwatermark.selection import PromptSelection, StreamingSelector, iter_grouped_selections
+from redwatermark.pipeline import (
+    PipelineOutputs,
+    PromptOutputs,
+    iter_pipeline,
+    run_pipeline,
+    run_pipeline_sharded,
+)
+from redwatermark.storage import ShardedJSONLWriter, ShardManifest
+from redwatermark.coordinator import ShardCoordinator, ShardPlan, merge_shards, plan_shards, run_worker
+from redwatermark.regularizer import (
+    kl_divergence,
+    kl_divergence_batch,
+    red_ids_tensor,
+    red_kl_loss,
+    red_mass,
+    red_mass_batch,
+    red_regularizer,
+    red_regularizer_batch,
+)
+from redwatermark.rl import (
+    RewardWeights,
+    RolloutBuffer,
+    RolloutCollector,
+    compute_episode_reward,
+    reward,
+    reward_batch,
+)
+from redwatermark.hf_model import HFModel, HFModelConfig, HFTokenizer, RedBiasLogitsProcessor
+from redwatermark.parallel import WorkerConfig, iter_pipeline_parallel
+from redwatermark.stages import StageConfig, StagedCandidatePipeline, StagedPipelineConfig
+from redwatermark.calibration import CalibrationTable, LogitTrace, record_traces, sweep
+from redwatermark.detection import DetectionResult, RedRateDetector, iter_detections, scan_corpus
+from redwatermark.frequency import TokenCounts, count_corpus, count_tokens, merge_counts
+from redwatermark.serving import ContinuousBatchingServer, ServingStats, run_load_test
+from redwatermark.speculative import SpeculativeDecoder, SpeculativeStats
+from redwatermark.metrics import (
+    CProfileHook,
+    JSONLinesSink,
+    MetricsRecorder,
+    MetricsSnapshot,
+    PrometheusTextSink,
+    StageStats,
+    recording,
+)
+
+try:  # the columnar sample store needs the optional pyarrow extra
+    from redwatermark.columnar import SampleRow, SampleTable, write_samples
+except ImportError:
+    _COLUMNAR: list = []
+else:
+    _COLUMNAR = ["SampleRow", "SampleTable", "write_samples"]
 
 __all__ = [
     "EligibleTokenConfig",
     "build_eligible_token_set",
     "build_red_blue_partition",
+    "VocabPartition",
+    "load_or_build_partition",
+    "load_partition",
     "OddityFlags",
     "detect_oddities",
+    "detect_oddities_batch",
+    "BatchDecodeSession",
+    "DecodeSession",
     "ModelInterface",
     "ModelOutput",
     "ScoreWeights",
     "score_candidate",
+    "EarlyRejectionConfig",
+    "GenerationResult",
     "RedBiasConfig",
     "RedBiasedTeacher",
+    "CachedGeneration",
+    "GenerationCache",
+    "generation_key",
     "DPOPair",
     "SFTExample",
     "build_dpo_pairs",
+    "build_dpo_pairs_from_table",
     "build_sft_dataset",
+    "build_sft_dataset_from_table",
+    "mine_dpo_pairs",
+    "PromptSelection",
+    "StreamingSelector",
+    "iter_grouped_selections",
     "PipelineOutputs",
+    "PromptOutputs",
+    "iter_pipeline",
     "run_pipeline",
+    "run_pipeline_sharded",
+    "ShardedJSONLWriter",
+    "ShardManifest",
+    "ShardCoordinator",
+    "ShardPlan",
+    "merge_shards",
+    "plan_shards",
+    "run_worker",
     "kl_divergence",
+    "kl_divergence_batch",
+    "red_ids_tensor",
+    "red_kl_loss",
     "red_mass",
+    "red_mass_batch",
     "red_regularizer",
+    "red_regularizer_batch",
     "RewardWeights",
+    "RolloutBuffer",
+    "RolloutCollector",
     "compute_episode_reward",
     "reward",
+    "reward_batch",
     "HFModel",
     "HFModelConfig",
-]
+    "HFTokenizer",
+    "RedBiasLogitsProcessor",
+    "WorkerConfig",
+    "iter_pipeline_parallel",
+    "StageConfig",
+    "StagedCandidatePipeline",
+    "StagedPipelineConfig",
+    "CalibrationTable",
+    "LogitTrace",
+    "record_traces",
+    "sweep",
+    "DetectionResult",
+    "RedRateDetector",
+    "iter_detections",
+    "scan_corpus",
+    "TokenCounts",
+    "count_corpus",
+    "count_tokens",
+    "merge_counts",
+    "ContinuousBatchingServer",
+    "ServingStats",
+    "run_load_test",
+    "SpeculativeDecoder",
+    "SpeculativeStats",
+    "CProfileHook",
+    "JSONLinesSink",
+    "MetricsRecorder",
+    "MetricsSnapshot",
+    "PrometheusTextSink",
+    "StageStats",
+    "recording",
+] + _COLUMNAR
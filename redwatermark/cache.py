@@ -0,0 +1,218 @@
+"""Content-addressed on-disk cache of teacher generations and base log-probs.
+
+An entry is keyed by everything that determines it: the teacher model and
+tokenizer, the red/eligible partition, the ``RedBiasConfig`` (and early
+rejection rules), the base model that scored it, the prompt and the sample
+seed. Changing score weights, selection or filters then reuses cached
+entries instead of regenerating.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+import hashlib
+import json
+import os
+import struct
+from typing import List, Optional
+
+import numpy as np
+
+from redwatermark.model import ModelInterface
+from redwatermark.partition import tokenizer_hash
+from redwatermark.teacher import EarlyRejectionConfig, RedBiasConfig, RedBiasedTeacher
+
+_MAGIC = b"RWGEN001"
+_HEADER = struct.Struct("<IIIH")
+_SUFFIX = ".gen"
+
+
+@dataclass(frozen=True)
+class CachedGeneration:
+    """Generated ids and the base model's teacher-forced log-probs of ``token_ids[1:]``.
+
+    ``base_logprobs`` is empty for rejected candidates, which are never scored.
+    """
+
+    token_ids: List[int]
+    prompt_length: int
+    finish_reason: str
+    base_logprobs: List[float]
+
+
+def model_fingerprint(model: ModelInterface) -> str:
+    """Identify a model by its id and, when it has one, its tokenizer vocabulary."""
+
+    model_id = getattr(model, "model_id", None) or f"{type(model).__module__}.{type(model).__qualname__}"
+    tokenizer = getattr(model, "tokenizer", None)
+    get_vocab = getattr(tokenizer, "get_vocab", None)
+    if get_vocab is None:
+        return model_id
+    vocab = sorted((token_id, token) for token, token_id in get_vocab().items())
+    return f"{model_id}:{tokenizer_hash(vocab)}"
+
+
+def partition_fingerprint(teacher: RedBiasedTeacher) -> str:
+    if teacher.partition is not None and teacher.partition.key:
+        return teacher.partition.key
+    digest = hashlib.sha256()
+    for tokens in (teacher.eligible_tokens, teacher.red_tokens):
+        digest.update(np.asarray(sorted(tokens), dtype=np.int64).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def cache_namespace(teacher: RedBiasedTeacher, base_model: ModelInterface) -> str:
+    """Hash of the parts of a key shared by every sample of a run."""
+
+    payload = json.dumps(
+        {
+            "teacher_model": model_fingerprint(teacher.model),
+            "partition": partition_fingerprint(teacher),
+            "base_model": model_fingerprint(base_model),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def generation_key(
+    namespace: str,
+    config: RedBiasConfig,
+    prompt: str,
+    seed: int,
+    rejection: Optional[EarlyRejectionConfig] = None,
+) -> str:
+    payload = json.dumps(
+        {
+            "namespace": namespace,
+            "config": asdict(config),
+            "rejection": None if rejection is None else asdict(rejection),
+            "prompt": prompt,
+            "seed": seed,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _encode(entry: CachedGeneration) -> bytes:
+    reason = entry.finish_reason.encode("utf-8")
+    return b"".join(
+        [
+            _MAGIC,
+            _HEADER.pack(entry.prompt_length, len(entry.token_ids), len(entry.base_logprobs), len(reason)),
+            reason,
+            np.asarray(entry.token_ids, dtype=np.int64).tobytes(),
+            np.asarray(entry.base_logprobs, dtype=np.float64).tobytes(),
+        ]
+    )
+
+
+def _decode(payload: bytes) -> CachedGeneration:
+    if payload[: len(_MAGIC)] != _MAGIC:
+        raise ValueError("Not a cached generation.")
+    offset = len(_MAGIC)
+    prompt_length, num_tokens, num_logprobs, reason_length = _HEADER.unpack_from(payload, offset)
+    offset += _HEADER.size
+    reason = payload[offset : offset + reason_length].decode("utf-8")
+    offset += reason_length
+    token_ids = np.frombuffer(payload, dtype=np.int64, count=num_tokens, offset=offset)
+    offset += token_ids.nbytes
+    logprobs = np.frombuffer(payload, dtype=np.float64, count=num_logprobs, offset=offset)
+    return CachedGeneration(
+        token_ids=token_ids.tolist(),
+        prompt_length=prompt_length,
+        finish_reason=reason,
+        base_logprobs=logprobs.tolist(),
+    )
+
+
+class GenerationCache:
+    """Directory of one small file per key, evicted least recently used first.
+
+    Hits refresh the file's mtime, and the LRU order is rebuilt from mtimes
+    when the cache is opened. ``max_bytes`` bounds the total size of entry
+    files. Writes are atomic, so several processes can share a directory;
+    an entry evicted by another process is just a miss.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 10 * 2**30) -> None:
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive.")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self.size_bytes = 0
+        found = []
+        for shard in os.scandir(directory):
+            if not shard.is_dir():
+                continue
+            for item in os.scandir(shard.path):
+                if item.name.endswith(_SUFFIX):
+                    stat = item.stat()
+                    found.append((stat.st_mtime, item.name[: -len(_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(found):
+            self._index[key] = size
+            self.size_bytes += size
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + _SUFFIX)
+
+    def get(self, key: str) -> Optional[CachedGeneration]:
+        """Return the entry for ``key``, including ones another process wrote since opening."""
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as handle:
+                payload = handle.read()
+            entry = _decode(payload)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            self._forget(key)
+            self.misses += 1
+            return None
+        if key in self._index:
+            self._index.move_to_end(key)
+        else:
+            self._index[key] = len(payload)
+            self.size_bytes += len(payload)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: CachedGeneration) -> None:
+        payload = _encode(entry)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            handle.write(payload)
+        os.replace(tmp_path, path)
+        self._forget(key)
+        self._index[key] = len(payload)
+        self.size_bytes += len(payload)
+        self._evict()
+
+    def _forget(self, key: str) -> None:
+        size = self._index.pop(key, None)
+        if size is not None:
+            self.size_bytes -= size
+
+    def _evict(self) -> None:
+        while self.size_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self.size_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
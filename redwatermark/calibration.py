@@ -0,0 +1,274 @@
+"""Logit traces from unbiased runs and offline delta/threshold/top-k calibration.
+
+A trace keeps, per decoding step, only what the red-bias rule looks at:
+the entropy, the eligible red and blue probability mass, and the rank of the
+best red and best blue token. That is enough to replay the bias exactly for
+any ``delta``/``entropy_threshold``/``top_k`` at that step, so a sweep is a
+few array passes instead of a model run per grid point.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from redwatermark.data import derive_sample_seed
+from redwatermark.teacher import RedBiasConfig, RedBiasedTeacher
+from watermark_sampler import sample_from_probs
+
+_STEP_DTYPES = {
+    "entropy": np.float32,
+    "red_mass": np.float32,
+    "blue_mass": np.float32,
+    "red_rank": np.int32,
+    "blue_rank": np.int32,
+}
+
+
+@dataclass(frozen=True)
+class LogitTrace:
+    """Per-step statistics of unbiased decoding, concatenated over sequences.
+
+    Attributes:
+        entropy: Entropy of the base distribution at each step.
+        red_mass: Base probability of eligible red tokens.
+        blue_mass: Base probability of eligible blue tokens.
+        red_rank: Number of tokens scoring strictly above the best red token.
+        blue_rank: Number of tokens scoring strictly above the best blue token.
+        lengths: Number of steps in each traced sequence.
+    """
+
+    entropy: np.ndarray
+    red_mass: np.ndarray
+    blue_mass: np.ndarray
+    red_rank: np.ndarray
+    blue_rank: np.ndarray
+    lengths: np.ndarray
+
+    @property
+    def num_steps(self) -> int:
+        return int(self.entropy.shape[0])
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, **_trace_arrays(self))
+
+    @classmethod
+    def load(cls, path: str) -> LogitTrace:
+        with np.load(path) as payload:
+            return cls(**{name: payload[name] for name in payload.files})
+
+    @classmethod
+    def concatenate(cls, traces: Sequence[LogitTrace]) -> LogitTrace:
+        """Merge traces, e.g. shards recorded by different workers."""
+
+        if not traces:
+            raise ValueError("Expected at least one trace.")
+        arrays = [_trace_arrays(trace) for trace in traces]
+        return cls(**{name: np.concatenate([item[name] for item in arrays]) for name in arrays[0]})
+
+
+def _trace_arrays(trace: LogitTrace) -> Dict[str, np.ndarray]:
+    return {
+        "entropy": trace.entropy,
+        "red_mass": trace.red_mass,
+        "blue_mass": trace.blue_mass,
+        "red_rank": trace.red_rank,
+        "blue_rank": trace.blue_rank,
+        "lengths": trace.lengths,
+    }
+
+
+def _best_rank(rows: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    best = np.where(mask, rows, -np.inf).max(axis=-1)
+    return (rows > best[:, None]).sum(axis=-1)
+
+
+def record_traces(
+    teacher: RedBiasedTeacher,
+    prompts: Iterable[str],
+    rng_seed: int = 0,
+    batch_size: int = 8,
+    max_tokens: Optional[int] = None,
+) -> LogitTrace:
+    """Sample one unbiased completion per prompt and trace every step.
+
+    Prompt ``i`` samples with ``derive_sample_seed(rng_seed, i, 0)``.
+    ``max_tokens`` defaults to the teacher's config.
+    """
+
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive.")
+    steps = teacher.config.max_tokens if max_tokens is None else max_tokens
+    columns: Dict[str, List[np.ndarray]] = {name: [] for name in _STEP_DTYPES}
+    lengths: List[int] = []
+    prompt_list = list(prompts)
+    for start in range(0, len(prompt_list), batch_size):
+        batch = prompt_list[start : start + batch_size]
+        rngs = [np.random.default_rng(derive_sample_seed(rng_seed, start + idx, 0)) for idx in range(len(batch))]
+        session = teacher.start_batch_session([list(teacher.model.encode(prompt)) for prompt in batch])
+        per_step: Dict[str, List[np.ndarray]] = {name: [] for name in columns}
+        for _ in range(steps):
+            rows = np.stack([np.asarray(output.logits, dtype=np.float64) for output in session.next_logits()])
+            processor = teacher.processor(rows.shape[-1])
+            probs, entropies = processor.softmax_entropy(rows)
+            per_step["entropy"].append(entropies)
+            per_step["red_mass"].append(probs @ processor.bias_mask)
+            per_step["blue_mass"].append(probs @ processor.blue_mask)
+            per_step["red_rank"].append(_best_rank(rows, processor.red_mask))
+            per_step["blue_rank"].append(_best_rank(rows, processor.blue_mask))
+            session.append(sample_from_probs(probs, rngs).tolist())
+        for name, values in per_step.items():
+            if values:
+                # [steps, batch] -> sequence-major order
+                columns[name].append(np.stack(values).T.reshape(-1).astype(_STEP_DTYPES[name]))
+        lengths.extend([steps] * len(batch))
+    arrays = {
+        name: np.concatenate(values) if values else np.zeros(0, dtype=_STEP_DTYPES[name])
+        for name, values in columns.items()
+    }
+    return LogitTrace(**arrays, lengths=np.asarray(lengths, dtype=np.int64))
+
+
+@dataclass(frozen=True)
+class CalibrationPoint:
+    delta: float
+    entropy_threshold: float
+    top_k: Optional[int]
+    red_rate: float
+    gate_rate: float
+    kl_to_base: float
+
+    def bias_config(self, max_tokens: int = 256) -> RedBiasConfig:
+        return RedBiasConfig(
+            delta=self.delta,
+            entropy_threshold=self.entropy_threshold,
+            top_k=self.top_k,
+            max_tokens=max_tokens,
+        )
+
+
+@dataclass(frozen=True)
+class CalibrationTable:
+    """Estimated outcomes over a ``delta x entropy_threshold x top_k`` grid.
+
+    Attributes:
+        red_rate: ``[delta, threshold, top_k]`` mean per-sequence expected red rate.
+        gate_rate: ``[threshold, top_k]`` fraction of steps where the bias fires.
+        kl_to_base: ``[delta, threshold, top_k]`` mean per-step KL(biased || base).
+    """
+
+    deltas: np.ndarray
+    entropy_thresholds: np.ndarray
+    top_ks: List[Optional[int]]
+    red_rate: np.ndarray
+    gate_rate: np.ndarray
+    kl_to_base: np.ndarray
+
+    def point(self, delta_idx: int, threshold_idx: int, top_k_idx: int) -> CalibrationPoint:
+        return CalibrationPoint(
+            delta=float(self.deltas[delta_idx]),
+            entropy_threshold=float(self.entropy_thresholds[threshold_idx]),
+            top_k=self.top_ks[top_k_idx],
+            red_rate=float(self.red_rate[delta_idx, threshold_idx, top_k_idx]),
+            gate_rate=float(self.gate_rate[threshold_idx, top_k_idx]),
+            kl_to_base=float(self.kl_to_base[delta_idx, threshold_idx, top_k_idx]),
+        )
+
+    def rows(self) -> List[CalibrationPoint]:
+        return [self.point(*index) for index in np.ndindex(*self.red_rate.shape)]
+
+    def best(self, target_red_rate: float, tolerance: float = 0.01) -> CalibrationPoint:
+        """Return the lowest-KL grid point within ``tolerance`` of the target.
+
+        Falls back to the point whose red rate is closest to the target when
+        none is within tolerance.
+        """
+
+        error = np.abs(self.red_rate - target_red_rate)
+        within = error <= tolerance
+        if within.any():
+            index = np.unravel_index(np.argmin(np.where(within, self.kl_to_base, np.inf)), error.shape)
+        else:
+            index = np.unravel_index(np.argmin(error), error.shape)
+        return self.point(*(int(idx) for idx in index))
+
+    def delta_for(self, target_red_rate: float, entropy_threshold: float, top_k: Optional[int]) -> float:
+        """Interpolate the delta reaching ``target_red_rate`` for fixed gating settings.
+
+        The estimated red rate is non-decreasing in delta; targets outside
+        the swept range clamp to the first or last delta.
+        """
+
+        threshold_idx = int(np.argmin(np.abs(self.entropy_thresholds - entropy_threshold)))
+        top_k_idx = self.top_ks.index(top_k)
+        rates = self.red_rate[:, threshold_idx, top_k_idx]
+        order = np.argsort(self.deltas)
+        return float(np.interp(target_red_rate, np.maximum.accumulate(rates[order]), self.deltas[order]))
+
+
+def sweep(
+    trace: LogitTrace,
+    deltas: Sequence[float],
+    entropy_thresholds: Sequence[float],
+    top_ks: Sequence[Optional[int]],
+) -> CalibrationTable:
+    """Replay ``trace`` under every grid point.
+
+    Each step's bias is applied exactly: with eligible red mass ``r`` and
+    ``Z = 1 + r (e^delta - 1)``, the biased red mass is ``r e^delta / Z``,
+    blue mass ``b / Z``, and KL(biased || base) is ``delta r e^delta / Z - log Z``.
+    Estimates are per step on the unbiased trajectories, so they do not
+    account for the bias steering later context.
+    """
+
+    delta_values = np.asarray(deltas, dtype=np.float64)
+    threshold_values = np.asarray(entropy_thresholds, dtype=np.float64)
+    top_k_values = list(top_ks)
+    lengths = trace.lengths[trace.lengths > 0]
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    red = trace.red_mass.astype(np.float64)
+    blue = trace.blue_mass.astype(np.float64)
+    scale = np.exp(delta_values)[:, None]
+    partition = 1.0 + red[None, :] * (scale - 1.0)
+    biased_red = red[None, :] * scale / partition
+    biased_blue = blue[None, :] / partition
+    kl = delta_values[:, None] * biased_red - np.log(partition)
+    red_gain = biased_red - red[None, :]
+    eligible_gain = biased_red + biased_blue - (red + blue)[None, :]
+
+    def per_sequence(values: np.ndarray) -> np.ndarray:
+        if values.shape[-1] == 0:
+            return np.zeros(values.shape[:-1] + (0,))
+        return np.add.reduceat(values, offsets, axis=-1)
+
+    base_red = per_sequence(red)
+    base_eligible = per_sequence(red + blue)
+    num_steps = max(trace.num_steps, 1)
+
+    red_rate = np.zeros((len(delta_values), len(threshold_values), len(top_k_values)))
+    kl_to_base = np.zeros_like(red_rate)
+    gate_rate = np.zeros((len(threshold_values), len(top_k_values)))
+    for top_k_idx, top_k in enumerate(top_k_values):
+        if top_k is None:
+            in_top_k = np.ones(trace.num_steps, dtype=bool)
+        else:
+            in_top_k = np.maximum(trace.red_rank, trace.blue_rank) < top_k
+        for threshold_idx, threshold in enumerate(threshold_values):
+            gated = (trace.entropy >= threshold) & in_top_k
+            gate_rate[threshold_idx, top_k_idx] = gated.sum() / num_steps
+            red_counts = base_red + per_sequence(red_gain * gated)
+            eligible_counts = base_eligible + per_sequence(eligible_gain * gated)
+            rates = np.divide(red_counts, eligible_counts, out=np.zeros_like(red_counts), where=eligible_counts > 0)
+            red_rate[:, threshold_idx, top_k_idx] = rates.mean(axis=-1) if rates.shape[-1] else 0.0
+            kl_to_base[:, threshold_idx, top_k_idx] = (kl * gated).sum(axis=-1) / num_steps
+    return CalibrationTable(
+        deltas=delta_values,
+        entropy_thresholds=threshold_values,
+        top_ks=top_k_values,
+        red_rate=red_rate,
+        gate_rate=gate_rate,
+        kl_to_base=kl_to_base,
+    )
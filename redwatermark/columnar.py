@@ -0,0 +1,231 @@
+"""Columnar Arrow/Parquet storage for scored samples.
+
+Token ids are a ``list<int32>`` column, which Arrow keeps as one flat int32
+buffer plus offsets, and the oddity flags are a struct of bit-packed boolean
+columns. Arrow IPC files (any path not ending in ``.parquet``) are loaded by
+memory-mapping, so the token, score and red-rate arrays are views of the
+file rather than Python objects.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from redwatermark.data import SampleMetadata
+from redwatermark.filters import ODDITY_FIELDS, OddityFlags, any_oddity_bits, flags_from_bits, flags_to_bits
+
+SAMPLE_SCHEMA = pa.schema(
+    [
+        pa.field("prompt", pa.string(), nullable=False),
+        pa.field("completion", pa.string(), nullable=False),
+        pa.field("token_ids", pa.list_(pa.int32()), nullable=False),
+        pa.field("red_rate", pa.float64(), nullable=False),
+        pa.field("base_logprob", pa.float64()),
+        pa.field("oddities", pa.struct([pa.field(name, pa.bool_(), nullable=False) for name in ODDITY_FIELDS])),
+        pa.field("score", pa.float64(), nullable=False),
+    ]
+)
+
+
+def _is_parquet(path: str) -> bool:
+    return path.endswith(".parquet")
+
+
+def samples_to_record_batch(samples: Sequence[SampleMetadata]) -> pa.RecordBatch:
+    lengths = np.fromiter((len(sample.token_ids) for sample in samples), dtype=np.int64, count=len(samples))
+    offsets = np.zeros(len(samples) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    flat = np.empty(int(offsets[-1]), dtype=np.int32)
+    for sample, start, end in zip(samples, offsets[:-1].tolist(), offsets[1:].tolist()):
+        flat[start:end] = sample.token_ids
+    bits = np.fromiter((flags_to_bits(sample.oddities) for sample in samples), dtype=np.uint8, count=len(samples))
+    oddities = pa.StructArray.from_arrays(
+        [pa.array((bits >> idx & 1).astype(bool)) for idx in range(len(ODDITY_FIELDS))],
+        fields=list(SAMPLE_SCHEMA.field("oddities").type),
+    )
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array([sample.prompt for sample in samples], type=pa.string()),
+            pa.array([sample.completion for sample in samples], type=pa.string()),
+            pa.ListArray.from_arrays(pa.array(offsets), pa.array(flat)),
+            pa.array([sample.red_rate for sample in samples], type=pa.float64()),
+            pa.array([sample.base_logprob for sample in samples], type=pa.float64()),
+            oddities,
+            pa.array([sample.score for sample in samples], type=pa.float64()),
+        ],
+        schema=SAMPLE_SCHEMA,
+    )
+
+
+def write_samples(path: str, samples: Iterable[SampleMetadata], batch_size: int = 8192) -> int:
+    """Stream ``samples`` to an Arrow IPC or (``*.parquet``) Parquet file; return the row count.
+
+    Samples are converted ``batch_size`` at a time, so memory holds one
+    record batch. The file is written under a temporary name and renamed.
+    """
+
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive.")
+    tmp_path = f"{path}.tmp"
+    if _is_parquet(path):
+        writer = pq.ParquetWriter(tmp_path, SAMPLE_SCHEMA)
+    else:
+        writer = pa.ipc.new_file(tmp_path, SAMPLE_SCHEMA)
+    count = 0
+    with writer:
+        batch: List[SampleMetadata] = []
+        for sample in samples:
+            batch.append(sample)
+            if len(batch) == batch_size:
+                writer.write_batch(samples_to_record_batch(batch))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_batch(samples_to_record_batch(batch))
+            count += len(batch)
+    os.replace(tmp_path, path)
+    return count
+
+
+class SampleRow:
+    """Lazy view of one row of a ``SampleTable`` with ``SampleMetadata``'s attributes."""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table: SampleTable, index: int) -> None:
+        self._table = table
+        self._index = index
+
+    @property
+    def prompt(self) -> str:
+        return self._table.prompt(self._index)
+
+    @property
+    def completion(self) -> str:
+        return self._table.completion(self._index)
+
+    @property
+    def token_ids(self) -> np.ndarray:
+        return self._table.token_ids(self._index)
+
+    @property
+    def red_rate(self) -> float:
+        return float(self._table.red_rates[self._index])
+
+    @property
+    def base_logprob(self) -> Optional[float]:
+        value = self._table.base_logprobs[self._index]
+        return None if np.isnan(value) else float(value)
+
+    @property
+    def oddities(self) -> OddityFlags:
+        return flags_from_bits(int(self._table.oddity_bits[self._index]))
+
+    @property
+    def score(self) -> float:
+        return float(self._table.scores[self._index])
+
+    def to_sample(self) -> SampleMetadata:
+        return SampleMetadata(
+            prompt=self.prompt,
+            completion=self.completion,
+            token_ids=self.token_ids.tolist(),
+            red_rate=self.red_rate,
+            base_logprob=self.base_logprob,
+            oddities=self.oddities,
+            score=self.score,
+        )
+
+
+class SampleTable:
+    """Read-only columnar samples backed by a ``pyarrow.Table``.
+
+    ``scores``, ``red_rates``, ``base_logprobs`` (NaN for missing) and
+    ``oddity_bits`` (packed as in ``ODDITY_FIELDS``) are NumPy arrays over
+    all rows; ``token_ids(i)`` is an int32 view into the table's buffers.
+    """
+
+    def __init__(self, table: pa.Table) -> None:
+        if not table.schema.equals(SAMPLE_SCHEMA):
+            table = table.cast(SAMPLE_SCHEMA)
+        self.table = table
+        self._prompts = table.column("prompt")
+        self._completions = table.column("completion")
+        self._tokens: List[Tuple[np.ndarray, np.ndarray]] = []
+        starts = [0]
+        for chunk in table.column("token_ids").chunks:
+            values = chunk.values.to_numpy(zero_copy_only=True) if len(chunk.values) else np.empty(0, np.int32)
+            self._tokens.append((chunk.offsets.to_numpy(zero_copy_only=True), values))
+            starts.append(starts[-1] + len(chunk))
+        self._chunk_starts = np.asarray(starts, dtype=np.int64)
+        self.scores = table.column("score").to_numpy()
+        self.red_rates = table.column("red_rate").to_numpy()
+        self.base_logprobs = table.column("base_logprob").to_numpy(zero_copy_only=False).astype(np.float64)
+        bits = np.zeros(table.num_rows, dtype=np.uint8)
+        oddities = table.column("oddities").combine_chunks()
+        for idx, name in enumerate(ODDITY_FIELDS):
+            flags = oddities.field(name).to_numpy(zero_copy_only=False)
+            bits |= flags.astype(np.uint8) << np.uint8(idx)
+        self.oddity_bits = bits
+
+    @classmethod
+    def from_samples(cls, samples: Sequence[SampleMetadata]) -> SampleTable:
+        return cls(pa.Table.from_batches([samples_to_record_batch(samples)], schema=SAMPLE_SCHEMA))
+
+    @classmethod
+    def load(cls, path: str) -> SampleTable:
+        """Memory-map an Arrow IPC file, or read a ``*.parquet`` file."""
+
+        if _is_parquet(path):
+            return cls(pq.read_table(path, memory_map=True))
+        return cls(pa.ipc.open_file(pa.memory_map(path, "r")).read_all())
+
+    def write(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        if _is_parquet(path):
+            pq.write_table(self.table, tmp_path)
+        else:
+            with pa.ipc.new_file(tmp_path, SAMPLE_SCHEMA) as writer:
+                writer.write_table(self.table)
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __getitem__(self, index: int) -> SampleRow:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SampleTable index out of range.")
+        return SampleRow(self, index)
+
+    def __iter__(self) -> Iterator[SampleRow]:
+        return (SampleRow(self, index) for index in range(len(self)))
+
+    def prompt(self, index: int) -> str:
+        return self._prompts[index].as_py()
+
+    def completion(self, index: int) -> str:
+        return self._completions[index].as_py()
+
+    def token_ids(self, index: int) -> np.ndarray:
+        chunk = int(np.searchsorted(self._chunk_starts, index, side="right")) - 1
+        offsets, values = self._tokens[chunk]
+        local = index - int(self._chunk_starts[chunk])
+        return values[offsets[local] : offsets[local + 1]]
+
+    def clean_mask(self, allowed: Iterable[str] = ()) -> np.ndarray:
+        """Rows with no oddity outside ``allowed``."""
+
+        return ~any_oddity_bits(self.oddity_bits, allowed)
+
+    def take(self, indices: Sequence[int]) -> SampleTable:
+        return SampleTable(self.table.take(pa.array(np.asarray(indices, dtype=np.int64))))
+
+    def to_samples(self) -> List[SampleMetadata]:
+        return [row.to_sample() for row in self]
@@ -0,0 +1,386 @@
+"""Multi-node sharded pipeline runs coordinated through a shared directory.
+
+``plan_shards`` splits a prompt file (one prompt per line) into fixed-size
+shards and records the plan in ``<work_dir>/plan.json``. Any number of
+``run_worker`` processes, on any machines that mount ``work_dir``, then
+claim shards through lease files and run the pipeline on them.
+``merge_shards`` finally concatenates the finished shards in shard order.
+
+A lease on shard ``i`` is a file ``leases/shard-<i>/<generation>``
+created with ``O_EXCL``; the highest generation owns the shard. Owners
+refresh the file's mtime every ``heartbeat_interval`` seconds. Once it is
+older than ``lease_timeout``, another worker may create the next
+generation, and the previous owner stops at its next heartbeat. Each
+generation writes to its own directory, so a presumed-dead worker that is
+still running never shares files with its successor. Expiry compares file
+mtimes with the local clock, so node clocks must roughly agree.
+
+Seeds depend only on the global prompt index, so the merged output matches
+a single ``run_pipeline_sharded`` call with ``shard_size`` set to the plan's
+shard size, whatever the number of workers or reclaimed shards.
+"""
+
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass
+import itertools
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import uuid
+
+from redwatermark.model import ModelInterface
+from redwatermark.pipeline import run_fingerprint, run_pipeline_sharded
+from redwatermark.scoring import ScoreWeights
+from redwatermark.storage import MANIFEST_NAME, STREAMS, ShardManifest, ShardRecord, load_manifest, write_json_atomic
+from redwatermark.teacher import RedBiasedTeacher
+
+PLAN_NAME = "plan.json"
+
+
+@dataclass(frozen=True)
+class ShardPlan:
+    """Shard ``i`` covers prompts ``[i * shard_size, min((i + 1) * shard_size, num_prompts))``.
+
+    ``offsets[i]`` is the byte offset of its first line in ``prompts_path``.
+    ``params`` are the pipeline parameters every worker must use, and
+    ``fingerprint`` the ``run_fingerprint`` its teacher, models and score
+    weights must match.
+    """
+
+    prompts_path: str
+    num_prompts: int
+    shard_size: int
+    offsets: List[int]
+    params: Dict[str, Any]
+    fingerprint: Dict[str, Any]
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.offsets)
+
+    def prompt_range(self, shard: int) -> Tuple[int, int]:
+        start = shard * self.shard_size
+        return start, min(start + self.shard_size, self.num_prompts)
+
+
+@dataclass(frozen=True)
+class Lease:
+    shard: int
+    generation: int
+    worker_id: str
+    path: str
+
+
+def _publish_json(path: str, payload: Any) -> None:
+    """Atomically replace ``path``; the temp name is unique, so concurrent writers do not collide."""
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(payload, handle, indent=2, sort_keys=True)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+def _load_plan(work_dir: str) -> Optional[ShardPlan]:
+    path = os.path.join(work_dir, PLAN_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as handle:
+        return ShardPlan(**json.load(handle))
+
+
+def plan_shards(
+    work_dir: str,
+    prompts_path: str,
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    target_red_rate: float,
+    shard_size: int = 1000,
+    samples_per_prompt: int = 4,
+    best_of_n: int = 1,
+    rng_seed: int = 0,
+    score_weights: Optional[ScoreWeights] = None,
+) -> ShardPlan:
+    """Write (or, if an identical one exists, reuse) the shard plan for ``prompts_path``.
+
+    Every node may call this; a plan made with different settings,
+    including the teacher config, models, partition or score weights, raises.
+    """
+
+    if shard_size <= 0:
+        raise ValueError("shard_size must be positive.")
+    params = {
+        "target_red_rate": target_red_rate,
+        "samples_per_prompt": samples_per_prompt,
+        "best_of_n": best_of_n,
+        "rng_seed": rng_seed,
+    }
+    offsets: List[int] = []
+    num_prompts = 0
+    position = 0
+    with open(prompts_path, "rb") as handle:
+        for line in handle:
+            if num_prompts % shard_size == 0:
+                offsets.append(position)
+            position += len(line)
+            num_prompts += 1
+    plan = ShardPlan(
+        prompts_path=os.path.abspath(prompts_path),
+        num_prompts=num_prompts,
+        shard_size=shard_size,
+        offsets=offsets,
+        params=params,
+        fingerprint=run_fingerprint(teacher, model, score_weights),
+    )
+    os.makedirs(work_dir, exist_ok=True)
+    existing = _load_plan(work_dir)
+    if existing is None:
+        _publish_json(os.path.join(work_dir, PLAN_NAME), asdict(plan))
+    elif existing != plan:
+        raise ValueError(f"Work directory {work_dir} already holds a different shard plan.")
+    return plan
+
+
+class ShardCoordinator:
+    """Lease, heartbeat and completion bookkeeping for one planned work directory."""
+
+    def __init__(self, work_dir: str, lease_timeout: float = 60.0) -> None:
+        if lease_timeout <= 0:
+            raise ValueError("lease_timeout must be positive.")
+        plan = _load_plan(work_dir)
+        if plan is None:
+            raise FileNotFoundError(f"No {PLAN_NAME} in {work_dir}; call plan_shards first.")
+        self.work_dir = work_dir
+        self.plan = plan
+        self.lease_timeout = lease_timeout
+        for name in ("leases", "done", "shards"):
+            os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+
+    def _lease_dir(self, shard: int) -> str:
+        return os.path.join(self.work_dir, "leases", f"shard-{shard:05d}")
+
+    def _done_path(self, shard: int) -> str:
+        return os.path.join(self.work_dir, "done", f"shard-{shard:05d}.json")
+
+    def _generations(self, shard: int) -> List[int]:
+        try:
+            names = os.listdir(self._lease_dir(shard))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def is_done(self, shard: int) -> bool:
+        return os.path.exists(self._done_path(shard))
+
+    def pending(self) -> List[int]:
+        return [shard for shard in range(self.plan.num_shards) if not self.is_done(shard)]
+
+    def acquire(self, shard: int, worker_id: str) -> Optional[Lease]:
+        """Claim ``shard`` if it is unleased or its lease has expired."""
+
+        if self.is_done(shard):
+            return None
+        lease_dir = self._lease_dir(shard)
+        os.makedirs(lease_dir, exist_ok=True)
+        generations = self._generations(shard)
+        if generations:
+            current = os.path.join(lease_dir, f"{generations[-1]:06d}")
+            try:
+                if time.time() - os.stat(current).st_mtime < self.lease_timeout:
+                    return None
+            except FileNotFoundError:
+                return None
+        generation = generations[-1] + 1 if generations else 0
+        path = os.path.join(lease_dir, f"{generation:06d}")
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w", encoding="utf-8") as handle:
+            json.dump({"worker_id": worker_id, "generation": generation}, handle)
+        return Lease(shard=shard, generation=generation, worker_id=worker_id, path=path)
+
+    def acquire_next(self, worker_id: str) -> Optional[Lease]:
+        for shard in self.pending():
+            lease = self.acquire(shard, worker_id)
+            if lease is not None:
+                return lease
+        return None
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Refresh ``lease``; False once a newer generation has taken the shard."""
+
+        if self._generations(lease.shard)[-1:] != [lease.generation]:
+            return False
+        try:
+            os.utime(lease.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def output_dir(self, lease: Lease) -> str:
+        return os.path.join(
+            self.work_dir, "shards", f"shard-{lease.shard:05d}", f"{lease.generation:06d}-{lease.worker_id}"
+        )
+
+    def complete(self, lease: Lease) -> bool:
+        """Mark the shard done with ``lease``'s output, unless the lease was lost."""
+
+        if not self.heartbeat(lease):
+            return False
+        record = {
+            "output_dir": os.path.relpath(self.output_dir(lease), self.work_dir),
+            "worker_id": lease.worker_id,
+            "generation": lease.generation,
+        }
+        _publish_json(self._done_path(lease.shard), record)
+        return True
+
+    def done_output_dir(self, shard: int) -> str:
+        with open(self._done_path(shard), "r", encoding="utf-8") as handle:
+            return os.path.join(self.work_dir, json.load(handle)["output_dir"])
+
+    def iter_prompts(self, shard: int) -> Iterator[str]:
+        start, end = self.plan.prompt_range(shard)
+        with open(self.plan.prompts_path, "rb") as handle:
+            handle.seek(self.plan.offsets[shard])
+            for line in itertools.islice(handle, end - start):
+                yield line.decode("utf-8").rstrip("\r\n")
+
+
+class _LeaseLost(Exception):
+    pass
+
+
+class _Heartbeat:
+    """Background thread that keeps a lease fresh and notes when it is lost."""
+
+    def __init__(self, coordinator: ShardCoordinator, lease: Lease, interval: float) -> None:
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._coordinator = coordinator
+        self._lease = lease
+        self._interval = interval
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            if not self._coordinator.heartbeat(self._lease):
+                self.lost.set()
+                return
+
+    def __enter__(self) -> _Heartbeat:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    work_dir: str,
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    worker_id: Optional[str] = None,
+    lease_timeout: float = 60.0,
+    heartbeat_interval: Optional[float] = None,
+    poll_interval: float = 5.0,
+    **kwargs: Any,
+) -> List[int]:
+    """Claim and run shards until every shard is done; return the shards this worker finished.
+
+    While other workers hold the remaining shards, the worker polls every
+    ``poll_interval`` seconds so it can take over expired leases. Extra
+    keyword arguments (``batch_size``, ``score_weights``, ``cache``, ...)
+    go to ``run_pipeline_sharded``; settings fixed by the plan may not be
+    passed again.
+    """
+
+    coordinator = ShardCoordinator(work_dir, lease_timeout)
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    if heartbeat_interval is None:
+        heartbeat_interval = lease_timeout / 4
+    plan = coordinator.plan
+    fixed = set(plan.params) | {"prompts", "output_dir", "shard_size", "start_index"}
+    overlap = sorted(fixed.intersection(kwargs))
+    if overlap:
+        raise ValueError(f"Arguments set by the shard plan cannot be passed to run_worker: {', '.join(overlap)}.")
+    if run_fingerprint(teacher, model, kwargs.get("score_weights")) != plan.fingerprint:
+        raise ValueError(f"The teacher config, models or score weights differ from the plan in {work_dir}.")
+    finished: List[int] = []
+    while True:
+        lease = coordinator.acquire_next(worker_id)
+        if lease is None:
+            if not coordinator.pending():
+                return finished
+            time.sleep(poll_interval)
+            continue
+        with _Heartbeat(coordinator, lease, heartbeat_interval) as heartbeat:
+
+            def prompts() -> Iterator[str]:
+                for prompt in coordinator.iter_prompts(lease.shard):
+                    if heartbeat.lost.is_set():
+                        raise _LeaseLost()
+                    yield prompt
+
+            start, _ = plan.prompt_range(lease.shard)
+            try:
+                run_pipeline_sharded(
+                    teacher=teacher,
+                    model=model,
+                    prompts=prompts(),
+                    output_dir=coordinator.output_dir(lease),
+                    shard_size=plan.shard_size,
+                    start_index=start,
+                    **plan.params,
+                    **kwargs,
+                )
+            except _LeaseLost:
+                continue
+        if coordinator.complete(lease):
+            finished.append(lease.shard)
+
+
+def merge_shards(work_dir: str, output_dir: str) -> ShardManifest:
+    """Concatenate finished shards in shard order into a ``run_pipeline_sharded``-style directory."""
+
+    coordinator = ShardCoordinator(work_dir)
+    plan = coordinator.plan
+    missing = coordinator.pending()
+    if missing:
+        raise RuntimeError(f"{len(missing)} shards are not finished yet, e.g. shard {missing[0]}.")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = ShardManifest(params={**plan.params, **plan.fingerprint}, next_prompt=plan.num_prompts)
+    for shard in range(plan.num_shards):
+        source_dir = coordinator.done_output_dir(shard)
+        source = load_manifest(source_dir)
+        start, end = plan.prompt_range(shard)
+        if source is None or source.next_prompt != end:
+            raise RuntimeError(f"Output of shard {shard} in {source_dir} is incomplete.")
+        if source.params != manifest.params:
+            raise RuntimeError(f"Output of shard {shard} in {source_dir} was made with different parameters.")
+        files: Dict[str, str] = {}
+        counts = {stream: 0 for stream in STREAMS}
+        for stream in STREAMS:
+            name = f"{stream}-{shard:05d}.jsonl"
+            path = os.path.join(output_dir, name)
+            with open(f"{path}.tmp", "wb") as target:
+                for record in source.shards:
+                    with open(os.path.join(source_dir, record.files[stream]), "rb") as handle:
+                        shutil.copyfileobj(handle, target)
+                    counts[stream] += record.counts[stream]
+            os.replace(f"{path}.tmp", path)
+            files[stream] = name
+        manifest.shards.append(
+            ShardRecord(index=shard, first_prompt=start, end_prompt=end, files=files, counts=counts)
+        )
+    write_json_atomic(os.path.join(output_dir, MANIFEST_NAME), manifest.to_dict())
+    return manifest
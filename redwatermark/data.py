@@ -3,12 +3,16 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Callable, Iterable, List, Optional, Sequence
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import numpy as np
+
+from redwatermark import metrics
+from redwatermark.cache import CachedGeneration, GenerationCache, cache_namespace, generation_key
 from redwatermark.filters import OddityFlags, detect_oddities
 from redwatermark.model import ModelInterface
 from redwatermark.scoring import ScoreWeights, score_candidate
-from redwatermark.teacher import RedBiasedTeacher
+from redwatermark.teacher import EarlyRejectionConfig, GenerationResult, RedBiasedTeacher
 
 
 @dataclass(frozen=True)
@@ -22,17 +26,89 @@ class SampleMetadata:
     score: float
 
 
+def compute_token_logprobs(
+    model: ModelInterface,
+    batch_token_ids: Sequence[Sequence[int]],
+) -> List[List[float]]:
+    """Teacher-forced log-probs of ``token_ids[1:]`` for each sequence, batched when the model allows."""
+
+    sequence_logprobs_batch = getattr(model, "sequence_logprobs_batch", None)
+    if sequence_logprobs_batch is not None:
+        return sequence_logprobs_batch(batch_token_ids)
+    return [
+        [model.logprob(token_ids[:idx], token_ids[idx]) for idx in range(1, len(token_ids))]
+        for token_ids in batch_token_ids
+    ]
+
+
 def compute_base_logprob(
     model: ModelInterface,
     token_ids: Sequence[int],
 ) -> float:
-    logprob = 0.0
-    for idx in range(1, len(token_ids)):
-        logprob += model.logprob(token_ids[:idx], token_ids[idx])
-    return logprob
+    return compute_base_logprobs(model, [token_ids])[0]
 
 
-def generate_candidates(
+def compute_base_logprobs(
+    model: ModelInterface,
+    batch_token_ids: Sequence[Sequence[int]],
+) -> List[float]:
+    """Score a batch of sequences with one teacher-forced pass."""
+
+    with metrics.stage("data.compute_base_logprobs") as stage:
+        scored = [token_ids for token_ids in batch_token_ids if len(token_ids) > 1]
+        stage.add_tokens(sum(len(token_ids) for token_ids in scored))
+        logprobs = iter(compute_token_logprobs(model, scored))
+        return [sum(next(logprobs)) if len(token_ids) > 1 else 0.0 for token_ids in batch_token_ids]
+
+
+def derive_sample_seed(rng_seed: int, prompt_idx: int, sample_idx: int) -> int:
+    """Return an independent 63-bit seed for one (prompt, sample) pair.
+
+    Seeds come from a ``numpy.random.SeedSequence`` keyed on all three values,
+    so they never collide across prompts and do not depend on how prompts are
+    batched or sharded across workers.
+    """
+
+    state = np.random.SeedSequence([rng_seed, prompt_idx, sample_idx]).generate_state(1, dtype=np.uint64)
+    return int(state[0] >> np.uint64(1))
+
+
+def iter_jobs(
+    prompts: Iterable[str],
+    samples_per_prompt: int,
+    rng_seed: int,
+    start_index: int = 0,
+) -> Iterator[Tuple[int, str, int]]:
+    """Yield ``(prompt_index, prompt, seed)`` for every sample to generate."""
+
+    for prompt_idx, prompt in enumerate(prompts, start=start_index):
+        for sample_idx in range(samples_per_prompt):
+            yield prompt_idx, prompt, derive_sample_seed(rng_seed, prompt_idx, sample_idx)
+
+
+def _iter_batches(
+    jobs: Iterable[Tuple[int, str, int]],
+    batch_size: int,
+    per_prompt: bool = False,
+) -> Iterator[List[Tuple[int, str, int]]]:
+    """Group jobs into batches of at most ``batch_size``, never mixing prompts if ``per_prompt``."""
+
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive.")
+    batch: List[Tuple[int, str, int]] = []
+    for job in jobs:
+        if per_prompt and batch and job[0] != batch[0][0]:
+            yield batch
+            batch = []
+        batch.append(job)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_candidate_groups(
     teacher: RedBiasedTeacher,
     model: ModelInterface,
     prompts: Iterable[str],
@@ -41,17 +117,89 @@ def generate_candidates(
     scorer: Optional[Callable[[float, float, Optional[float], OddityFlags], float]] = None,
     score_weights: Optional[ScoreWeights] = None,
     rng_seed: int = 0,
-) -> List[SampleMetadata]:
+    batch_size: int = 8,
+    on_device: bool = False,
+    share_prefix: bool = False,
+    start_index: int = 0,
+    rejection: Optional[EarlyRejectionConfig] = None,
+    accept_score: Optional[float] = None,
+    cache: Optional[GenerationCache] = None,
+) -> Iterator[Tuple[int, List[SampleMetadata]]]:
+    """Lazily generate and score candidates, yielding ``(prompt_index, samples)`` per prompt.
+
+    Prompts are consumed as batches need them, so memory stays bounded by
+    ``batch_size``. ``start_index`` numbers the first prompt, which keeps
+    seeds stable when resuming part-way through a prompt stream.
+
+    Candidates aborted by ``rejection`` are left out of their group (which
+    may end up empty). With ``accept_score``, a prompt's samples are drawn
+    ``batch_size`` at a time and sampling stops once a candidate scores at
+    least ``accept_score``; the candidates kept are a prefix of what a full
+    run would produce.
+
+    With ``cache``, generations and their base log-probs are looked up by
+    content key before decoding and stored after, so reruns with other
+    score weights or selection only redo the scoring.
+    """
+
     if score_weights is None:
         score_weights = ScoreWeights()
+    if on_device and (rejection is not None or accept_score is not None):
+        raise ValueError("Early rejection and adaptive stopping are not supported with on_device.")
+    if on_device and share_prefix:
+        raise ValueError("share_prefix is not supported with on_device.")
+    if on_device and cache is not None:
+        raise ValueError("on_device samples with torch's RNG, so its generations cannot share the cache.")
+    namespace = None if cache is None else cache_namespace(teacher, model)
 
-    all_samples: List[SampleMetadata] = []
-    for prompt_idx, prompt in enumerate(prompts):
-        for sample_idx in range(samples_per_prompt):
-            token_ids = teacher.generate(prompt, rng_seed=rng_seed + prompt_idx + sample_idx)
+    def generate(batch: List[Tuple[int, str, int]]) -> List[GenerationResult]:
+        batch_prompts = [prompt for _, prompt, _ in batch]
+        batch_seeds = [seed for _, _, seed in batch]
+        if on_device:
+            token_batch = teacher.generate_batch_on_device(batch_prompts, rng_seed=batch_seeds)
+            return [GenerationResult(token_ids, prompt_length=0) for token_ids in token_batch]
+        return teacher.generate_results(batch_prompts, batch_seeds, rejection, share_prefix=share_prefix)
+
+    def generate_cached(batch: List[Tuple[int, str, int]]) -> List[CachedGeneration]:
+        keys = [generation_key(namespace, teacher.config, prompt, seed, rejection) for _, prompt, seed in batch]
+        entries = [cache.get(key) for key in keys]
+        missing = [idx for idx, entry in enumerate(entries) if entry is None]
+        if missing:
+            results = generate([batch[idx] for idx in missing])
+            scored = [result.token_ids for result in results if not result.rejected and len(result.token_ids) > 1]
+            token_logprobs = iter(compute_token_logprobs(model, scored))
+            for idx, result in zip(missing, results):
+                unscored = result.rejected or len(result.token_ids) <= 1
+                entry = CachedGeneration(
+                    token_ids=list(result.token_ids),
+                    prompt_length=result.prompt_length,
+                    finish_reason=result.finish_reason,
+                    base_logprobs=[] if unscored else list(next(token_logprobs)),
+                )
+                cache.put(keys[idx], entry)
+                entries[idx] = entry
+        return entries
+
+    def score_batch(batch: List[Tuple[int, str, int]]) -> List[Tuple[int, Optional[SampleMetadata]]]:
+        if cache is None:
+            results = generate(batch)
+            kept = [result.token_ids for result in results if not result.rejected]
+            base_logprobs = iter(compute_base_logprobs(model, kept))
+        else:
+            entries = generate_cached(batch)
+            results = [GenerationResult(entry.token_ids, entry.prompt_length, entry.finish_reason) for entry in entries]
+            base_logprobs = iter(
+                [float(sum(entry.base_logprobs)) for entry, result in zip(entries, results) if not result.rejected]
+            )
+        scored: List[Tuple[int, Optional[SampleMetadata]]] = []
+        for (prompt_idx, prompt, _), result in zip(batch, results):
+            if result.rejected:
+                scored.append((prompt_idx, None))
+                continue
+            token_ids = result.token_ids
+            base_logprob = next(base_logprobs)
             completion = model.decode(token_ids)
             rate = teacher.summarize_red_rate(token_ids)
-            base_logprob = compute_base_logprob(model, token_ids)
             oddities = detect_oddities(completion)
             if scorer is None:
                 score = score_candidate(
@@ -63,17 +211,95 @@ def generate_candidates(
                 )
             else:
                 score = scorer(rate, target_red_rate, base_logprob, oddities)
-            all_samples.append(
-                SampleMetadata(
-                    prompt=prompt,
-                    completion=completion,
-                    token_ids=token_ids,
-                    red_rate=rate,
-                    base_logprob=base_logprob,
-                    oddities=oddities,
-                    score=score,
-                )
+            sample = SampleMetadata(
+                prompt=prompt,
+                completion=completion,
+                token_ids=token_ids,
+                red_rate=rate,
+                base_logprob=base_logprob,
+                oddities=oddities,
+                score=score,
             )
+            scored.append((prompt_idx, sample))
+        return scored
+
+    if accept_score is not None:
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive.")
+        for prompt_idx, prompt in enumerate(prompts, start=start_index):
+            group: List[SampleMetadata] = []
+            for first in range(0, samples_per_prompt, batch_size):
+                batch = [
+                    (prompt_idx, prompt, derive_sample_seed(rng_seed, prompt_idx, sample_idx))
+                    for sample_idx in range(first, min(first + batch_size, samples_per_prompt))
+                ]
+                group.extend(sample for _, sample in score_batch(batch) if sample is not None)
+                if any(sample.score >= accept_score for sample in group):
+                    break
+            yield prompt_idx, group
+        return
+
+    group_index: Optional[int] = None
+    group = []
+    jobs = iter_jobs(prompts, samples_per_prompt, rng_seed, start_index)
+    for batch in _iter_batches(jobs, batch_size, per_prompt=share_prefix):
+        for prompt_idx, sample in score_batch(batch):
+            if prompt_idx != group_index:
+                if group_index is not None:
+                    yield group_index, group
+                group_index, group = prompt_idx, []
+            if sample is not None:
+                group.append(sample)
+    if group_index is not None:
+        yield group_index, group
+
+
+def generate_candidates(
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    samples_per_prompt: int = 4,
+    scorer: Optional[Callable[[float, float, Optional[float], OddityFlags], float]] = None,
+    score_weights: Optional[ScoreWeights] = None,
+    rng_seed: int = 0,
+    batch_size: int = 8,
+    on_device: bool = False,
+    share_prefix: bool = False,
+    rejection: Optional[EarlyRejectionConfig] = None,
+    accept_score: Optional[float] = None,
+    cache: Optional[GenerationCache] = None,
+) -> List[SampleMetadata]:
+    """Generate and score candidates, decoding ``batch_size`` sequences at a time.
+
+    With ``on_device`` the teacher samples through the model's own generate
+    loop with one torch generator per sample seed. With
+    ``share_prefix`` a batch holds up to ``batch_size`` samples of a single
+    prompt, which is prefilled once and forked into one branch per sample.
+    This saves prefill compute, not memory: each branch copies the prefix
+    cache on its first decoding step.
+    ``rejection``, ``accept_score`` and ``cache`` are described in
+    ``iter_candidate_groups``.
+    """
+
+    all_samples: List[SampleMetadata] = []
+    for _, group in iter_candidate_groups(
+        teacher=teacher,
+        model=model,
+        prompts=prompts,
+        target_red_rate=target_red_rate,
+        samples_per_prompt=samples_per_prompt,
+        scorer=scorer,
+        score_weights=score_weights,
+        rng_seed=rng_seed,
+        batch_size=batch_size,
+        on_device=on_device,
+        share_prefix=share_prefix,
+        rejection=rejection,
+        accept_score=accept_score,
+        cache=cache,
+    ):
+        all_samples.extend(group)
     return all_samples
 
 
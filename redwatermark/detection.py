@@ -0,0 +1,296 @@
+"""Batch red-rate detection over large text corpora."""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+import itertools
+import json
+import math
+import multiprocessing
+import time
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from redwatermark.hf_model import HFTokenizer
+from redwatermark.partition import VocabPartition
+
+Document = Tuple[str, str]
+
+
+@dataclass(frozen=True)
+class DetectionResult:
+    """Red-rate statistics for one document.
+
+    ``z_score`` tests the red count against the red fraction expected from
+    unwatermarked text; ``p_value`` is its one-sided upper tail.
+    """
+
+    doc_id: str
+    num_tokens: int
+    eligible: int
+    red: int
+    red_rate: float
+    z_score: float
+    p_value: float
+
+
+class RedRateDetector:
+    """Counts eligible and red tokens with boolean lookup tables.
+
+    A batch of documents is flattened into one id array, looked up in the
+    tables and summed per document with ``np.add.reduceat``. Ids outside the
+    tables count as ineligible.
+    """
+
+    def __init__(
+        self,
+        red_tokens: Iterable[int],
+        eligible_tokens: Iterable[int],
+        red_fraction: Optional[float] = None,
+    ) -> None:
+        eligible_ids = np.fromiter(eligible_tokens, dtype=np.int64)
+        red_ids = np.fromiter(red_tokens, dtype=np.int64)
+        size = int(max(eligible_ids.max(initial=-1), red_ids.max(initial=-1))) + 1
+        eligible_mask = np.zeros(size, dtype=bool)
+        eligible_mask[eligible_ids] = True
+        red_mask = np.zeros(size, dtype=bool)
+        red_mask[red_ids] = True
+        self._set_masks(red_mask, eligible_mask, red_fraction)
+        self.partition: Optional[VocabPartition] = None
+
+    @classmethod
+    def from_partition(cls, partition: VocabPartition, red_fraction: Optional[float] = None) -> RedRateDetector:
+        """Build from a ``VocabPartition``; pickles as the partition (a path when file-backed)."""
+
+        detector = cls.from_masks(partition.red_mask(), partition.eligible_mask(), red_fraction)
+        detector.partition = partition
+        return detector
+
+    def __reduce__(self) -> Any:
+        if self.partition is None:
+            return super().__reduce__()
+        return (RedRateDetector.from_partition, (self.partition, self.red_fraction))
+
+    @classmethod
+    def from_masks(
+        cls,
+        red_mask: np.ndarray,
+        eligible_mask: np.ndarray,
+        red_fraction: Optional[float] = None,
+    ) -> RedRateDetector:
+        detector = cls.__new__(cls)
+        detector._set_masks(np.asarray(red_mask, dtype=bool), np.asarray(eligible_mask, dtype=bool), red_fraction)
+        detector.partition = None
+        return detector
+
+    def _set_masks(self, red_mask: np.ndarray, eligible_mask: np.ndarray, red_fraction: Optional[float]) -> None:
+        if red_mask.shape != eligible_mask.shape:
+            raise ValueError("Red and eligible masks must have the same size.")
+        # One extra False slot absorbs out-of-range ids.
+        self.vocab_size = int(eligible_mask.shape[0])
+        self.eligible_mask = np.append(eligible_mask, False)
+        self.red_mask = np.append(red_mask & eligible_mask, False)
+        if red_fraction is None:
+            num_eligible = int(self.eligible_mask.sum())
+            red_fraction = float(self.red_mask.sum()) / num_eligible if num_eligible else 0.0
+        self.red_fraction = red_fraction
+
+    def counts(self, batch_token_ids: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return per-document ``(num_tokens, eligible, red)`` count arrays."""
+
+        lengths = np.fromiter((len(token_ids) for token_ids in batch_token_ids), dtype=np.int64, count=len(batch_token_ids))
+        if not lengths.sum():
+            zeros = np.zeros(len(batch_token_ids), dtype=np.int64)
+            return lengths, zeros, zeros.copy()
+        ids = np.concatenate([np.asarray(token_ids, dtype=np.int64) for token_ids in batch_token_ids])
+        ids = np.where((ids >= 0) & (ids < self.vocab_size), ids, self.vocab_size)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        nonempty = lengths > 0
+        eligible = np.zeros(len(lengths), dtype=np.int64)
+        red = np.zeros(len(lengths), dtype=np.int64)
+        eligible[nonempty] = np.add.reduceat(self.eligible_mask[ids].astype(np.int64), offsets[nonempty])
+        red[nonempty] = np.add.reduceat(self.red_mask[ids].astype(np.int64), offsets[nonempty])
+        return lengths, eligible, red
+
+    def score_batch(
+        self,
+        batch_token_ids: Sequence[Sequence[int]],
+        doc_ids: Optional[Sequence[str]] = None,
+    ) -> List[DetectionResult]:
+        lengths, eligible, red = self.counts(batch_token_ids)
+        gamma = self.red_fraction
+        rates = np.divide(red, eligible, out=np.zeros(len(red)), where=eligible > 0)
+        spread = np.sqrt(eligible * gamma * (1.0 - gamma))
+        z_scores = np.divide(red - gamma * eligible, spread, out=np.zeros(len(red)), where=spread > 0)
+        if doc_ids is None:
+            doc_ids = [str(idx) for idx in range(len(batch_token_ids))]
+        return [
+            DetectionResult(
+                doc_id=doc_id,
+                num_tokens=int(lengths[idx]),
+                eligible=int(eligible[idx]),
+                red=int(red[idx]),
+                red_rate=float(rates[idx]),
+                z_score=float(z_scores[idx]),
+                p_value=0.5 * math.erfc(z_scores[idx] / math.sqrt(2.0)),
+            )
+            for idx, doc_id in enumerate(doc_ids)
+        ]
+
+    def score(self, token_ids: Sequence[int], doc_id: str = "0") -> DetectionResult:
+        return self.score_batch([token_ids], [doc_id])[0]
+
+
+def iter_documents(
+    paths: Iterable[str],
+    text_field: str = "text",
+    id_field: str = "id",
+) -> Iterator[Document]:
+    """Stream ``(doc_id, text)`` from JSONL files or plain text (one document per line).
+
+    JSONL documents without ``id_field`` and text lines are identified as
+    ``path:line``.
+    """
+
+    for path in paths:
+        is_jsonl = path.endswith((".jsonl", ".json"))
+        with open(path, "r", encoding="utf-8") as handle:
+            for line_no, line in enumerate(handle, start=1):
+                if not line.strip():
+                    continue
+                if is_jsonl:
+                    record = json.loads(line)
+                    yield str(record.get(id_field, f"{path}:{line_no}")), record[text_field]
+                else:
+                    yield f"{path}:{line_no}", line.rstrip("\n")
+
+
+def _encode_batch(tokenizer: Any, texts: Sequence[str]) -> List[List[int]]:
+    encode_batch = getattr(tokenizer, "encode_batch", None)
+    if encode_batch is not None:
+        return encode_batch(texts)
+    return [tokenizer.encode(text) for text in texts]
+
+
+def _scan_batch(tokenizer: Any, detector: RedRateDetector, documents: List[Document]) -> List[DetectionResult]:
+    doc_ids = [doc_id for doc_id, _ in documents]
+    return detector.score_batch(_encode_batch(tokenizer, [text for _, text in documents]), doc_ids)
+
+
+_WORKER: Optional[Tuple[Any, RedRateDetector]] = None
+
+
+def _init_worker(
+    tokenizer_factory: Callable[[Any], Any],
+    tokenizer_config: Any,
+    detector: RedRateDetector,
+) -> None:
+    global _WORKER
+    _WORKER = (tokenizer_factory(tokenizer_config), detector)
+
+
+def _run_batch(documents: List[Document]) -> List[DetectionResult]:
+    if _WORKER is None:
+        raise RuntimeError("Worker process was not initialized.")
+    return _scan_batch(*_WORKER, documents)
+
+
+def _iter_document_batches(documents: Iterable[Document], batch_size: int) -> Iterator[List[Document]]:
+    iterator = iter(documents)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_detections(
+    documents: Iterable[Document],
+    detector: RedRateDetector,
+    tokenizer_config: Any,
+    tokenizer_factory: Callable[[Any], Any] = HFTokenizer,
+    workers: int = 1,
+    batch_size: int = 256,
+    mp_context: str = "spawn",
+) -> Iterator[DetectionResult]:
+    """Tokenize and score documents, yielding results in input order.
+
+    With ``workers > 1`` batches go to a process pool, each process building
+    its own tokenizer once; at most two batches per worker are in flight.
+    """
+
+    if workers <= 0:
+        raise ValueError("workers must be positive.")
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive.")
+    batches = _iter_document_batches(documents, batch_size)
+    if workers == 1:
+        tokenizer = tokenizer_factory(tokenizer_config)
+        for batch in batches:
+            yield from _scan_batch(tokenizer, detector, batch)
+        return
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(mp_context),
+        initializer=_init_worker,
+        initargs=(tokenizer_factory, tokenizer_config, detector),
+    ) as executor:
+        pending: Deque[Future] = deque()
+        for batch in batches:
+            pending.append(executor.submit(_run_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+@dataclass(frozen=True)
+class ScanSummary:
+    documents: int
+    tokens: int
+    flagged: int
+    elapsed_seconds: float
+    documents_per_second: float
+
+
+def scan_corpus(
+    paths: Sequence[str],
+    output_path: str,
+    detector: RedRateDetector,
+    tokenizer_config: Any,
+    z_threshold: float = 4.0,
+    text_field: str = "text",
+    id_field: str = "id",
+    **kwargs: Any,
+) -> ScanSummary:
+    """Scan text/JSONL files and append one JSON result per document to ``output_path``.
+
+    Results are flushed batch by batch, so a long scan can be followed (and
+    its partial output used) while it runs. Documents with
+    ``z_score >= z_threshold`` are counted as flagged. Extra keyword
+    arguments go to ``iter_detections``.
+    """
+
+    start = time.perf_counter()
+    documents = tokens = flagged = 0
+    batch_size = kwargs.get("batch_size", 256)
+    results = iter_detections(iter_documents(paths, text_field, id_field), detector, tokenizer_config, **kwargs)
+    with open(output_path, "a", encoding="utf-8") as handle:
+        for result in results:
+            handle.write(json.dumps(asdict(result)) + "\n")
+            documents += 1
+            tokens += result.num_tokens
+            flagged += result.z_score >= z_threshold
+            if documents % batch_size == 0:
+                handle.flush()
+    elapsed = time.perf_counter() - start
+    return ScanSummary(
+        documents=documents,
+        tokens=tokens,
+        flagged=flagged,
+        elapsed_seconds=elapsed,
+        documents_per_second=documents / elapsed if elapsed > 0 else 0.0,
+    )
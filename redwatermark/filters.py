@@ -2,9 +2,15 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields
+import multiprocessing
 import re
-from typing import Iterable
+from typing import Iterable, List, Sequence
+
+import numpy as np
+
+from redwatermark import metrics
 
 
 @dataclass(frozen=True)
@@ -24,37 +30,99 @@ FILLER_PREFIXES = (
     "like ",
 )
 
+# Bit ``i`` of a packed flag byte is ``ODDITY_FIELDS[i]``.
+ODDITY_FIELDS = tuple(item.name for item in fields(OddityFlags))
+
+_WORD = re.compile(r"[A-Za-z]+")
+_ASCII_CHAR = re.compile(r"[\x00-\x7f]")
+_DIGIT = re.compile(r"\d")
+_NUMBER_CORRUPTION = re.compile(r"\d{1,3}(?:\D\d{1,3}){3,}")
+_REPEATED_PUNCT = re.compile(r"[!?]{3,}")
+# Lowercasing never shortens a string, so the longest prefix's length of
+# leading characters decides the filler check.
+_FILLER_PREFIX_CHARS = max(len(prefix) for prefix in FILLER_PREFIXES)
 
-def _has_mixed_script(text: str) -> bool:
-    has_ascii = any(ord(char) < 128 for char in text)
-    has_non_ascii = any(ord(char) > 127 for char in text)
-    return has_ascii and has_non_ascii
 
+def oddity_bits(text: str) -> int:
+    """Compute every oddity flag for ``text`` as a bitmask over ``ODDITY_FIELDS``.
 
-def _caps_weirdness(text: str) -> bool:
-    words = re.findall(r"[A-Za-z]+", text)
-    if not words:
-        return False
-    upper_ratio = sum(word.isupper() for word in words) / len(words)
-    return upper_ratio > 0.4
+    Each check runs as a C-level scan over shared compiled patterns, and checks
+    that cannot fire are skipped: pure-ASCII text skips the script check,
+    digit-free text skips the number regex and text without ``!``/``?`` skips
+    the punctuation regex.
+    """
 
+    bits = 0
+    words = _WORD.findall(text)
+    if words and sum(map(str.isupper, words)) > 0.4 * len(words):
+        bits |= 1
+    if text[:_FILLER_PREFIX_CHARS].lower().startswith(FILLER_PREFIXES):
+        bits |= 2
+    if not text.isascii() and _ASCII_CHAR.search(text):
+        bits |= 4
+    if _DIGIT.search(text) and _NUMBER_CORRUPTION.search(text):
+        bits |= 8
+    if ("!" in text or "?" in text) and _REPEATED_PUNCT.search(text):
+        bits |= 16
+    return bits
 
-def _number_corruption(text: str) -> bool:
-    return bool(re.search(r"\d{1,3}(?:\D\d{1,3}){3,}", text))
 
+def flags_from_bits(bits: int) -> OddityFlags:
+    return OddityFlags(*(bool(bits >> idx & 1) for idx in range(len(ODDITY_FIELDS))))
 
-def _repeated_punct(text: str) -> bool:
-    return bool(re.search(r"[!?]{3,}", text))
+
+def flags_to_bits(flags: OddityFlags) -> int:
+    return sum(1 << idx for idx, name in enumerate(ODDITY_FIELDS) if getattr(flags, name))
 
 
 def detect_oddities(text: str) -> OddityFlags:
-    return OddityFlags(
-        caps_weirdness=_caps_weirdness(text),
-        filler_prefix=text.lower().startswith(FILLER_PREFIXES),
-        mixed_script=_has_mixed_script(text),
-        number_corruption=_number_corruption(text),
-        repeated_punct=_repeated_punct(text),
-    )
+    with metrics.stage("filters.detect_oddities"):
+        return flags_from_bits(oddity_bits(text))
+
+
+def _oddity_bits_chunk(texts: List[str]) -> np.ndarray:
+    return np.fromiter(map(oddity_bits, texts), dtype=np.uint8, count=len(texts))
+
+
+def detect_oddities_batch(
+    texts: Sequence[str],
+    workers: int = 1,
+    chunk_size: int = 4096,
+    mp_context: str = "spawn",
+) -> np.ndarray:
+    """Return one ``uint8`` flag byte per text (bit layout in ``ODDITY_FIELDS``).
+
+    With ``workers > 1`` chunks of ``chunk_size`` texts are scanned in a
+    process pool; output order matches ``texts``.
+    """
+
+    if workers <= 0:
+        raise ValueError("workers must be positive.")
+    with metrics.stage("filters.detect_oddities_batch"):
+        if workers == 1 or len(texts) <= chunk_size:
+            return _oddity_bits_chunk(list(texts))
+        chunks = [list(texts[start : start + chunk_size]) for start in range(0, len(texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(mp_context)) as executor:
+            return np.concatenate(list(executor.map(_oddity_bits_chunk, chunks)))
+
+
+def flag_mask(names: Iterable[str] = ()) -> int:
+    """Bitmask selecting the named ``OddityFlags`` fields."""
+
+    name_set = set(names)
+    return sum(1 << idx for idx, name in enumerate(ODDITY_FIELDS) if name in name_set)
+
+
+def any_oddity_bits(bits: np.ndarray, allowed: Iterable[str] = ()) -> np.ndarray:
+    """Vectorized ``any_oddities`` over packed flag bytes."""
+
+    return (np.asarray(bits, dtype=np.uint8) & ~np.uint8(flag_mask(allowed))) != 0
+
+
+def oddity_counts(bits: np.ndarray) -> np.ndarray:
+    """Number of flags set per packed flag byte."""
+
+    return np.unpackbits(np.asarray(bits, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
 
 
 def oddity_score(flags: OddityFlags) -> float:
@@ -69,10 +137,4 @@ def oddity_score(flags: OddityFlags) -> float:
 
 
 def any_oddities(flags: OddityFlags, allowed: Iterable[str] = ()) -> bool:
-    allowed_set = set(allowed)
-    for field, value in flags.__dict__.items():
-        if field in allowed_set:
-            continue
-        if value:
-            return True
-    return False
+    return bool(flags_to_bits(flags) & ~flag_mask(allowed))
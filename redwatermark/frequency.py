@@ -0,0 +1,270 @@
+"""Corpus token-frequency counting for frequency-ranked eligibility."""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from redwatermark.detection import iter_documents
+from redwatermark.hf_model import HFTokenizer
+
+
+@dataclass
+class TokenCounts:
+    """Per-token-id occurrence counts; partial counts merge by addition."""
+
+    counts: np.ndarray
+    documents: int = 0
+
+    @classmethod
+    def empty(cls, vocab_size: int = 0) -> TokenCounts:
+        return cls(counts=np.zeros(vocab_size, dtype=np.int64))
+
+    @property
+    def tokens(self) -> int:
+        return int(self.counts.sum())
+
+    def add_ids(self, ids: np.ndarray, counts: np.ndarray, documents: int = 0) -> None:
+        """Add ``counts`` for distinct token ``ids``."""
+
+        if ids.size:
+            size = int(ids.max()) + 1
+            if size > self.counts.shape[0]:
+                self.counts = np.concatenate([self.counts, np.zeros(size - self.counts.shape[0], dtype=np.int64)])
+            self.counts[ids] += counts
+        self.documents += documents
+
+    def update(self, batch_token_ids: Sequence[Sequence[int]]) -> None:
+        ids, counts = _count_batch(batch_token_ids)
+        self.add_ids(ids, counts, len(batch_token_ids))
+
+    def merge(self, other: TokenCounts) -> None:
+        size = other.counts.shape[0]
+        if size > self.counts.shape[0]:
+            self.counts = np.concatenate([self.counts, np.zeros(size - self.counts.shape[0], dtype=np.int64)])
+        self.counts[:size] += other.counts
+        self.documents += other.documents
+
+    def save(self, path: str) -> None:
+        """Write counts via a temp file and rename."""
+
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, counts=self.counts, documents=np.int64(self.documents))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> TokenCounts:
+        with np.load(path) as payload:
+            return cls(counts=payload["counts"], documents=int(payload["documents"]))
+
+    def ranked_vocab(self, vocab: Dict[int, str]) -> List[Tuple[int, str]]:
+        """Return ``vocab`` as ``(token_id, token_str)`` by descending count.
+
+        Ties and unseen tokens fall back to token id order, so the result can
+        be passed straight to ``build_eligible_token_set``.
+        """
+
+        token_ids = np.fromiter(vocab.keys(), dtype=np.int64, count=len(vocab))
+        seen = token_ids < self.counts.shape[0]
+        counts = np.zeros(len(token_ids), dtype=np.int64)
+        counts[seen] = self.counts[token_ids[seen]]
+        order = np.lexsort((token_ids, -counts))
+        return [(int(token_id), vocab[int(token_id)]) for token_id in token_ids[order]]
+
+
+def _count_batch(batch_token_ids: Sequence[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the distinct ids of a batch and their counts."""
+
+    arrays = [np.asarray(token_ids, dtype=np.int64) for token_ids in batch_token_ids if len(token_ids)]
+    if not arrays:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    counts = np.bincount(np.concatenate(arrays))
+    ids = np.flatnonzero(counts)
+    return ids, counts[ids]
+
+
+_TOKENIZER: Optional[Any] = None
+
+
+def _init_worker(tokenizer_factory: Callable[[Any], Any], tokenizer_config: Any) -> None:
+    global _TOKENIZER
+    _TOKENIZER = tokenizer_factory(tokenizer_config)
+
+
+def _count_texts(texts: List[str]) -> Tuple[np.ndarray, np.ndarray, int]:
+    if _TOKENIZER is None:
+        raise RuntimeError("Worker process was not initialized.")
+    ids, counts = _count_batch(_TOKENIZER.encode_batch(texts))
+    return ids, counts, len(texts)
+
+
+def _iter_text_batches(texts: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    iterator = iter(texts)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class _BatchCounter:
+    """Count text streams with one tokenizer, or one worker pool, reused across calls.
+
+    The pool starts on the first call, so a fully resumed run spawns nothing.
+    """
+
+    def __init__(
+        self,
+        tokenizer_config: Any,
+        tokenizer_factory: Callable[[Any], Any],
+        workers: int,
+        batch_size: int,
+        mp_context: str,
+    ) -> None:
+        if workers <= 0:
+            raise ValueError("workers must be positive.")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive.")
+        self.tokenizer_config = tokenizer_config
+        self.tokenizer_factory = tokenizer_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        self.mp_context = mp_context
+        self._tokenizer: Optional[Any] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def count(self, texts: Iterable[str]) -> TokenCounts:
+        totals = TokenCounts.empty()
+        batches = _iter_text_batches(texts, self.batch_size)
+        if self.workers == 1:
+            if self._tokenizer is None:
+                self._tokenizer = self.tokenizer_factory(self.tokenizer_config)
+            for batch in batches:
+                totals.update(self._tokenizer.encode_batch(batch))
+            return totals
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self.mp_context),
+                initializer=_init_worker,
+                initargs=(self.tokenizer_factory, self.tokenizer_config),
+            )
+        pending: Deque[Future] = deque()
+        for batch in batches:
+            pending.append(self._executor.submit(_count_texts, batch))
+            if len(pending) >= 2 * self.workers:
+                totals.add_ids(*pending.popleft().result())
+        while pending:
+            totals.add_ids(*pending.popleft().result())
+        return totals
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> _BatchCounter:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def count_tokens(
+    texts: Iterable[str],
+    tokenizer_config: Any,
+    tokenizer_factory: Callable[[Any], Any] = HFTokenizer,
+    workers: int = 1,
+    batch_size: int = 1024,
+    mp_context: str = "spawn",
+) -> TokenCounts:
+    """Tokenize a text stream in batches and count token ids.
+
+    Memory is bounded by the vocabulary size plus the batches in flight (at
+    most two per worker); each batch comes back as distinct ids and counts.
+    """
+
+    with _BatchCounter(tokenizer_config, tokenizer_factory, workers, batch_size, mp_context) as counter:
+        return counter.count(texts)
+
+
+def _shard_source(path: str, text_field: str) -> str:
+    """Describe an input file well enough to notice when it changes."""
+
+    stat = os.stat(path)
+    return json.dumps(
+        {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "text_field": text_field},
+        sort_keys=True,
+    )
+
+
+def _load_shard(path: str, source: str) -> Optional[TokenCounts]:
+    """Load saved partial counts if they were made from ``source``."""
+
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as payload:
+        if "source" not in payload or str(payload["source"]) != source:
+            return None
+        return TokenCounts(counts=payload["counts"], documents=int(payload["documents"]))
+
+
+def _save_shard(path: str, counts: TokenCounts, source: str) -> None:
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, counts=counts.counts, documents=np.int64(counts.documents), source=np.array(source))
+    os.replace(tmp_path, path)
+
+
+def count_corpus(
+    paths: Sequence[str],
+    tokenizer_config: Any,
+    output_dir: Optional[str] = None,
+    text_field: str = "text",
+    tokenizer_factory: Callable[[Any], Any] = HFTokenizer,
+    workers: int = 1,
+    batch_size: int = 1024,
+    mp_context: str = "spawn",
+) -> TokenCounts:
+    """Count tokens over text/JSONL files, treating each file as a shard.
+
+    One worker pool serves every file. With ``output_dir`` each file's
+    partial counts are saved as ``counts-<hash>.npz``, keyed by the file's
+    path, size and modification time, and reused on a rerun only while the
+    file is unchanged, so an interrupted pass resumes at unfinished files.
+    """
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    totals = TokenCounts.empty()
+    with _BatchCounter(tokenizer_config, tokenizer_factory, workers, batch_size, mp_context) as counter:
+        for path in paths:
+            shard_path = shard = None
+            if output_dir is not None:
+                source = _shard_source(path, text_field)
+                digest = hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+                shard_path = os.path.join(output_dir, f"counts-{digest}.npz")
+                shard = _load_shard(shard_path, source)
+            if shard is None:
+                shard = counter.count(text for _, text in iter_documents([path], text_field=text_field))
+                if shard_path is not None:
+                    _save_shard(shard_path, shard, source)
+            totals.merge(shard)
+    return totals
+
+
+def merge_counts(paths: Iterable[str]) -> TokenCounts:
+    """Load and sum saved partial counts."""
+
+    totals = TokenCounts.empty()
+    for path in paths:
+        totals.merge(TokenCounts.load(path))
+    return totals
@@ -2,13 +2,21 @@
 
 from __future__ import annotations
 
+import copy
 from dataclasses import dataclass
-from typing import List, Sequence
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessor, LogitsProcessorList
 
-from redwatermark.model import ModelInterface, ModelOutput
+try:
+    from transformers.cache_utils import DynamicLayer
+except ImportError:  # older transformers only have tuple or monolithic caches
+    DynamicLayer = None
+
+from redwatermark import metrics
+from redwatermark.model import BatchDecodeSession, DecodeSession, ModelInterface, ModelOutput
+from watermark_sampler import RedBiasConfig as SamplerBiasConfig
 
 
 @dataclass
@@ -30,20 +38,522 @@ class HFModel(ModelInterface):
     def encode(self, text: str) -> List[int]:
         return self.tokenizer.encode(text, add_special_tokens=False)
 
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        return _encode_batch(self.tokenizer, texts)
+
     def decode(self, token_ids: Sequence[int]) -> str:
         return self.tokenizer.decode(list(token_ids), skip_special_tokens=True)
 
+    @property
+    def model_id(self) -> str:
+        return self.config.model_name
+
+    @property
+    def eos_token_id(self) -> Optional[int]:
+        return self.tokenizer.eos_token_id
+
     @torch.no_grad()
     def next_logits(self, input_ids: Sequence[int]) -> ModelOutput:
-        input_tensor = torch.tensor([list(input_ids)], device=self.config.device)
-        outputs = self.model(input_ids=input_tensor)
-        logits = outputs.logits[0, -1].float().cpu().tolist()
+        with metrics.stage("hf.next_logits") as stage:
+            metrics.count("forward_passes")
+            stage.add_tokens(len(input_ids))
+            input_tensor = torch.tensor([list(input_ids)], device=self.config.device)
+            outputs = self.model(input_ids=input_tensor)
+            logits = outputs.logits[0, -1].float().cpu().numpy()
         return ModelOutput(logits=logits)
 
+    def _pad_token_id(self) -> int:
+        for token_id in (self.tokenizer.pad_token_id, self.tokenizer.eos_token_id):
+            if token_id is not None:
+                return token_id
+        return 0
+
+    def _pad_batch(self, batch_input_ids: Sequence[Sequence[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Left-pad a batch so the last column holds every row's latest token."""
+
+        if any(len(input_ids) == 0 for input_ids in batch_input_ids):
+            raise ValueError("Cannot decode an empty sequence.")
+        max_len = max(len(input_ids) for input_ids in batch_input_ids)
+        pad_id = self._pad_token_id()
+        padded = [[pad_id] * (max_len - len(ids)) + list(ids) for ids in batch_input_ids]
+        mask = [[0] * (max_len - len(ids)) + [1] * len(ids) for ids in batch_input_ids]
+        device = self.config.device
+        return torch.tensor(padded, device=device), torch.tensor(mask, device=device)
+
+    @torch.no_grad()
+    def next_logits_batch(self, batch_input_ids: Sequence[Sequence[int]]) -> List[ModelOutput]:
+        if not batch_input_ids:
+            return []
+        metrics.count("forward_passes")
+        input_tensor, attention_mask = self._pad_batch(batch_input_ids)
+        outputs = self.model(
+            input_ids=input_tensor,
+            attention_mask=attention_mask,
+            position_ids=_position_ids(attention_mask),
+        )
+        logits = outputs.logits[:, -1].float().cpu().numpy()
+        return [ModelOutput(logits=row) for row in logits]
+
     @torch.no_grad()
     def logprob(self, input_ids: Sequence[int], target_id: int) -> float:
-        input_tensor = torch.tensor([list(input_ids)], device=self.config.device)
-        outputs = self.model(input_ids=input_tensor)
-        logits = outputs.logits[0, -1].float()
-        log_probs = torch.log_softmax(logits, dim=-1)
-        return log_probs[target_id].item()
+        with metrics.stage("hf.logprob") as stage:
+            metrics.count("forward_passes")
+            stage.add_tokens(len(input_ids))
+            input_tensor = torch.tensor([list(input_ids)], device=self.config.device)
+            outputs = self.model(input_ids=input_tensor)
+            logits = outputs.logits[0, -1].float()
+            log_probs = torch.log_softmax(logits, dim=-1)
+            return log_probs[target_id].item()
+
+    def sequence_logprobs(self, token_ids: Sequence[int]) -> List[float]:
+        return self.sequence_logprobs_batch([token_ids])[0]
+
+    @torch.no_grad()
+    def sequence_logprobs_batch(self, batch_token_ids: Sequence[Sequence[int]]) -> List[List[float]]:
+        if not batch_token_ids:
+            return []
+        metrics.count("forward_passes")
+        input_tensor, attention_mask = self._pad_batch(batch_token_ids)
+        outputs = self.model(
+            input_ids=input_tensor,
+            attention_mask=attention_mask,
+            position_ids=_position_ids(attention_mask),
+        )
+        logits = outputs.logits[:, :-1].float()
+        targets = input_tensor[:, 1:].unsqueeze(-1)
+        token_logprobs = logits.gather(-1, targets).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+        rows = token_logprobs.cpu().tolist()
+        # Rows are left-padded, so each row's real positions are its trailing entries.
+        return [row[len(row) - (len(token_ids) - 1):] for row, token_ids in zip(rows, batch_token_ids)]
+
+    @torch.no_grad()
+    def generate_red_biased(
+        self,
+        batch_input_ids: Sequence[Sequence[int]],
+        processor: RedBiasLogitsProcessor,
+        max_new_tokens: int,
+        rng_seed: Union[int, Sequence[int]] = 0,
+        eos_token_id: Optional[int] = None,
+        stop_strings: Sequence[str] = (),
+    ) -> List[List[int]]:
+        """Sample continuations with ``model.generate`` and an on-device red bias.
+
+        Logits never leave the device. Rows stop on ``eos_token_id`` or
+        ``stop_strings`` when given and are then padded to the longest row.
+        With one seed per row each row samples from its own ``torch.Generator``
+        and does not depend on the rest of the batch; a single seed seeds the
+        whole batch. torch's global RNG state is left untouched either way.
+        """
+
+        if not batch_input_ids:
+            return []
+        input_tensor, attention_mask = self._pad_batch(batch_input_ids)
+        stop_kwargs: Dict[str, Any] = {}
+        if stop_strings:
+            stop_kwargs = {"stop_strings": list(stop_strings), "tokenizer": self.tokenizer}
+        with metrics.stage("hf.generate_red_biased") as stage:
+            processors = LogitsProcessorList([processor])
+            if not isinstance(rng_seed, int):
+                if len(rng_seed) != len(batch_input_ids):
+                    raise ValueError("Expected one seed per row.")
+                processors.append(_SeededRowSampler(rng_seed, input_tensor.device))
+            devices = [input_tensor.device] if input_tensor.is_cuda else []
+            with torch.random.fork_rng(devices=devices):
+                if isinstance(rng_seed, int):
+                    torch.manual_seed(rng_seed)
+                outputs = self.model.generate(
+                    input_ids=input_tensor,
+                    attention_mask=attention_mask,
+                    logits_processor=processors,
+                    do_sample=True,
+                    top_k=0,
+                    top_p=1.0,
+                    temperature=1.0,
+                    max_new_tokens=max_new_tokens,
+                    min_new_tokens=0,
+                    eos_token_id=eos_token_id,
+                    pad_token_id=self._pad_token_id(),
+                    **stop_kwargs,
+                )
+            completions = outputs[:, input_tensor.shape[1] :].cpu().tolist()
+            stage.add_tokens(sum(len(completion) for completion in completions))
+        return [list(input_ids) + completion for input_ids, completion in zip(batch_input_ids, completions)]
+
+    def start_session(self, input_ids: Sequence[int]) -> DecodeSession:
+        return HFDecodeSession(self, input_ids)
+
+    def start_batch_session(self, batch_input_ids: Sequence[Sequence[int]]) -> BatchDecodeSession:
+        return HFBatchDecodeSession(self, batch_input_ids)
+
+
+class HFTokenizer:
+    """Tokenizer half of ``HFModel``, for workers that never run the model."""
+
+    def __init__(self, config: HFModelConfig) -> None:
+        self.config = config
+        self.tokenizer = AutoTokenizer.from_pretrained(config.model_name)
+
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        return _encode_batch(self.tokenizer, texts)
+
+
+def _encode_batch(tokenizer: Any, texts: Sequence[str]) -> List[List[int]]:
+    if not texts:
+        return []
+    return tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+
+
+class RedBiasLogitsProcessor(LogitsProcessor):
+    """Entropy-gated red bias as a ``transformers`` logits processor.
+
+    Mirrors ``watermark_sampler.RedBiasProcessor`` with torch ops, so gating
+    and biasing stay on the scores' device. Masks are built lazily for the
+    first vocabulary size and device seen.
+    """
+
+    def __init__(
+        self,
+        red_tokens: Iterable[int],
+        eligible_tokens: Iterable[int],
+        config: SamplerBiasConfig,
+    ) -> None:
+        self.red_tokens = sorted(set(red_tokens))
+        self.eligible_tokens = sorted(set(eligible_tokens))
+        self.config = config
+        self._masks: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None
+
+    def _masks_for(self, scores: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        vocab_size = scores.shape[-1]
+        if self._masks is None or self._masks[0].shape[0] != vocab_size or self._masks[0].device != scores.device:
+            red_mask = _token_mask(self.red_tokens, vocab_size, scores.device)
+            eligible_mask = _token_mask(self.eligible_tokens, vocab_size, scores.device)
+            bias = (red_mask & eligible_mask).float() * self.config.delta
+            self._masks = (red_mask, eligible_mask & ~red_mask, bias)
+        return self._masks
+
+    def gate(self, scores: torch.Tensor) -> torch.Tensor:
+        """Return a per-row boolean tensor telling whether to bias."""
+
+        red_mask, blue_mask, _ = self._masks_for(scores)
+        probs = torch.softmax(scores.float(), dim=-1)
+        step_entropy = torch.special.entr(probs).sum(dim=-1)
+        gated = step_entropy >= self.config.entropy_threshold
+        if self.config.top_k is None:
+            return gated
+        if self.config.top_k <= 0:
+            return torch.zeros_like(gated)
+        top_k = scores.topk(min(self.config.top_k, scores.shape[-1]), dim=-1).indices
+        return gated & red_mask[top_k].any(dim=-1) & blue_mask[top_k].any(dim=-1)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        _, _, bias = self._masks_for(scores)
+        gated = self.gate(scores)
+        recorder = metrics.active()
+        if recorder is not None:
+            # ``generate`` calls processors once per forward pass, finished rows included.
+            recorder.count("forward_passes")
+            recorder.count("gating.steps", gated.shape[0])
+            recorder.count("gating.fired", int(gated.sum()))
+        return scores + gated.unsqueeze(-1).to(scores.dtype) * bias.to(scores.dtype)
+
+
+class _SeededRowSampler(LogitsProcessor):
+    """Sample each row with its own generator and leave only that token possible.
+
+    ``generate``'s own multinomial then has a single choice, so a row's
+    samples depend only on its seed and its scores.
+    """
+
+    def __init__(self, seeds: Sequence[int], device: torch.device) -> None:
+        self.generators = [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        probs = torch.softmax(scores.float(), dim=-1)
+        tokens = torch.stack(
+            [torch.multinomial(row, 1, generator=generator) for row, generator in zip(probs, self.generators)]
+        )
+        return torch.full_like(scores, float("-inf")).scatter_(1, tokens, 0.0)
+
+
+def _token_mask(tokens: Sequence[int], vocab_size: int, device: torch.device) -> torch.Tensor:
+    ids = torch.tensor([token for token in tokens if 0 <= token < vocab_size], dtype=torch.long, device=device)
+    mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+    mask[ids] = True
+    return mask
+
+
+def _cache_tensors(past_key_values: Any) -> Optional[List[Tuple[torch.Tensor, torch.Tensor]]]:
+    """Return per-layer (keys, values) for caches we can reshape, else ``None``."""
+
+    if isinstance(past_key_values, tuple):
+        return [(layer[0], layer[1]) for layer in past_key_values]
+    layers = getattr(past_key_values, "layers", None)
+    if DynamicLayer is None or layers is None or not all(type(layer) is DynamicLayer for layer in layers):
+        return None
+    if any(layer.get_seq_length() == 0 for layer in layers):
+        return None
+    return [(layer.keys, layer.values) for layer in layers]
+
+
+def _with_cache_tensors(past_key_values: Any, tensors: Sequence[Tuple[torch.Tensor, torch.Tensor]]) -> Any:
+    """Return a new cache like ``past_key_values`` holding ``tensors``; the input is not modified."""
+
+    if isinstance(past_key_values, tuple):
+        return tuple((keys, values) + tuple(layer[2:]) for layer, (keys, values) in zip(past_key_values, tensors))
+    rebuilt = copy.copy(past_key_values)
+    rebuilt.layers = []
+    for layer, (keys, values) in zip(past_key_values.layers, tensors):
+        branch = copy.copy(layer)
+        branch.keys, branch.values = keys, values
+        rebuilt.layers.append(branch)
+    return rebuilt
+
+
+def _reshapable_cache_tensors(past_key_values: Any) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    tensors = _cache_tensors(past_key_values)
+    if tensors is None:
+        raise NotImplementedError(f"Cannot reshape a {type(past_key_values).__name__} across rows.")
+    return tensors
+
+
+def _fork_cache(past_key_values: Any, num_branches: int) -> Any:
+    """Broadcast a batch-1 KV cache to ``num_branches`` rows.
+
+    Tuple caches and plain dynamic layers are expanded as views, so the prefix
+    is shared until the first append concatenates a per-row copy. Other cache
+    types fall back to a real copy.
+    """
+
+    tensors = _cache_tensors(past_key_values)
+    if tensors is None:
+        forked = copy.deepcopy(past_key_values)
+        forked.batch_repeat_interleave(num_branches)
+        return forked
+    return _with_cache_tensors(
+        past_key_values,
+        [
+            (keys.expand(num_branches, *keys.shape[1:]), values.expand(num_branches, *values.shape[1:]))
+            for keys, values in tensors
+        ],
+    )
+
+
+def _left_pad_cache(past_key_values: Any, padding: int) -> Any:
+    if padding == 0:
+        return past_key_values
+
+    def pad(tensor: torch.Tensor) -> torch.Tensor:
+        zeros = tensor.new_zeros(*tensor.shape[:-2], padding, tensor.shape[-1])
+        return torch.cat([zeros, tensor], dim=-2)
+
+    tensors = _reshapable_cache_tensors(past_key_values)
+    return _with_cache_tensors(past_key_values, [(pad(keys), pad(values)) for keys, values in tensors])
+
+
+def _position_ids(attention_mask: torch.Tensor) -> torch.Tensor:
+    """Positions that skip left padding, so padded rows match unpadded ones."""
+
+    return (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+
+
+class HFDecodeSession(DecodeSession):
+    """KV-cached decoding session: prefill once, then one token per step."""
+
+    def __init__(self, model: HFModel, input_ids: Sequence[int]) -> None:
+        self.model = model
+        self.past_key_values: Optional[Any] = None
+        self._pending: List[int] = list(input_ids)
+        self._last_logits: Optional[torch.Tensor] = None
+        self.length = 0
+
+    @torch.no_grad()
+    def _forward_pending(self, num_logits: int) -> torch.Tensor:
+        """Run the pending tokens through the model; return the last ``num_logits`` logit rows."""
+
+        metrics.count("forward_passes")
+        input_tensor = torch.tensor([self._pending], device=self.model.config.device)
+        outputs = self.model.model(
+            input_ids=input_tensor,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+        )
+        self.past_key_values = outputs.past_key_values
+        logits = outputs.logits[0, -num_logits:].float()
+        self._last_logits = logits[-1]
+        self.length += len(self._pending)
+        self._pending = []
+        return logits
+
+    def _flush(self) -> torch.Tensor:
+        if self._pending:
+            self._forward_pending(1)
+        if self._last_logits is None:
+            raise ValueError("Decode session has no tokens to condition on.")
+        return self._last_logits
+
+    def next_logits(self) -> ModelOutput:
+        return ModelOutput(logits=self._flush().cpu().numpy())
+
+    def append(self, token_id: int) -> None:
+        self._pending.append(token_id)
+
+    def extend_logits(self, token_ids: Sequence[int]) -> List[ModelOutput]:
+        if not token_ids:
+            return []
+        self._pending.extend(token_ids)
+        return [ModelOutput(logits=row) for row in self._forward_pending(len(token_ids)).cpu().numpy()]
+
+    def rollback(self, num_tokens: int) -> None:
+        """Drop the last ``num_tokens`` tokens, cropping the KV cache if they were processed."""
+
+        dropped = min(num_tokens, len(self._pending))
+        if dropped:
+            del self._pending[-dropped:]
+        cropped = num_tokens - dropped
+        if cropped <= 0:
+            return
+        if cropped > self.length:
+            raise ValueError("Cannot roll back past the start of the sequence.")
+        self.length -= cropped
+        tensors = _reshapable_cache_tensors(self.past_key_values)
+        self.past_key_values = _with_cache_tensors(
+            self.past_key_values,
+            [(keys[..., : self.length, :], values[..., : self.length, :]) for keys, values in tensors],
+        )
+        self._last_logits = None
+
+    def fork(self, num_branches: int) -> BatchDecodeSession:
+        last_logits = self._flush()
+        device = self.model.config.device
+        return HFBatchDecodeSession.from_cache(
+            self.model,
+            past_key_values=_fork_cache(self.past_key_values, num_branches),
+            attention_mask=torch.ones(num_branches, self.length, dtype=torch.long, device=device),
+            last_logits=last_logits.expand(num_branches, -1),
+        )
+
+
+class HFBatchDecodeSession(BatchDecodeSession):
+    """KV-cached lockstep decoding over a left-padded batch."""
+
+    def __init__(self, model: HFModel, batch_input_ids: Sequence[Sequence[int]]) -> None:
+        self.model = model
+        self.past_key_values: Optional[Any] = None
+        self._pending: Optional[torch.Tensor]
+        self._pending, self.attention_mask = model._pad_batch(batch_input_ids)
+        self._last_logits: Optional[torch.Tensor] = None
+
+    @classmethod
+    def from_cache(
+        cls,
+        model: HFModel,
+        past_key_values: Any,
+        attention_mask: torch.Tensor,
+        last_logits: torch.Tensor,
+    ) -> HFBatchDecodeSession:
+        """Wrap an already prefilled cache, e.g. one forked from a single prompt."""
+
+        session = cls.__new__(cls)
+        session.model = model
+        session.past_key_values = past_key_values
+        session._pending = None
+        session.attention_mask = attention_mask
+        session._last_logits = last_logits
+        return session
+
+    @property
+    def batch_size(self) -> int:
+        return self.attention_mask.shape[0]
+
+    @torch.no_grad()
+    def _flush(self) -> torch.Tensor:
+        if self._pending is not None:
+            pending_len = self._pending.shape[1]
+            metrics.count("forward_passes")
+            outputs = self.model.model(
+                input_ids=self._pending,
+                attention_mask=self.attention_mask,
+                position_ids=_position_ids(self.attention_mask)[:, -pending_len:],
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+            self.past_key_values = outputs.past_key_values
+            self._last_logits = outputs.logits[:, -1].float()
+            self._pending = None
+        if self._last_logits is None:
+            raise ValueError("Decode session has no tokens to condition on.")
+        return self._last_logits
+
+    def next_logits(self) -> List[ModelOutput]:
+        if self.batch_size == 0:
+            return []
+        return [ModelOutput(logits=row) for row in self._flush().cpu().numpy()]
+
+    def select(self, rows: Sequence[int]) -> None:
+        """Keep only ``rows`` (in the given order), dropping their cache rows too."""
+
+        if self.batch_size > 0:
+            self._flush()
+        index = torch.tensor(list(rows), dtype=torch.long, device=self.attention_mask.device)
+        tensors = _reshapable_cache_tensors(self.past_key_values)
+        self.past_key_values = _with_cache_tensors(
+            self.past_key_values,
+            [(keys.index_select(0, index), values.index_select(0, index)) for keys, values in tensors],
+        )
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self._last_logits = self._last_logits.index_select(0, index)
+        self._trim_padding()
+
+    def extend(self, other: HFBatchDecodeSession) -> None:
+        """Append the rows of another session, left-padding the shorter cache."""
+
+        self._flush()
+        other._flush()
+        self_len = self.attention_mask.shape[1]
+        other_len = other.attention_mask.shape[1]
+        length = max(self_len, other_len)
+        mine = _reshapable_cache_tensors(_left_pad_cache(self.past_key_values, length - self_len))
+        theirs = _reshapable_cache_tensors(_left_pad_cache(other.past_key_values, length - other_len))
+        self.past_key_values = _with_cache_tensors(
+            self.past_key_values,
+            [
+                (torch.cat([keys, other_keys], dim=0), torch.cat([values, other_values], dim=0))
+                for (keys, values), (other_keys, other_values) in zip(mine, theirs)
+            ],
+        )
+        self.attention_mask = torch.cat(
+            [
+                torch.nn.functional.pad(self.attention_mask, (length - self_len, 0)),
+                torch.nn.functional.pad(other.attention_mask.to(self.attention_mask.dtype), (length - other_len, 0)),
+            ],
+            dim=0,
+        )
+        self._last_logits = torch.cat([self._last_logits, other._last_logits], dim=0)
+
+    def _trim_padding(self) -> None:
+        """Drop leading columns that are padding for every remaining row."""
+
+        if self.batch_size == 0:
+            return
+        used = self.attention_mask.sum(dim=0).nonzero()
+        start = int(used[0]) if len(used) else 0
+        if start == 0:
+            return
+        tensors = _reshapable_cache_tensors(self.past_key_values)
+        self.past_key_values = _with_cache_tensors(
+            self.past_key_values,
+            [(keys[..., start:, :], values[..., start:, :]) for keys, values in tensors],
+        )
+        self.attention_mask = self.attention_mask[:, start:]
+
+    def append(self, token_ids: Sequence[int]) -> None:
+        if len(token_ids) != self.batch_size:
+            raise ValueError("Expected one token id per row.")
+        device = self.model.config.device
+        column = torch.tensor(token_ids, device=device).unsqueeze(1)
+        self._pending = column if self._pending is None else torch.cat([self._pending, column], dim=1)
+        ones = torch.ones_like(column, dtype=self.attention_mask.dtype)
+        self.attention_mask = torch.cat([self.attention_mask, ones], dim=1)
@@ -0,0 +1,327 @@
+"""Opt-in instrumentation for the generation and scoring hot paths.
+
+Instrumented code asks for ``active()`` or opens a ``stage``; while no
+recorder is enabled both return immediately, so disabled instrumentation
+costs one global lookup per call. Enable a recorder with ``recording`` (or
+``enable``/``disable``) and pass sinks to export what it collected:
+
+* stages: calls, inclusive wall time and tokens per named stage
+  (``teacher.generate``, ``hf.next_logits``, ``pipeline.run_pipeline``, ...);
+* counters: ``forward_passes``, ``gating.steps`` and ``gating.fired``;
+* peak memory: process max RSS and, with CUDA, peak allocated device memory.
+
+Stages are ``with`` blocks inside the instrumented functions rather than
+wrappers, so sampling profilers such as py-spy see the original frames.
+"""
+
+from __future__ import annotations
+
+import cProfile
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+import json
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Protocol, Sequence, Union
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+@dataclass(frozen=True)
+class StageStats:
+    calls: int
+    seconds: float
+    tokens: int
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
+
+
+@dataclass(frozen=True)
+class MetricsSnapshot:
+    timestamp: float
+    stages: Dict[str, StageStats]
+    counters: Dict[str, float]
+    peak_rss_bytes: int
+    peak_device_bytes: Optional[int] = None
+
+    @property
+    def gating_hit_rate(self) -> float:
+        """Fraction of sampling steps where the entropy gate applied the bias."""
+
+        steps = self.counters.get("gating.steps", 0)
+        return self.counters.get("gating.fired", 0) / steps if steps else 0.0
+
+    def to_dict(self) -> Dict[str, object]:
+        payload = asdict(self)
+        for name, stats in self.stages.items():
+            payload["stages"][name]["tokens_per_second"] = stats.tokens_per_second
+        payload["gating_hit_rate"] = self.gating_hit_rate
+        return payload
+
+
+class MetricsSink(Protocol):
+    def emit(self, snapshot: MetricsSnapshot) -> None:
+        ...
+
+
+class StageHook(Protocol):
+    """Called around every stage, e.g. to start a profiler for selected stages."""
+
+    def enter(self, name: str) -> None:
+        ...
+
+    def exit(self, name: str, seconds: float) -> None:
+        ...
+
+
+def _peak_rss_bytes() -> int:
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere.
+    return int(peak if sys.platform == "darwin" else peak * 1024)
+
+
+def _peak_device_bytes() -> Optional[int]:
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return int(torch.cuda.max_memory_allocated())
+
+
+class _Stage:
+    __slots__ = ("_recorder", "name", "tokens", "_start")
+
+    def __init__(self, recorder: MetricsRecorder, name: str) -> None:
+        self._recorder = recorder
+        self.name = name
+        self.tokens = 0
+
+    def add_tokens(self, count: int) -> None:
+        self.tokens += count
+
+    def __enter__(self) -> _Stage:
+        for hook in self._recorder.hooks:
+            hook.enter(self.name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        seconds = time.perf_counter() - self._start
+        self._recorder.record(self.name, seconds, self.tokens)
+        for hook in self._recorder.hooks:
+            hook.exit(self.name, seconds)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def add_tokens(self, count: int) -> None:
+        pass
+
+    def __enter__(self) -> _NullStage:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class MetricsRecorder:
+    """Thread-safe accumulator of stage timings and counters."""
+
+    def __init__(self, sinks: Sequence[MetricsSink] = (), hooks: Sequence[StageHook] = ()) -> None:
+        self.sinks = list(sinks)
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self._stages: Dict[str, List[float]] = {}
+        self._counters: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float, tokens: int = 0) -> None:
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = [0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += tokens
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def snapshot(self) -> MetricsSnapshot:
+        with self._lock:
+            stages = {
+                name: StageStats(calls=int(calls), seconds=seconds, tokens=int(tokens))
+                for name, (calls, seconds, tokens) in self._stages.items()
+            }
+            counters = dict(self._counters)
+        return MetricsSnapshot(
+            timestamp=time.time(),
+            stages=stages,
+            counters=counters,
+            peak_rss_bytes=_peak_rss_bytes(),
+            peak_device_bytes=_peak_device_bytes(),
+        )
+
+    def emit(self) -> MetricsSnapshot:
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.emit(snapshot)
+        return snapshot
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+
+_RECORDER: Optional[MetricsRecorder] = None
+
+
+def active() -> Optional[MetricsRecorder]:
+    return _RECORDER
+
+
+def enable(recorder: Optional[MetricsRecorder] = None) -> MetricsRecorder:
+    global _RECORDER
+    _RECORDER = recorder if recorder is not None else MetricsRecorder()
+    return _RECORDER
+
+
+def disable() -> None:
+    global _RECORDER
+    _RECORDER = None
+
+
+@contextmanager
+def recording(sinks: Sequence[MetricsSink] = (), hooks: Sequence[StageHook] = ()) -> Iterator[MetricsRecorder]:
+    """Enable a fresh recorder for the block, then emit to ``sinks`` and restore the previous one."""
+
+    global _RECORDER
+    previous = _RECORDER
+    recorder = enable(MetricsRecorder(sinks, hooks))
+    try:
+        yield recorder
+    finally:
+        _RECORDER = previous
+        recorder.emit()
+
+
+def stage(name: str) -> Union[_Stage, _NullStage]:
+    """Time a block as stage ``name``; a shared no-op when recording is off."""
+
+    recorder = _RECORDER
+    if recorder is None:
+        return _NULL_STAGE
+    return _Stage(recorder, name)
+
+
+def count(name: str, value: float = 1) -> None:
+    recorder = _RECORDER
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        handle.write(text)
+    os.replace(tmp_path, path)
+
+
+def _metric_name(*parts: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(parts))
+
+
+class PrometheusTextSink:
+    """Rewrite a Prometheus text-format file, e.g. for node_exporter's textfile collector."""
+
+    def __init__(self, path: str, prefix: str = "redwatermark") -> None:
+        self.path = path
+        self.prefix = prefix
+
+    def render(self, snapshot: MetricsSnapshot) -> str:
+        lines: List[str] = []
+
+        def family(name: str, kind: str, samples: List[str]) -> None:
+            if samples:
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(samples)
+
+        stages = sorted(snapshot.stages.items())
+        for suffix, kind, value in (
+            ("stage_calls_total", "counter", lambda stats: stats.calls),
+            ("stage_seconds_total", "counter", lambda stats: stats.seconds),
+            ("stage_tokens_total", "counter", lambda stats: stats.tokens),
+            ("stage_tokens_per_second", "gauge", lambda stats: stats.tokens_per_second),
+        ):
+            name = _metric_name(self.prefix, suffix)
+            family(name, kind, [f'{name}{{stage="{stage}"}} {value(stats)!r}' for stage, stats in stages])
+        for counter, value in sorted(snapshot.counters.items()):
+            name = _metric_name(self.prefix, counter, "total")
+            family(name, "counter", [f"{name} {value!r}"])
+        gauges = {"gating_hit_rate": snapshot.gating_hit_rate, "peak_rss_bytes": snapshot.peak_rss_bytes}
+        if snapshot.peak_device_bytes is not None:
+            gauges["peak_device_bytes"] = snapshot.peak_device_bytes
+        for gauge, value in gauges.items():
+            name = _metric_name(self.prefix, gauge)
+            family(name, "gauge", [f"{name} {value!r}"])
+        return "\n".join(lines) + "\n"
+
+    def emit(self, snapshot: MetricsSnapshot) -> None:
+        _write_atomic(self.path, self.render(snapshot))
+
+
+class JSONLinesSink:
+    """Append one JSON object per emitted snapshot."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def emit(self, snapshot: MetricsSnapshot) -> None:
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps(snapshot.to_dict(), sort_keys=True) + "\n")
+
+
+class CProfileHook:
+    """Profile only inside the named stages and dump ``pstats`` data to ``path`` on emit.
+
+    Usable as both a hook and a sink; the dump opens in ``pstats`` or snakeviz.
+    Nested or repeated entries into profiled stages share one profiler.
+    """
+
+    def __init__(self, path: str, stages: Sequence[str] = ("pipeline.run_pipeline",)) -> None:
+        self.path = path
+        self.stages = set(stages)
+        self.profiler = cProfile.Profile()
+        self._depth = 0
+
+    def enter(self, name: str) -> None:
+        if name in self.stages:
+            if self._depth == 0:
+                self.profiler.enable()
+            self._depth += 1
+
+    def exit(self, name: str, seconds: float) -> None:
+        if name in self.stages:
+            self._depth -= 1
+            if self._depth == 0:
+                self.profiler.disable()
+
+    def emit(self, snapshot: MetricsSnapshot) -> None:
+        self.profiler.dump_stats(self.path)
@@ -8,11 +8,54 @@ from typing import List, Protocol, Sequence
 
 @dataclass(frozen=True)
 class ModelOutput:
-    """Container for model outputs used during sampling."""
+    """Container for model outputs used during sampling.
+
+    ``logits`` may be a list or a 1-D NumPy array; array-backed models should
+    avoid converting to Python floats.
+    """
 
     logits: Sequence[float]
 
 
+class DecodeSession(Protocol):
+    """Stateful decoding over a single growing sequence.
+
+    The session owns the prefix state (e.g. a KV cache), so each step only
+    has to process the newly appended token.
+    """
+
+    def next_logits(self) -> ModelOutput:
+        """Return logits for the next token given everything appended so far."""
+
+    def append(self, token_id: int) -> None:
+        """Extend the sequence by one token."""
+
+    def extend_logits(self, token_ids: Sequence[int]) -> List[ModelOutput]:
+        """Append ``token_ids`` and return the logits after each of them, in one pass."""
+
+    def rollback(self, num_tokens: int) -> None:
+        """Drop the last ``num_tokens`` tokens; append again before asking for logits."""
+
+    def fork(self, num_branches: int) -> BatchDecodeSession:
+        """Split into ``num_branches`` rows that share the current prefix state."""
+
+
+class BatchDecodeSession(Protocol):
+    """Stateful decoding over several sequences advanced in lockstep."""
+
+    def next_logits(self) -> List[ModelOutput]:
+        """Return next-token logits for every row in the batch."""
+
+    def append(self, token_ids: Sequence[int]) -> None:
+        """Extend every row by one token (one id per row)."""
+
+    def select(self, rows: Sequence[int]) -> None:
+        """Keep only ``rows``, in order, releasing the state of the others."""
+
+    def extend(self, other: BatchDecodeSession) -> None:
+        """Append the rows of another session of the same kind."""
+
+
 class ModelInterface(Protocol):
     """Protocol for models used by the watermarking utilities."""
 
@@ -22,8 +65,109 @@ class ModelInterface(Protocol):
     def decode(self, token_ids: Sequence[int]) -> str:
         """Decode token ids into text."""
 
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        """Encode several texts; backends with a batch tokenizer should override it."""
+
+        return [list(self.encode(text)) for text in texts]
+
     def next_logits(self, input_ids: Sequence[int]) -> ModelOutput:
         """Return logits for the next token given input ids."""
 
+    def next_logits_batch(self, batch_input_ids: Sequence[Sequence[int]]) -> List[ModelOutput]:
+        """Return next-token logits for each sequence in a batch.
+
+        The default evaluates rows one at a time; batched backends should
+        override it with a single padded forward pass.
+        """
+
+        return [self.next_logits(input_ids) for input_ids in batch_input_ids]
+
     def logprob(self, input_ids: Sequence[int], target_id: int) -> float:
         """Return log probability of target token given input ids."""
+
+    def sequence_logprobs(self, token_ids: Sequence[int]) -> List[float]:
+        """Return teacher-forced log-probs of ``token_ids[1:]``, one per position.
+
+        The default issues one ``logprob`` call per position; backends should
+        override it with a single forward pass.
+        """
+
+        return [self.logprob(token_ids[:idx], token_ids[idx]) for idx in range(1, len(token_ids))]
+
+    def sequence_logprobs_batch(self, batch_token_ids: Sequence[Sequence[int]]) -> List[List[float]]:
+        """Return ``sequence_logprobs`` for each sequence in a batch."""
+
+        return [self.sequence_logprobs(token_ids) for token_ids in batch_token_ids]
+
+    def start_session(self, input_ids: Sequence[int]) -> DecodeSession:
+        """Start an incremental decoding session primed with input ids.
+
+        The default recomputes the full prefix every step; models with a
+        cache should override it.
+        """
+
+        return RecomputeSession(self, input_ids)
+
+    def start_batch_session(self, batch_input_ids: Sequence[Sequence[int]]) -> BatchDecodeSession:
+        """Start a lockstep decoding session over several sequences."""
+
+        return RecomputeBatchSession(self, batch_input_ids)
+
+
+class RecomputeSession:
+    """DecodeSession that calls ``next_logits`` on the full sequence each step."""
+
+    def __init__(self, model: ModelInterface, input_ids: Sequence[int]) -> None:
+        self.model = model
+        self.input_ids = list(input_ids)
+
+    def next_logits(self) -> ModelOutput:
+        return self.model.next_logits(self.input_ids)
+
+    def append(self, token_id: int) -> None:
+        self.input_ids.append(token_id)
+
+    def extend_logits(self, token_ids: Sequence[int]) -> List[ModelOutput]:
+        prefixes = [self.input_ids + list(token_ids[: idx + 1]) for idx in range(len(token_ids))]
+        self.input_ids.extend(token_ids)
+        next_logits_batch = getattr(self.model, "next_logits_batch", None)
+        if next_logits_batch is None:
+            return [self.model.next_logits(prefix) for prefix in prefixes]
+        return next_logits_batch(prefixes)
+
+    def rollback(self, num_tokens: int) -> None:
+        if num_tokens > 0:
+            del self.input_ids[-num_tokens:]
+
+    def fork(self, num_branches: int) -> BatchDecodeSession:
+        return RecomputeBatchSession(self.model, [self.input_ids] * num_branches)
+
+
+class RecomputeBatchSession:
+    """BatchDecodeSession that calls ``next_logits_batch`` on full sequences."""
+
+    def __init__(self, model: ModelInterface, batch_input_ids: Sequence[Sequence[int]]) -> None:
+        self.model = model
+        self.batch_input_ids = [list(input_ids) for input_ids in batch_input_ids]
+
+    def next_logits(self) -> List[ModelOutput]:
+        if not self.batch_input_ids:
+            return []
+        next_logits_batch = getattr(self.model, "next_logits_batch", None)
+        if next_logits_batch is None:
+            return [self.model.next_logits(input_ids) for input_ids in self.batch_input_ids]
+        return next_logits_batch(self.batch_input_ids)
+
+    def append(self, token_ids: Sequence[int]) -> None:
+        if len(token_ids) != len(self.batch_input_ids):
+            raise ValueError("Expected one token id per row.")
+        for input_ids, token_id in zip(self.batch_input_ids, token_ids):
+            input_ids.append(token_id)
+
+    def select(self, rows: Sequence[int]) -> None:
+        self.batch_input_ids = [self.batch_input_ids[row] for row in rows]
+
+    def extend(self, other: BatchDecodeSession) -> None:
+        if not isinstance(other, RecomputeBatchSession):
+            raise TypeError("Can only extend with another RecomputeBatchSession.")
+        self.batch_input_ids.extend(other.batch_input_ids)
@@ -0,0 +1,211 @@
+"""Multi-process candidate generation with deterministic seeding."""
+
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+import itertools
+import multiprocessing
+import os
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from redwatermark.data import SampleMetadata, iter_candidate_groups
+from redwatermark.hf_model import HFModel
+from redwatermark.model import ModelInterface
+from redwatermark.partition import VocabPartition
+from redwatermark.pipeline import PromptOutputs, assemble_prompt_outputs
+from redwatermark.scoring import ScoreWeights
+from redwatermark.teacher import RedBiasConfig, RedBiasedTeacher
+
+CandidateGroup = Tuple[int, List[SampleMetadata]]
+
+
+@dataclass(frozen=True)
+class WorkerConfig:
+    """Placement for one worker process.
+
+    Attributes:
+        model_config: Passed to the model factory, e.g. an ``HFModelConfig``
+            whose ``device`` pins the replica to a GPU.
+        cpu_cores: If set, the worker's CPU affinity (Linux only).
+        num_threads: If set, the intra-op thread count for torch.
+    """
+
+    model_config: Any
+    cpu_cores: Optional[Tuple[int, ...]] = None
+    num_threads: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class _GenerationSettings:
+    target_red_rate: float
+    samples_per_prompt: int
+    score_weights: Optional[ScoreWeights]
+    rng_seed: int
+    batch_size: int
+    share_prefix: bool
+
+
+_WORKER: Optional[Tuple[RedBiasedTeacher, ModelInterface, _GenerationSettings]] = None
+
+
+def _init_worker(
+    placements: Any,
+    model_factory: Callable[[Any], ModelInterface],
+    red_tokens: Set[int],
+    eligible_tokens: Set[int],
+    bias_config: RedBiasConfig,
+    settings: _GenerationSettings,
+    partition: Optional[VocabPartition],
+) -> None:
+    global _WORKER
+    worker_config: WorkerConfig = placements.get()
+    if worker_config.cpu_cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, worker_config.cpu_cores)
+    if worker_config.num_threads is not None:
+        import torch
+
+        torch.set_num_threads(worker_config.num_threads)
+    model = model_factory(worker_config.model_config)
+    if partition is not None:
+        teacher = RedBiasedTeacher.from_partition(model, partition, bias_config)
+    else:
+        teacher = RedBiasedTeacher(model, red_tokens, eligible_tokens, bias_config)
+    _WORKER = (teacher, model, settings)
+
+
+def _run_chunk(start_index: int, prompts: List[str]) -> List[CandidateGroup]:
+    if _WORKER is None:
+        raise RuntimeError("Worker process was not initialized.")
+    teacher, model, settings = _WORKER
+    return list(
+        iter_candidate_groups(
+            teacher=teacher,
+            model=model,
+            prompts=prompts,
+            target_red_rate=settings.target_red_rate,
+            samples_per_prompt=settings.samples_per_prompt,
+            score_weights=settings.score_weights,
+            rng_seed=settings.rng_seed,
+            batch_size=settings.batch_size,
+            share_prefix=settings.share_prefix,
+            start_index=start_index,
+        )
+    )
+
+
+def _iter_chunks(prompts: Iterable[str], chunk_size: int, start_index: int) -> Iterator[Tuple[int, List[str]]]:
+    iterator = iter(prompts)
+    index = start_index
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield index, chunk
+        index += len(chunk)
+
+
+def iter_candidate_groups_parallel(
+    workers: Sequence[WorkerConfig],
+    red_tokens: Set[int],
+    eligible_tokens: Set[int],
+    bias_config: RedBiasConfig,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    samples_per_prompt: int = 4,
+    score_weights: Optional[ScoreWeights] = None,
+    rng_seed: int = 0,
+    batch_size: int = 8,
+    share_prefix: bool = False,
+    chunk_size: int = 16,
+    start_index: int = 0,
+    model_factory: Callable[[Any], ModelInterface] = HFModel,
+    mp_context: str = "spawn",
+    partition: Optional[VocabPartition] = None,
+) -> Iterator[CandidateGroup]:
+    """Shard prompts across worker processes and yield groups in prompt order.
+
+    Each worker builds its own model replica and teacher once. Prompts are
+    sent in contiguous chunks of ``chunk_size``; seeds depend only on
+    ``(rng_seed, prompt_index, sample_index)``, so output does not depend on
+    the number of workers. At most two chunks per worker are in flight.
+    With a file-backed ``partition``, workers map the artifact instead of
+    receiving ``red_tokens``/``eligible_tokens`` (pass empty sets).
+    """
+
+    if not workers:
+        raise ValueError("At least one worker is required.")
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive.")
+    context = multiprocessing.get_context(mp_context)
+    placements = context.Queue()
+    for worker_config in workers:
+        placements.put(worker_config)
+    settings = _GenerationSettings(
+        target_red_rate=target_red_rate,
+        samples_per_prompt=samples_per_prompt,
+        score_weights=score_weights,
+        rng_seed=rng_seed,
+        batch_size=batch_size,
+        share_prefix=share_prefix,
+    )
+    max_in_flight = 2 * len(workers)
+    with ProcessPoolExecutor(
+        max_workers=len(workers),
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(
+            placements,
+            model_factory,
+            set(red_tokens),
+            set(eligible_tokens),
+            bias_config,
+            settings,
+            partition,
+        ),
+    ) as executor:
+        pending: Deque[Future] = deque()
+        for chunk_start, chunk in _iter_chunks(prompts, chunk_size, start_index):
+            pending.append(executor.submit(_run_chunk, chunk_start, chunk))
+            if len(pending) >= max_in_flight:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def generate_candidates_parallel(
+    workers: Sequence[WorkerConfig],
+    red_tokens: Set[int],
+    eligible_tokens: Set[int],
+    bias_config: RedBiasConfig,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    **kwargs: Any,
+) -> List[SampleMetadata]:
+    """Collect ``iter_candidate_groups_parallel`` into a flat, ordered list."""
+
+    samples: List[SampleMetadata] = []
+    for _, group in iter_candidate_groups_parallel(
+        workers, red_tokens, eligible_tokens, bias_config, prompts, target_red_rate, **kwargs
+    ):
+        samples.extend(group)
+    return samples
+
+
+def iter_pipeline_parallel(
+    workers: Sequence[WorkerConfig],
+    red_tokens: Set[int],
+    eligible_tokens: Set[int],
+    bias_config: RedBiasConfig,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    best_of_n: int = 1,
+    **kwargs: Any,
+) -> Iterator[PromptOutputs]:
+    """Multi-process ``iter_pipeline``: selection and pairing run in the parent."""
+
+    groups = iter_candidate_groups_parallel(
+        workers, red_tokens, eligible_tokens, bias_config, prompts, target_red_rate, **kwargs
+    )
+    return assemble_prompt_outputs(groups, best_of_n=best_of_n)
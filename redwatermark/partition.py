@@ -0,0 +1,229 @@
+"""Persisted, memory-mapped red/eligible vocabulary partitions.
+
+An artifact holds the eligible and red sets as packed bit arrays behind a
+small JSON header. Files are named by a key hashing the tokenizer vocabulary,
+the ``EligibleTokenConfig`` and the partition seed, so every process that
+asks for the same partition maps the same bytes instead of rebuilding sets.
+"""
+
+from __future__ import annotations
+
+from dataclasses import asdict
+import hashlib
+import json
+import os
+import struct
+from typing import Any, Dict, Iterable, Optional, Sequence, Set, Tuple
+import uuid
+
+import numpy as np
+
+from redwatermark.eligibility import EligibleTokenConfig, build_eligible_token_set, build_red_blue_partition
+
+_MAGIC = b"RWVPART1"
+_HEADER_LENGTH = struct.Struct("<Q")
+_ALIGNMENT = 64
+
+
+def tokenizer_hash(vocab: Sequence[Tuple[int, str]]) -> str:
+    """Hash a ranked ``(token_id, token_str)`` vocabulary.
+
+    Order is part of the hash because eligibility keeps the top-ranked tokens.
+    """
+
+    digest = hashlib.sha256()
+    for token_id, token_str in vocab:
+        digest.update(f"{token_id}\t{token_str}\n".encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
+
+
+def partition_key(tokenizer_digest: str, config: EligibleTokenConfig, seed: int) -> str:
+    config_values = asdict(config)
+    config_values["banned_fillers"] = sorted(config_values["banned_fillers"])
+    payload = json.dumps(
+        {"tokenizer": tokenizer_digest, "config": config_values, "seed": seed},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _pack(mask: np.ndarray) -> np.ndarray:
+    return np.packbits(mask, bitorder="little")
+
+
+def _resize(mask: np.ndarray, vocab_size: int) -> np.ndarray:
+    if mask.shape[0] >= vocab_size:
+        return mask[:vocab_size]
+    return np.concatenate([mask, np.zeros(vocab_size - mask.shape[0], dtype=bool)])
+
+
+class VocabPartition:
+    """Eligible and red token sets stored as packed bit arrays.
+
+    Loaded artifacts are read-only ``np.memmap`` views, so processes share
+    the page cache. Pickling a file-backed partition sends only its path.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        eligible_bits: np.ndarray,
+        red_bits: np.ndarray,
+        key: str = "",
+        path: Optional[str] = None,
+    ) -> None:
+        num_bytes = (vocab_size + 7) // 8
+        if eligible_bits.shape != (num_bytes,) or red_bits.shape != (num_bytes,):
+            raise ValueError(f"Expected {num_bytes} packed bytes for a vocabulary of {vocab_size}.")
+        self.vocab_size = vocab_size
+        self.eligible_bits = eligible_bits
+        self.red_bits = red_bits
+        self.key = key
+        self.path = path
+
+    @classmethod
+    def from_tokens(
+        cls,
+        vocab_size: int,
+        red_tokens: Iterable[int],
+        eligible_tokens: Iterable[int],
+        key: str = "",
+    ) -> VocabPartition:
+        masks = []
+        for tokens in (eligible_tokens, red_tokens):
+            ids = np.fromiter(tokens, dtype=np.int64)
+            mask = np.zeros(vocab_size, dtype=bool)
+            mask[ids[(ids >= 0) & (ids < vocab_size)]] = True
+            masks.append(mask)
+        eligible_mask, red_mask = masks
+        return cls(vocab_size, _pack(eligible_mask), _pack(red_mask & eligible_mask), key=key)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        if self.path is not None:
+            return (load_partition, (self.path,))
+        return (VocabPartition, (self.vocab_size, np.asarray(self.eligible_bits), np.asarray(self.red_bits), self.key))
+
+    def eligible_mask(self, vocab_size: Optional[int] = None) -> np.ndarray:
+        """Unpack to a boolean mask, padded or cut to ``vocab_size`` if given."""
+
+        mask = np.unpackbits(self.eligible_bits, count=self.vocab_size, bitorder="little").view(bool)
+        return mask if vocab_size is None else _resize(mask, vocab_size)
+
+    def red_mask(self, vocab_size: Optional[int] = None) -> np.ndarray:
+        mask = np.unpackbits(self.red_bits, count=self.vocab_size, bitorder="little").view(bool)
+        return mask if vocab_size is None else _resize(mask, vocab_size)
+
+    def eligible_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.eligible_mask())
+
+    def red_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.red_mask())
+
+    def eligible_tokens(self) -> Set[int]:
+        return set(self.eligible_ids().tolist())
+
+    def red_tokens(self) -> Set[int]:
+        return set(self.red_ids().tolist())
+
+    def _lookup(self, bits: np.ndarray, token_ids: Iterable[int]) -> np.ndarray:
+        ids = np.fromiter(token_ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < self.vocab_size)
+        ids = np.where(valid, ids, 0)
+        return valid & ((bits[ids >> 3] >> (ids & 7)) & 1).astype(bool)
+
+    def is_eligible(self, token_ids: Iterable[int]) -> np.ndarray:
+        """Per-id membership, read straight from the packed bits."""
+
+        return self._lookup(self.eligible_bits, token_ids)
+
+    def is_red(self, token_ids: Iterable[int]) -> np.ndarray:
+        return self._lookup(self.red_bits, token_ids)
+
+    def red_rate(self, token_ids: Iterable[int]) -> float:
+        """Same value as ``watermark_sampler.red_rate`` with this partition's sets."""
+
+        ids = list(token_ids)
+        eligible = int(self.is_eligible(ids).sum())
+        return int(self.is_red(ids).sum()) / eligible if eligible else 0.0
+
+    def save(self, path: str) -> None:
+        """Write the artifact atomically (temp file + rename)."""
+
+        header = json.dumps(
+            {
+                "vocab_size": self.vocab_size,
+                "key": self.key,
+                "num_eligible": int(self.eligible_mask().sum()),
+                "num_red": int(self.red_mask().sum()),
+            },
+            sort_keys=True,
+        ).encode("utf-8")
+        prefix = len(_MAGIC) + _HEADER_LENGTH.size + len(header)
+        padding = -prefix % _ALIGNMENT
+        # A unique temp file per writer, so concurrent builders never share one.
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as handle:
+                handle.write(_MAGIC)
+                handle.write(_HEADER_LENGTH.pack(len(header) + padding))
+                handle.write(header + b" " * padding)
+                handle.write(np.asarray(self.eligible_bits, dtype=np.uint8).tobytes())
+                handle.write(np.asarray(self.red_bits, dtype=np.uint8).tobytes())
+                handle.flush()
+                os.fsync(handle.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+def read_partition_header(path: str) -> Tuple[Dict[str, Any], int]:
+    """Return the JSON header of an artifact and the offset of its bit arrays."""
+
+    with open(path, "rb") as handle:
+        if handle.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not a vocabulary partition artifact.")
+        (length,) = _HEADER_LENGTH.unpack(handle.read(_HEADER_LENGTH.size))
+        header = json.loads(handle.read(length).decode("utf-8"))
+    return header, len(_MAGIC) + _HEADER_LENGTH.size + length
+
+
+def load_partition(path: str) -> VocabPartition:
+    """Memory-map an artifact written by ``VocabPartition.save``."""
+
+    header, offset = read_partition_header(path)
+    vocab_size = header["vocab_size"]
+    num_bytes = (vocab_size + 7) // 8
+    bits = np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=(2 * num_bytes,))
+    return VocabPartition(vocab_size, bits[:num_bytes], bits[num_bytes:], key=header["key"], path=path)
+
+
+def build_vocab_partition(
+    vocab: Sequence[Tuple[int, str]],
+    config: EligibleTokenConfig,
+    seed: int = 0,
+) -> VocabPartition:
+    """Build the partition that ``build_eligible_token_set`` + ``build_red_blue_partition`` give."""
+
+    eligible = build_eligible_token_set(vocab, config)
+    red, _ = build_red_blue_partition(eligible, seed=seed)
+    vocab_size = max((token_id for token_id, _ in vocab), default=-1) + 1
+    key = partition_key(tokenizer_hash(vocab), config, seed)
+    return VocabPartition.from_tokens(vocab_size, red, eligible, key=key)
+
+
+def load_or_build_partition(
+    cache_dir: str,
+    vocab: Sequence[Tuple[int, str]],
+    config: EligibleTokenConfig,
+    seed: int = 0,
+) -> VocabPartition:
+    """Map the cached artifact for this vocabulary/config/seed, building it on a miss."""
+
+    key = partition_key(tokenizer_hash(vocab), config, seed)
+    path = os.path.join(cache_dir, f"{key}.vpart")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_vocab_partition(vocab, config, seed).save(path)
+    return load_partition(path)
@@ -2,13 +2,18 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Iterable, List, Optional
+from dataclasses import asdict, dataclass
+import itertools
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from redwatermark.data import SampleMetadata, generate_candidates, select_best_of_n
+from redwatermark import metrics
+from redwatermark.cache import GenerationCache, cache_namespace
+from redwatermark.data import SampleMetadata, generate_candidates, iter_candidate_groups, select_best_of_n
 from redwatermark.model import ModelInterface
 from redwatermark.scoring import ScoreWeights
-from redwatermark.teacher import RedBiasedTeacher
+from redwatermark.storage import ShardedJSONLWriter, ShardManifest
+from redwatermark.teacher import EarlyRejectionConfig, RedBiasedTeacher
 from redwatermark.training import DPOPair, SFTExample, build_dpo_pairs, build_sft_dataset
 
 
@@ -19,6 +24,15 @@ class PipelineOutputs:
     dpo_pairs: List[DPOPair]
 
 
+@dataclass(frozen=True)
+class PromptOutputs:
+    prompt_index: int
+    candidates: List[SampleMetadata]
+    selected: List[SampleMetadata]
+    sft_examples: List[SFTExample]
+    dpo_pairs: List[DPOPair]
+
+
 def run_pipeline(
     teacher: RedBiasedTeacher,
     model: ModelInterface,
@@ -27,16 +41,158 @@ def run_pipeline(
     samples_per_prompt: int = 4,
     best_of_n: int = 1,
     score_weights: Optional[ScoreWeights] = None,
+    batch_size: int = 8,
+    on_device: bool = False,
+    share_prefix: bool = False,
+    rejection: Optional[EarlyRejectionConfig] = None,
+    accept_score: Optional[float] = None,
+    cache: Optional[GenerationCache] = None,
 ) -> PipelineOutputs:
-    samples = generate_candidates(
+    with metrics.stage("pipeline.run_pipeline"):
+        samples = generate_candidates(
+            teacher=teacher,
+            model=model,
+            prompts=prompts,
+            target_red_rate=target_red_rate,
+            samples_per_prompt=samples_per_prompt,
+            score_weights=score_weights,
+            batch_size=batch_size,
+            on_device=on_device,
+            share_prefix=share_prefix,
+            rejection=rejection,
+            accept_score=accept_score,
+            cache=cache,
+        )
+        selected = select_best_of_n(samples, n=best_of_n)
+        sft_dataset = build_sft_dataset(selected)
+        dpo_pairs = build_dpo_pairs(samples)
+    return PipelineOutputs(samples=selected, sft_dataset=sft_dataset, dpo_pairs=dpo_pairs)
+
+
+def iter_pipeline(
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    samples_per_prompt: int = 4,
+    best_of_n: int = 1,
+    score_weights: Optional[ScoreWeights] = None,
+    rng_seed: int = 0,
+    batch_size: int = 8,
+    on_device: bool = False,
+    share_prefix: bool = False,
+    start_index: int = 0,
+    rejection: Optional[EarlyRejectionConfig] = None,
+    accept_score: Optional[float] = None,
+    cache: Optional[GenerationCache] = None,
+) -> Iterator[PromptOutputs]:
+    """Streaming ``run_pipeline``: selection and pairing happen per prompt as it completes."""
+
+    groups = iter_candidate_groups(
         teacher=teacher,
         model=model,
         prompts=prompts,
         target_red_rate=target_red_rate,
         samples_per_prompt=samples_per_prompt,
         score_weights=score_weights,
+        rng_seed=rng_seed,
+        batch_size=batch_size,
+        on_device=on_device,
+        share_prefix=share_prefix,
+        start_index=start_index,
+        rejection=rejection,
+        accept_score=accept_score,
+        cache=cache,
     )
-    selected = select_best_of_n(samples, n=best_of_n)
-    sft_dataset = build_sft_dataset(selected)
-    dpo_pairs = build_dpo_pairs(samples)
-    return PipelineOutputs(samples=selected, sft_dataset=sft_dataset, dpo_pairs=dpo_pairs)
+    return assemble_prompt_outputs(groups, best_of_n=best_of_n)
+
+
+def assemble_prompt_outputs(
+    groups: Iterable[Tuple[int, List[SampleMetadata]]],
+    best_of_n: int = 1,
+) -> Iterator[PromptOutputs]:
+    """Turn ``(prompt_index, candidates)`` groups into per-prompt pipeline outputs."""
+
+    for prompt_index, candidates in groups:
+        selected = select_best_of_n(candidates, n=best_of_n)
+        yield PromptOutputs(
+            prompt_index=prompt_index,
+            candidates=candidates,
+            selected=selected,
+            sft_examples=build_sft_dataset(selected),
+            dpo_pairs=build_dpo_pairs(candidates),
+        )
+
+
+def run_fingerprint(
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    score_weights: Optional[ScoreWeights] = None,
+) -> Dict[str, Any]:
+    """Settings besides the call arguments that decide what a sharded run writes.
+
+    Covers the teacher's ``RedBiasConfig``, the score weights and a hash of
+    the teacher and base models, tokenizer and partition. The result is
+    JSON-normalized so it compares equal to a reloaded manifest.
+    """
+
+    payload = {
+        "teacher_config": asdict(teacher.config),
+        "score_weights": asdict(score_weights or ScoreWeights()),
+        "models": cache_namespace(teacher, model),
+    }
+    return json.loads(json.dumps(payload, sort_keys=True))
+
+
+def run_pipeline_sharded(
+    teacher: RedBiasedTeacher,
+    model: ModelInterface,
+    prompts: Iterable[str],
+    target_red_rate: float,
+    output_dir: str,
+    shard_size: int = 1000,
+    samples_per_prompt: int = 4,
+    best_of_n: int = 1,
+    score_weights: Optional[ScoreWeights] = None,
+    rng_seed: int = 0,
+    batch_size: int = 8,
+    on_device: bool = False,
+    share_prefix: bool = False,
+    cache: Optional[GenerationCache] = None,
+    start_index: int = 0,
+) -> ShardManifest:
+    """Run the pipeline into sharded JSONL files under ``output_dir``.
+
+    Prompts already covered by the directory's manifest are skipped, so
+    rerunning with the same prompt stream resumes after a crash. Resuming
+    with a different teacher config, partition, models or score weights
+    (see ``run_fingerprint``) raises instead of mixing outputs.
+    ``start_index`` is the global index of the stream's first prompt.
+    """
+
+    params = {
+        "target_red_rate": target_red_rate,
+        "samples_per_prompt": samples_per_prompt,
+        "best_of_n": best_of_n,
+        "rng_seed": rng_seed,
+        **run_fingerprint(teacher, model, score_weights),
+    }
+    with ShardedJSONLWriter(output_dir, params=params, shard_size=shard_size, start_prompt=start_index) as writer:
+        resume_index = writer.resume_index
+        for outputs in iter_pipeline(
+            teacher=teacher,
+            model=model,
+            prompts=itertools.islice(prompts, resume_index - start_index, None),
+            target_red_rate=target_red_rate,
+            samples_per_prompt=samples_per_prompt,
+            best_of_n=best_of_n,
+            score_weights=score_weights,
+            rng_seed=rng_seed,
+            batch_size=batch_size,
+            on_device=on_device,
+            share_prefix=share_prefix,
+            start_index=resume_index,
+            cache=cache,
+        ):
+            writer.write(outputs.prompt_index, outputs.candidates, outputs.sft_examples, outputs.dpo_pairs)
+        return writer.manifest
@@ -1,9 +1,19 @@
-"""Loss utilities for red-mass regularization."""
+"""Loss utilities for red-mass regularization.
+
+The list functions score a single position. The ``*_batch`` functions are
+autograd-compatible torch versions over ``[batch, seq, vocab]`` logits for
+the ``L = L_CE + L_red + beta * KL`` training loss. With ``chunk_size``
+they work through the sequence a chunk at a time, so peak memory does not
+grow with sequence length.
+"""
 
 from __future__ import annotations
 
 import math
-from typing import Iterable, Sequence
+from typing import Callable, Iterable, Optional, Sequence
+
+import torch
+from torch.utils.checkpoint import checkpoint
 
 
 def red_mass(probs: Sequence[float], red_tokens: Iterable[int]) -> float:
@@ -24,3 +34,191 @@ def kl_divergence(p: Sequence[float], q: Sequence[float], epsilon: float = 1e-8)
     for p_i, q_i in zip(p, q):
         total += p_i * (math.log(p_i + epsilon) - math.log(q_i + epsilon))
     return total
+
+
+def _chunked(
+    fn: Callable[..., torch.Tensor],
+    tensors: Sequence[Optional[torch.Tensor]],
+    chunk_size: Optional[int],
+) -> torch.Tensor:
+    """Apply ``fn`` to ``[batch, chunk, ...]`` slices of ``tensors`` along the sequence axis.
+
+    When gradients are needed each chunk is checkpointed, so backward
+    recomputes one chunk's vocabulary-sized intermediates at a time instead
+    of keeping all of them alive.
+    """
+
+    seq_len = next(tensor for tensor in tensors if tensor is not None).shape[1]
+    if chunk_size is None or chunk_size >= seq_len:
+        return fn(*tensors)
+    needs_grad = torch.is_grad_enabled() and any(tensor is not None and tensor.requires_grad for tensor in tensors)
+    outputs = []
+    for start in range(0, seq_len, chunk_size):
+        chunk = [None if tensor is None else tensor[:, start : start + chunk_size] for tensor in tensors]
+        if needs_grad:
+            outputs.append(checkpoint(fn, *chunk, use_reentrant=False))
+        else:
+            outputs.append(fn(*chunk))
+    return torch.cat(outputs, dim=1)
+
+
+def _reduce(values: torch.Tensor, mask: Optional[torch.Tensor], reduction: str) -> torch.Tensor:
+    if mask is not None:
+        values = torch.where(mask, values, torch.zeros_like(values))
+    if reduction == "none":
+        return values
+    if reduction == "sum":
+        return values.sum()
+    if reduction == "mean":
+        count = values.numel() if mask is None else mask.sum()
+        return values.sum() / torch.clamp(torch.as_tensor(count, dtype=values.dtype, device=values.device), min=1)
+    raise ValueError(f"Unknown reduction: {reduction}")
+
+
+def _combine_masks(*masks: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    combined = None
+    for mask in masks:
+        if mask is not None:
+            mask = mask.bool()
+            combined = mask if combined is None else combined & mask
+    return combined
+
+
+def red_ids_tensor(
+    red_tokens: Iterable[int],
+    eligible_tokens: Optional[Iterable[int]] = None,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """Sorted ids of eligible red tokens, for the batched functions below."""
+
+    ids = set(red_tokens)
+    if eligible_tokens is not None:
+        ids &= set(eligible_tokens)
+    return torch.tensor(sorted(ids), dtype=torch.long, device=device)
+
+
+def red_log_mass_batch(logits: torch.Tensor, red_ids: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    """``log sum_{v in red} softmax(logits)_v`` per position of ``[batch, seq, vocab]`` logits.
+
+    Computed as a difference of two log-sum-exps, so the probabilities are
+    never materialized and tiny red masses keep full precision.
+    """
+
+    def log_mass(chunk: torch.Tensor) -> torch.Tensor:
+        chunk = chunk.float()
+        return chunk.index_select(-1, red_ids).logsumexp(dim=-1) - chunk.logsumexp(dim=-1)
+
+    return _chunked(log_mass, [logits], chunk_size)
+
+
+def red_mass_batch(logits: torch.Tensor, red_ids: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    """Batched ``red_mass`` from logits: ``[batch, seq]`` red probability mass."""
+
+    return red_log_mass_batch(logits, red_ids, chunk_size).exp()
+
+
+def entropy_batch(logits: torch.Tensor, chunk_size: Optional[int] = None) -> torch.Tensor:
+    """Per-position entropy ``-sum_v p_v * log p_v`` of ``[batch, seq, vocab]`` logits.
+
+    Works from the log-softmax; ``-inf`` logits (masked tokens) contribute zero.
+    """
+
+    def entropy(chunk: torch.Tensor) -> torch.Tensor:
+        log_probs = torch.log_softmax(chunk.float(), dim=-1)
+        finite_log_probs = log_probs.masked_fill(torch.isneginf(log_probs), 0.0)
+        return -(log_probs.exp() * finite_log_probs).sum(dim=-1)
+
+    return _chunked(entropy, [logits], chunk_size)
+
+
+def red_regularizer_batch(
+    logits: torch.Tensor,
+    red_ids: torch.Tensor,
+    position_mask: Optional[torch.Tensor] = None,
+    entropy_threshold: Optional[float] = None,
+    entropy_logits: Optional[torch.Tensor] = None,
+    epsilon: float = 1e-8,
+    chunk_size: Optional[int] = None,
+    reduction: str = "mean",
+) -> torch.Tensor:
+    """Batched ``red_regularizer``: ``-log(m_t + epsilon)`` over ``[batch, seq]`` positions.
+
+    Args:
+        logits: ``[batch, seq, vocab]`` model logits.
+        red_ids: Eligible red token ids (see ``red_ids_tensor``).
+        position_mask: ``[batch, seq]`` positions to include (e.g. completion tokens).
+        entropy_threshold: If set, only positions whose entropy reaches it count.
+        entropy_logits: Logits the entropy gate is computed from (e.g. the base
+            model's); defaults to ``logits``. The gate is not differentiated.
+        reduction: ``"mean"`` over included positions, ``"sum"`` or ``"none"``.
+    """
+
+    log_epsilon = torch.tensor(epsilon, device=logits.device).log()
+    loss = -torch.logaddexp(red_log_mass_batch(logits, red_ids, chunk_size), log_epsilon)
+    gate = None
+    if entropy_threshold is not None:
+        with torch.no_grad():
+            source = logits if entropy_logits is None else entropy_logits
+            gate = entropy_batch(source.detach(), chunk_size) >= entropy_threshold
+    return _reduce(loss, _combine_masks(position_mask, gate), reduction)
+
+
+def kl_divergence_batch(
+    logits_p: torch.Tensor,
+    logits_q: torch.Tensor,
+    position_mask: Optional[torch.Tensor] = None,
+    chunk_size: Optional[int] = None,
+    reduction: str = "mean",
+) -> torch.Tensor:
+    """Batched ``kl_divergence``: ``KL(softmax(logits_p) || softmax(logits_q))`` per position.
+
+    Works in log space from both log-softmaxes, so it needs no epsilon.
+    """
+
+    def kl(chunk_p: torch.Tensor, chunk_q: torch.Tensor) -> torch.Tensor:
+        log_p = torch.log_softmax(chunk_p.float(), dim=-1)
+        log_q = torch.log_softmax(chunk_q.float(), dim=-1)
+        return torch.nn.functional.kl_div(log_q, log_p, reduction="none", log_target=True).sum(dim=-1)
+
+    return _reduce(_chunked(kl, [logits_p, logits_q], chunk_size), position_mask, reduction)
+
+
+def red_kl_loss(
+    logits: torch.Tensor,
+    labels: torch.Tensor,
+    base_logits: torch.Tensor,
+    red_ids: torch.Tensor,
+    red_weight: float = 1.0,
+    beta: float = 0.1,
+    entropy_threshold: Optional[float] = None,
+    ignore_index: int = -100,
+    epsilon: float = 1e-8,
+    chunk_size: Optional[int] = None,
+) -> torch.Tensor:
+    """``L = L_CE + red_weight * L_red + beta * KL(p_theta || p_base)`` for a batch.
+
+    ``logits`` and ``base_logits`` are ``[batch, seq, vocab]`` and already
+    aligned with ``labels`` (position ``t`` predicts ``labels[:, t]``);
+    positions labelled ``ignore_index`` are excluded from all three terms.
+    The red term is gated on the base model's entropy.
+    """
+
+    position_mask = labels != ignore_index
+
+    def cross_entropy(chunk: torch.Tensor, chunk_labels: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.cross_entropy(
+            chunk.float().transpose(1, 2), chunk_labels, ignore_index=ignore_index, reduction="none"
+        )
+
+    ce = _reduce(_chunked(cross_entropy, [logits, labels], chunk_size), position_mask, "mean")
+    red = red_regularizer_batch(
+        logits,
+        red_ids,
+        position_mask=position_mask,
+        entropy_threshold=entropy_threshold,
+        entropy_logits=base_logits,
+        epsilon=epsilon,
+        chunk_size=chunk_size,
+    )
+    kl = kl_divergence_batch(logits, base_logits.detach(), position_mask=position_mask, chunk_size=chunk_size)
+    return ce + red_weight * red + beta * kl
@@ -1,11 +1,17 @@
-"""Reward helpers for KL-constrained RL fine-tuning."""
+"""Reward helpers and rollout collection for KL-constrained RL fine-tuning."""
 
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Dict, Iterable, Optional, Sequence
 
-from redwatermark.filters import OddityFlags, oddity_score
+import numpy as np
+
+from redwatermark.data import compute_token_logprobs, iter_jobs
+from redwatermark.detection import RedRateDetector
+from redwatermark.filters import OddityFlags, detect_oddities_batch, oddity_counts, oddity_score
+from redwatermark.model import ModelInterface
+from redwatermark.teacher import RedBiasedTeacher
 
 
 @dataclass(frozen=True)
@@ -29,3 +35,219 @@ def compute_episode_reward(
     oddities: OddityFlags,
 ) -> float:
     return reward(red_rate_value, target_red_rate, oddities, RewardWeights())
+
+
+def reward_batch(
+    red_rates: np.ndarray,
+    target_red_rate: float,
+    oddity_bits: np.ndarray,
+    weights: RewardWeights,
+) -> np.ndarray:
+    """Vectorized ``reward`` over red rates and packed oddity flag bytes."""
+
+    distance = np.abs(np.asarray(red_rates, dtype=np.float64) - target_red_rate)
+    return -weights.red_rate_weight * distance - weights.oddity_weight * oddity_counts(oddity_bits)
+
+
+class RolloutBuffer:
+    """Preallocated arrays holding up to ``capacity`` rollouts for a PPO update.
+
+    Prompts are stored left-padded in ``prompt_ids`` and completions
+    right-padded in ``token_ids``, so ``[prompt_ids | token_ids]`` rows line
+    up at the prompt/completion boundary. Per-token arrays are valid where
+    ``mask`` is set.
+    """
+
+    def __init__(self, capacity: int, max_tokens: int, max_prompt_tokens: int) -> None:
+        if capacity <= 0:
+            raise ValueError("capacity must be positive.")
+        self.capacity = capacity
+        self.max_tokens = max_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.prompt_ids = np.zeros((capacity, max_prompt_tokens), dtype=np.int64)
+        self.prompt_lengths = np.zeros(capacity, dtype=np.int64)
+        self.token_ids = np.zeros((capacity, max_tokens), dtype=np.int64)
+        self.mask = np.zeros((capacity, max_tokens), dtype=bool)
+        self.policy_logprobs = np.zeros((capacity, max_tokens), dtype=np.float32)
+        self.base_logprobs = np.zeros((capacity, max_tokens), dtype=np.float32)
+        self.kl = np.zeros((capacity, max_tokens), dtype=np.float32)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.prompt_index = np.zeros(capacity, dtype=np.int64)
+        self.red_rates = np.zeros(capacity, dtype=np.float32)
+        self.oddity_bits = np.zeros(capacity, dtype=np.uint8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.size
+
+    def clear(self) -> None:
+        """Forget all rollouts; the arrays are reused, not reallocated."""
+
+        self.prompt_ids[: self.size] = 0
+        self.token_ids[: self.size] = 0
+        self.mask[: self.size] = False
+        self.policy_logprobs[: self.size] = 0.0
+        self.base_logprobs[: self.size] = 0.0
+        self.kl[: self.size] = 0.0
+        self.size = 0
+
+    def add_batch(
+        self,
+        prompt_index: Sequence[int],
+        prompt_ids: Sequence[Sequence[int]],
+        completions: Sequence[Sequence[int]],
+        policy_logprobs: Sequence[Sequence[float]],
+        base_logprobs: Sequence[Sequence[float]],
+        red_rates: np.ndarray,
+        oddity_bits: np.ndarray,
+        rewards: np.ndarray,
+    ) -> slice:
+        """Copy a batch of rollouts in and return the rows they occupy."""
+
+        count = len(completions)
+        if count > self.free:
+            raise ValueError(f"Buffer has room for {self.free} rollouts, got {count}.")
+        rows = slice(self.size, self.size + count)
+        for offset, (prompt, completion, policy, base) in enumerate(
+            zip(prompt_ids, completions, policy_logprobs, base_logprobs)
+        ):
+            row = self.size + offset
+            if len(completion) > self.max_tokens or len(prompt) > self.max_prompt_tokens:
+                raise ValueError("Rollout is longer than the buffer's max_tokens/max_prompt_tokens.")
+            length = len(completion)
+            self.prompt_ids[row, self.max_prompt_tokens - len(prompt) :] = prompt
+            self.prompt_lengths[row] = len(prompt)
+            self.token_ids[row, :length] = completion
+            self.mask[row, :length] = True
+            self.policy_logprobs[row, :length] = policy
+            self.base_logprobs[row, :length] = base
+            self.lengths[row] = length
+        self.kl[rows] = np.where(self.mask[rows], self.policy_logprobs[rows] - self.base_logprobs[rows], 0.0)
+        self.prompt_index[rows] = prompt_index
+        self.red_rates[rows] = red_rates
+        self.oddity_bits[rows] = oddity_bits
+        self.rewards[rows] = rewards
+        self.size += count
+        return rows
+
+    def token_rewards(self, kl_coef: float) -> np.ndarray:
+        """Per-token PPO rewards: ``-kl_coef * kl`` everywhere plus the sequence reward on the last token."""
+
+        size = self.size
+        rewards = -kl_coef * self.kl[:size]
+        last = self.lengths[:size] - 1
+        has_tokens = last >= 0
+        rewards[np.flatnonzero(has_tokens), last[has_tokens]] += self.rewards[:size][has_tokens]
+        return rewards
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Views of the filled rows of every array."""
+
+        size = self.size
+        return {
+            "prompt_ids": self.prompt_ids[:size],
+            "prompt_lengths": self.prompt_lengths[:size],
+            "token_ids": self.token_ids[:size],
+            "mask": self.mask[:size],
+            "policy_logprobs": self.policy_logprobs[:size],
+            "base_logprobs": self.base_logprobs[:size],
+            "kl": self.kl[:size],
+            "lengths": self.lengths[:size],
+            "prompt_index": self.prompt_index[:size],
+            "red_rates": self.red_rates[:size],
+            "oddity_bits": self.oddity_bits[:size],
+            "rewards": self.rewards[:size],
+        }
+
+
+class RolloutCollector:
+    """Sample rollouts with a teacher and score them for KL-constrained PPO.
+
+    Each batch is generated in lockstep by ``teacher``. The finished
+    sequences are then scored by the policy model and by the base model in
+    one teacher-forced batched pass each. ``policy_logprobs`` come from
+    ``policy`` (default ``teacher.model``) without the red bias. For on-policy
+    PPO, give the teacher ``delta=0.0`` so they are the sampling log-probs.
+    """
+
+    def __init__(
+        self,
+        teacher: RedBiasedTeacher,
+        base_model: ModelInterface,
+        target_red_rate: float,
+        weights: Optional[RewardWeights] = None,
+        policy: Optional[ModelInterface] = None,
+    ) -> None:
+        self.teacher = teacher
+        self.base_model = base_model
+        self.policy = policy or teacher.model
+        self.target_red_rate = target_red_rate
+        self.weights = weights or RewardWeights()
+        if teacher.partition is not None:
+            self.detector = RedRateDetector.from_partition(teacher.partition)
+        else:
+            self.detector = RedRateDetector(teacher.red_tokens, teacher.eligible_tokens)
+
+    def collect(
+        self,
+        prompts: Iterable[str],
+        buffer: RolloutBuffer,
+        samples_per_prompt: int = 1,
+        rng_seed: int = 0,
+        start_index: int = 0,
+        batch_size: int = 8,
+    ) -> slice:
+        """Generate, score and store rollouts; return the buffer rows filled.
+
+        Sample ``j`` of prompt ``i`` uses ``derive_sample_seed(rng_seed, i, j)``.
+        Raises before generating anything if the buffer cannot hold every rollout.
+        Red rates behind the rewards count prompt and completion tokens, like
+        candidate scoring in ``generate_candidates``.
+        """
+
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive.")
+        start = buffer.size
+        jobs = list(iter_jobs(prompts, samples_per_prompt, rng_seed, start_index))
+        if len(jobs) > buffer.free:
+            raise ValueError(f"Buffer has room for {buffer.free} rollouts, got {len(jobs)}.")
+        for offset in range(0, len(jobs), batch_size):
+            batch = jobs[offset : offset + batch_size]
+            results = self.teacher.generate_results([job[1] for job in batch], [job[2] for job in batch])
+            if any(result.prompt_length == 0 for result in results):
+                raise ValueError("Rollouts need a non-empty prompt to score their first completion token.")
+            sequences = [result.token_ids for result in results]
+            completions = [result.token_ids[result.prompt_length :] for result in results]
+            # Log-probs cover token_ids[1:], so the completion's start at prompt_length - 1.
+            policy = [
+                row[result.prompt_length - 1 :]
+                for row, result in zip(compute_token_logprobs(self.policy, sequences), results)
+            ]
+            base = [
+                row[result.prompt_length - 1 :]
+                for row, result in zip(compute_token_logprobs(self.base_model, sequences), results)
+            ]
+            for completion, policy_row, base_row in zip(completions, policy, base):
+                if len(policy_row) != len(completion) or len(base_row) != len(completion):
+                    raise ValueError("Scored log-probs do not line up with the completion tokens.")
+            # Count prompt + completion, as ``summarize_red_rate`` does when scoring candidates.
+            _, eligible, red = self.detector.counts(sequences)
+            red_rates = np.divide(red, eligible, out=np.zeros(len(red)), where=eligible > 0)
+            oddity_bits = detect_oddities_batch([self.teacher.model.decode(completion) for completion in completions])
+            rewards = reward_batch(red_rates, self.target_red_rate, oddity_bits, self.weights)
+            buffer.add_batch(
+                [job[0] for job in batch],
+                [result.token_ids[: result.prompt_length] for result in results],
+                completions,
+                policy,
+                base,
+                red_rates,
+                oddity_bits,
+                rewards,
+            )
+        return slice(start, buffer.size)
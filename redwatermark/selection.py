@@ -0,0 +1,216 @@
+"""Streaming best-of-n selection and DPO pair mining in bounded memory.
+
+Only what the results can still use is kept per prompt: the ``n`` best
+candidates, the ``max_pairs`` best clean candidates and the ``max_pairs``
+worst odd ones. When prompts arrive interleaved and too many are open at
+once, those retained candidates are spilled to on-disk buckets by prompt
+hash and regrouped one bucket at a time at the end.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import heapq
+import os
+import pickle
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import zlib
+
+from redwatermark.data import SampleMetadata
+from redwatermark.filters import any_oddities
+from redwatermark.training import DPOPair, mine_dpo_pairs
+
+
+@dataclass(frozen=True)
+class PromptSelection:
+    prompt: str
+    selected: List[SampleMetadata]
+    dpo_pairs: List[DPOPair]
+
+
+# Heap entries are (key, seq, sample); each heap is a min-heap on key, so its
+# root is the entry to evict first. seq is the input position and breaks
+# ties the way a stable sort over the input would.
+_Entry = Tuple[Tuple[float, int], int, SampleMetadata]
+
+
+def _push(heap: List[_Entry], limit: int, entry: _Entry) -> None:
+    if limit <= 0:
+        return
+    if len(heap) < limit:
+        heapq.heappush(heap, entry)
+    elif entry[0] > heap[0][0]:
+        heapq.heapreplace(heap, entry)
+
+
+class _PromptState:
+    """Bounded per-prompt heaps for best-of-n and pair mining."""
+
+    __slots__ = ("prompt", "first_seen", "best", "chosen", "rejected")
+
+    def __init__(self, prompt: str, first_seen: int) -> None:
+        self.prompt = prompt
+        self.first_seen = first_seen
+        self.best: List[_Entry] = []
+        self.chosen: List[_Entry] = []
+        self.rejected: List[_Entry] = []
+
+    def add(self, sample: SampleMetadata, seq: int, n: int, max_pairs: int) -> None:
+        # Higher score wins; on ties the earlier sample.
+        _push(self.best, n, ((sample.score, -seq), seq, sample))
+        if any_oddities(sample.oddities):
+            # Lower score wins; on ties the later sample (as ``build_dpo_pairs`` orders them).
+            _push(self.rejected, max_pairs, ((-sample.score, seq), seq, sample))
+        else:
+            _push(self.chosen, max_pairs, ((sample.score, -seq), seq, sample))
+
+    def retained(self) -> Iterator[Tuple[int, SampleMetadata]]:
+        """Every kept ``(seq, sample)``, once each."""
+
+        seen = set()
+        for heap in (self.best, self.chosen, self.rejected):
+            for _, seq, sample in heap:
+                if seq not in seen:
+                    seen.add(seq)
+                    yield seq, sample
+
+    def result(self, max_pairs: int) -> PromptSelection:
+        def ordered(heap: List[_Entry]) -> List[SampleMetadata]:
+            return [sample for _, _, sample in sorted(heap, key=lambda entry: entry[0], reverse=True)]
+
+        pairs = mine_dpo_pairs(self.prompt, ordered(self.chosen), ordered(self.rejected), max_pairs)
+        return PromptSelection(prompt=self.prompt, selected=ordered(self.best), dpo_pairs=pairs)
+
+
+class StreamingSelector:
+    """Best-of-n selection and distinct DPO pair mining over a candidate stream.
+
+    Matches ``select_best_of_n`` + ``build_dpo_pairs`` (grouping by prompt
+    text) without holding every candidate. At most ``max_open_prompts``
+    prompts are kept in memory; beyond that the open prompts' retained
+    candidates are spilled to ``num_buckets`` files under ``spill_dir``
+    (a temporary directory by default).
+
+    Results come out from ``finish``. Without spilling they are in
+    first-seen prompt order; after spilling, bucket by bucket and first-seen
+    order within a bucket.
+    """
+
+    def __init__(
+        self,
+        n: int = 1,
+        max_pairs_per_prompt: int = 1,
+        max_open_prompts: int = 10_000,
+        num_buckets: int = 64,
+        spill_dir: Optional[str] = None,
+    ) -> None:
+        if n <= 0 or max_open_prompts <= 0 or num_buckets <= 0:
+            raise ValueError("n, max_open_prompts and num_buckets must be positive.")
+        self.n = n
+        self.max_pairs = max_pairs_per_prompt
+        self.max_open_prompts = max_open_prompts
+        self.num_buckets = num_buckets
+        self.spill_dir = spill_dir
+        self._open: Dict[str, _PromptState] = {}
+        self._seq = 0
+        self._spill: Optional[tempfile.TemporaryDirectory] = None
+        self.spilled_candidates = 0
+
+    def add(self, sample: SampleMetadata) -> None:
+        state = self._open.get(sample.prompt)
+        if state is None:
+            if len(self._open) >= self.max_open_prompts:
+                self._spill_open()
+            state = self._open[sample.prompt] = _PromptState(sample.prompt, self._seq)
+        state.add(sample, self._seq, self.n, self.max_pairs)
+        self._seq += 1
+
+    def add_many(self, samples: Iterable[SampleMetadata]) -> None:
+        for sample in samples:
+            self.add(sample)
+
+    def _bucket_path(self, bucket: int) -> str:
+        assert self._spill is not None
+        return os.path.join(self._spill.name, f"bucket-{bucket:05d}.pkl")
+
+    def _spill_open(self) -> None:
+        if self._spill is None:
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._spill = tempfile.TemporaryDirectory(prefix="selection-", dir=self.spill_dir)
+        handles: Dict[int, Any] = {}
+        try:
+            for prompt, state in self._open.items():
+                bucket = zlib.crc32(prompt.encode("utf-8")) % self.num_buckets
+                handle = handles.get(bucket)
+                if handle is None:
+                    handle = handles[bucket] = open(self._bucket_path(bucket), "ab")
+                for seq, sample in state.retained():
+                    pickle.dump((state.first_seen, seq, sample), handle, protocol=pickle.HIGHEST_PROTOCOL)
+                    self.spilled_candidates += 1
+        finally:
+            for handle in handles.values():
+                handle.close()
+        self._open.clear()
+
+    def _iter_bucket(self, bucket: int) -> Iterator[PromptSelection]:
+        path = self._bucket_path(bucket)
+        if not os.path.exists(path):
+            return
+        states: Dict[str, _PromptState] = {}
+        with open(path, "rb") as handle:
+            while True:
+                try:
+                    first_seen, seq, sample = pickle.load(handle)
+                except EOFError:
+                    break
+                state = states.get(sample.prompt)
+                if state is None:
+                    state = states[sample.prompt] = _PromptState(sample.prompt, first_seen)
+                # A prompt reopened after a spill was first seen in its earliest spill.
+                state.first_seen = min(state.first_seen, first_seen)
+                state.add(sample, seq, self.n, self.max_pairs)
+        for state in sorted(states.values(), key=lambda item: item.first_seen):
+            yield state.result(self.max_pairs)
+
+    def finish(self) -> Iterator[PromptSelection]:
+        """Yield one ``PromptSelection`` per prompt and release spill files."""
+
+        if self._spill is None:
+            states = sorted(self._open.values(), key=lambda item: item.first_seen)
+            self._open.clear()
+            for state in states:
+                yield state.result(self.max_pairs)
+            return
+        self._spill_open()
+        try:
+            for bucket in range(self.num_buckets):
+                yield from self._iter_bucket(bucket)
+        finally:
+            self._spill.cleanup()
+            self._spill = None
+
+
+def iter_grouped_selections(
+    samples: Iterable[SampleMetadata],
+    n: int = 1,
+    max_pairs_per_prompt: int = 1,
+) -> Iterator[PromptSelection]:
+    """Select per prompt from a stream where each prompt's candidates are contiguous.
+
+    Each prompt is emitted as soon as the next one starts, so memory holds a
+    single prompt's retained candidates. A prompt that shows up again later
+    is emitted again as a separate group; use ``StreamingSelector`` when
+    prompts can interleave.
+    """
+
+    state: Optional[_PromptState] = None
+    for seq, sample in enumerate(samples):
+        if state is None or sample.prompt != state.prompt:
+            if state is not None:
+                yield state.result(max_pairs_per_prompt)
+            state = _PromptState(sample.prompt, seq)
+        state.add(sample, seq, n, max_pairs_per_prompt)
+    if state is not None:
+        yield state.result(max_pairs_per_prompt)
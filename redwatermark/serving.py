@@ -0,0 +1,324 @@
+"""Asyncio generation service with continuous batching around RedBiasedTeacher."""
+
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import time
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from redwatermark.model import BatchDecodeSession
+from redwatermark.teacher import RedBiasConfig, RedBiasedTeacher
+
+
+@dataclass
+class _Request:
+    prompt: str
+    config: RedBiasConfig
+    rng: np.random.Generator
+    stream: asyncio.Queue
+    submitted: float
+    first_token: Optional[float] = None
+    completion: List[int] = field(default_factory=list)
+    # Set when the caller stops iterating; the row is dropped on the next step.
+    cancelled: bool = False
+
+
+@dataclass(frozen=True)
+class ServingStats:
+    completed: int
+    failed: int
+    tokens: int
+    elapsed_seconds: float
+    tokens_per_second: float
+    mean_batch_size: float
+    latency_p50: float
+    latency_p99: float
+    time_to_first_token_p50: float
+    time_to_first_token_p99: float
+
+
+@dataclass
+class _Counters:
+    started: Optional[float] = None
+    tokens: int = 0
+    failed: int = 0
+    steps: int = 0
+    rows: int = 0
+    latencies: List[float] = field(default_factory=list)
+    first_token_latencies: List[float] = field(default_factory=list)
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+_END = object()
+
+
+class ContinuousBatchingServer:
+    """Serve red-biased completions from one continuously refilled decode batch.
+
+    Requests wait in a queue and join the running batch as soon as a slot is
+    free; a row that reaches ``max_tokens``, EOS or a stop sequence is dropped
+    from the batch (and its cache rows freed) on the step it completes. Each request carries its own ``RedBiasConfig``,
+    so delta, entropy threshold, top-k and ``max_tokens`` can differ per row.
+    Model calls run on a single worker thread so the event loop keeps
+    accepting requests and streaming tokens while the model computes. A
+    failing model call fails the requests in the batch, not the server; a
+    stream closed early frees its row on the next step.
+    """
+
+    def __init__(
+        self,
+        teacher: RedBiasedTeacher,
+        max_batch_size: int = 16,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be positive.")
+        self.teacher = teacher
+        self.max_batch_size = max_batch_size
+        self._executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+        self._waiting: "asyncio.Queue[_Request]" = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._counters = _Counters()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Finish every accepted request, then stop the decode loop."""
+
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def __aenter__(self) -> ContinuousBatchingServer:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.stop()
+
+    async def stream(
+        self,
+        prompt: str,
+        config: Optional[RedBiasConfig] = None,
+        rng_seed: int = 0,
+    ) -> AsyncIterator[int]:
+        """Yield completion token ids as they are sampled."""
+
+        if self._task is None or self._closing or self._task.done():
+            raise RuntimeError("Server is not running.")
+        request = _Request(
+            prompt=prompt,
+            config=config or self.teacher.config,
+            rng=np.random.default_rng(rng_seed),
+            stream=asyncio.Queue(),
+            submitted=time.perf_counter(),
+        )
+        await self._waiting.put(request)
+        self._wakeup.set()
+        try:
+            while True:
+                item = await request.stream.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            request.cancelled = True
+
+    async def generate(
+        self,
+        prompt: str,
+        config: Optional[RedBiasConfig] = None,
+        rng_seed: int = 0,
+    ) -> List[int]:
+        """Return the completion token ids (without the prompt)."""
+
+        return [token async for token in self.stream(prompt, config, rng_seed)]
+
+    def stats(self) -> ServingStats:
+        counters = self._counters
+        elapsed = time.perf_counter() - counters.started if counters.started is not None else 0.0
+        return ServingStats(
+            completed=len(counters.latencies),
+            failed=counters.failed,
+            tokens=counters.tokens,
+            elapsed_seconds=elapsed,
+            tokens_per_second=counters.tokens / elapsed if elapsed > 0 else 0.0,
+            mean_batch_size=counters.rows / counters.steps if counters.steps else 0.0,
+            latency_p50=_percentile(counters.latencies, 50),
+            latency_p99=_percentile(counters.latencies, 99),
+            time_to_first_token_p50=_percentile(counters.first_token_latencies, 50),
+            time_to_first_token_p99=_percentile(counters.first_token_latencies, 99),
+        )
+
+    async def _call(self, fn, *args):  # type: ignore[no-untyped-def]
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _admit(self, active: List[_Request], limit: int) -> List[_Request]:
+        admitted = []
+        while len(active) + len(admitted) < limit and not self._waiting.empty():
+            request = self._waiting.get_nowait()
+            if request.cancelled:
+                continue
+            if request.config.max_tokens <= 0:
+                self._finish(request, _END)
+            else:
+                admitted.append(request)
+        return admitted
+
+    def _finish(self, request: _Request, outcome: Union[object, BaseException]) -> None:
+        if isinstance(outcome, BaseException):
+            self._counters.failed += 1
+        else:
+            self._counters.latencies.append(time.perf_counter() - request.submitted)
+        request.stream.put_nowait(outcome)
+
+    def _start_rows(self, requests: List[_Request]) -> BatchDecodeSession:
+        batch_ids = [list(self.teacher.model.encode(request.prompt)) for request in requests]
+        session = self.teacher.start_batch_session(batch_ids)
+        session.next_logits()  # prefill now, off the event loop
+        return session
+
+    def _advance(self, session: BatchDecodeSession, keep: List[int], next_tokens: List[int], num_rows: int) -> None:
+        if len(keep) < num_rows:
+            session.select(keep)
+        session.append([next_tokens[row] for row in keep])
+
+    def _sample(self, session: BatchDecodeSession, active: List[_Request]) -> List[int]:
+        logits = np.stack([np.asarray(output.logits) for output in session.next_logits()])
+        next_tokens = np.zeros(len(active), dtype=np.int64)
+        by_config: Dict[RedBiasConfig, List[int]] = {}
+        for row, request in enumerate(active):
+            by_config.setdefault(request.config, []).append(row)
+        for config, rows in by_config.items():
+            processor = self.teacher.processor(logits.shape[-1], config)
+            sampled, _ = processor.sample_batch(logits[rows], [active[row].rng for row in rows])
+            next_tokens[rows] = sampled
+        return next_tokens.tolist()
+
+    def _fail(self, requests: Sequence[_Request], error: BaseException) -> None:
+        for request in requests:
+            if not request.cancelled:
+                self._finish(request, error)
+
+    async def _run(self) -> None:
+        active: List[_Request] = []
+        try:
+            await self._decode(active)
+        except BaseException as error:
+            # The loop itself broke; no request may be left waiting on its stream.
+            self._fail(active, error)
+            while not self._waiting.empty():
+                self._fail([self._waiting.get_nowait()], error)
+            raise
+
+    async def _decode(self, active: List[_Request]) -> None:
+        """Run the decode loop; ``active`` is updated in place so ``_run`` can fail it."""
+
+        session: Optional[BatchDecodeSession] = None
+        while True:
+            if not active and self._waiting.empty():
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if self._counters.started is None:
+                self._counters.started = time.perf_counter()
+
+            admitted = self._admit(active, self.max_batch_size)
+            if admitted:
+                try:
+                    fresh = await self._call(self._start_rows, admitted)
+                except Exception as error:
+                    self._fail(admitted, error)
+                else:
+                    try:
+                        if session is None:
+                            session = fresh
+                        else:
+                            await self._call(session.extend, fresh)
+                    except Exception as error:
+                        self._fail(active + admitted, error)
+                        session = None
+                        active.clear()
+                    else:
+                        active.extend(admitted)
+            if session is None or not active:
+                continue
+
+            try:
+                next_tokens = await self._call(self._sample, session, active)
+            except Exception as error:
+                self._fail(active, error)
+                session = None
+                active.clear()
+                continue
+            self._counters.steps += 1
+            self._counters.rows += len(active)
+            now = time.perf_counter()
+            keep: List[int] = []
+            for row, (request, token) in enumerate(zip(active, next_tokens)):
+                if request.cancelled:
+                    continue
+                if request.first_token is None:
+                    request.first_token = now
+                    self._counters.first_token_latencies.append(now - request.submitted)
+                request.completion.append(token)
+                self._counters.tokens += 1
+                request.stream.put_nowait(token)
+                if (
+                    len(request.completion) >= request.config.max_tokens
+                    or self.teacher.stop_reason(request.completion, request.config) is not None
+                ):
+                    self._finish(request, _END)
+                else:
+                    keep.append(row)
+            num_rows = len(active)
+            active[:] = [active[row] for row in keep]
+            if not active:
+                session = None
+                continue
+            try:
+                await self._call(self._advance, session, keep, next_tokens, num_rows)
+            except Exception as error:
+                self._fail(active, error)
+                session = None
+                active.clear()
+
+
+async def run_load_test(
+    server: ContinuousBatchingServer,
+    prompts: Sequence[str],
+    concurrency: int,
+    configs: Optional[Sequence[RedBiasConfig]] = None,
+) -> Tuple[ServingStats, List[List[int]]]:
+    """Issue ``prompts`` with at most ``concurrency`` in flight and report server stats.
+
+    ``configs`` optionally gives one ``RedBiasConfig`` per prompt.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(idx: int, prompt: str) -> List[int]:
+        async with semaphore:
+            config = configs[idx] if configs is not None else None
+            return await server.generate(prompt, config=config, rng_seed=idx)
+
+    completions = await asyncio.gather(*(one(idx, prompt) for idx, prompt in enumerate(prompts)))
+    return server.stats(), list(completions)
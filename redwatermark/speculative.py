@@ -0,0 +1,180 @@
+"""Speculative decoding for the red-biased teacher with a small draft model.
+
+Each round the draft proposes ``k`` tokens one at a time and the target
+scores all of them in a single forward pass. Draft token ``d`` with draft
+probability ``q(d)`` is kept with probability ``min(1, p(d) / q(d))``, where
+``p`` is the target's biased, entropy-gated sampling distribution. The first
+rejected position is resampled from ``max(p - q, 0)`` (normalized), and a
+fully accepted round adds one more token sampled from ``p``. Every emitted
+token is therefore distributed exactly as in ``RedBiasedTeacher.generate``,
+so the red rate does not change. Only the draws differ, so a seed does not
+reproduce ``generate``'s completion.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from redwatermark.model import DecodeSession, ModelInterface, RecomputeSession
+from redwatermark.teacher import GenerationResult, RedBiasedTeacher
+from watermark_sampler import RedBiasProcessor, sample_from_probs
+
+
+@dataclass(frozen=True)
+class SpeculativeStats:
+    """Acceptance counters accumulated over a decoder's generations."""
+
+    rounds: int
+    proposed: int
+    accepted: int
+    tokens: int
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_round(self) -> float:
+        """Tokens emitted per target forward pass."""
+
+        return self.tokens / self.rounds if self.rounds else 0.0
+
+
+def _start_session(model: ModelInterface, input_ids: Sequence[int]) -> DecodeSession:
+    start_session = getattr(model, "start_session", None)
+    session = None if start_session is None else start_session(input_ids)
+    if session is None or getattr(session, "extend_logits", None) is None or getattr(session, "rollback", None) is None:
+        return RecomputeSession(model, input_ids)
+    return session
+
+
+def _rows(outputs: Sequence) -> np.ndarray:
+    return np.stack([np.asarray(output.logits, dtype=np.float64) for output in outputs])
+
+
+class SpeculativeDecoder:
+    """Draft-and-verify sampling from a ``RedBiasedTeacher``.
+
+    The draft must share the teacher's tokenizer and vocabulary size. With
+    ``bias_draft`` the draft proposes from its own red-biased distribution,
+    which usually tracks the biased target more closely than its raw softmax.
+    """
+
+    def __init__(
+        self,
+        teacher: RedBiasedTeacher,
+        draft: ModelInterface,
+        num_draft_tokens: int = 4,
+        bias_draft: bool = True,
+    ) -> None:
+        if num_draft_tokens <= 0:
+            raise ValueError("num_draft_tokens must be positive.")
+        self.teacher = teacher
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
+        self.bias_draft = bias_draft
+        self._rounds = self._proposed = self._accepted = self._tokens = 0
+
+    def stats(self) -> SpeculativeStats:
+        return SpeculativeStats(
+            rounds=self._rounds,
+            proposed=self._proposed,
+            accepted=self._accepted,
+            tokens=self._tokens,
+        )
+
+    def reset_stats(self) -> None:
+        self._rounds = self._proposed = self._accepted = self._tokens = 0
+
+    def _draft_probs(self, processor: RedBiasProcessor, logits: np.ndarray) -> np.ndarray:
+        if self.bias_draft:
+            return processor.distribution(logits)[0][0]
+        return processor.softmax_entropy(logits)[0][0]
+
+    def _propose(
+        self,
+        session: DecodeSession,
+        feed: List[int],
+        count: int,
+        rng: np.random.Generator,
+    ) -> Tuple[List[int], List[np.ndarray]]:
+        """Sample ``count`` draft tokens; the last one is not fed to the draft."""
+
+        tokens: List[int] = []
+        probs: List[np.ndarray] = []
+        for _ in range(count):
+            logits = np.asarray(session.extend_logits(feed)[-1].logits, dtype=np.float64)
+            processor = self.teacher.processor(logits.shape[-1])
+            row = self._draft_probs(processor, logits)
+            token = int(sample_from_probs(row[None, :], [rng])[0])
+            tokens.append(token)
+            probs.append(row)
+            feed = [token]
+        return tokens, probs
+
+    def generate_result(self, prompt: str, rng_seed: int = 0) -> GenerationResult:
+        """Generate one completion, stopping on ``max_tokens``, EOS or a stop sequence."""
+
+        teacher = self.teacher
+        max_tokens = teacher.config.max_tokens
+        rng = np.random.default_rng(rng_seed)
+        input_ids = list(teacher.model.encode(prompt))
+        prompt_length = len(input_ids)
+        if max_tokens <= 0:
+            return GenerationResult(token_ids=input_ids, prompt_length=prompt_length)
+        if not input_ids:
+            raise ValueError("Speculative decoding needs a non-empty prompt.")
+        # Hold back the last prompt token so the first round can ask for its logits.
+        target = _start_session(teacher.model, input_ids[:-1])
+        draft = _start_session(self.draft, input_ids[:-1])
+        target_feed, draft_feed = input_ids[-1:], input_ids[-1:]
+        while True:
+            count = min(self.num_draft_tokens, max_tokens - (len(input_ids) - prompt_length) - 1)
+            proposed, draft_probs = self._propose(draft, draft_feed, count, rng)
+            target_logits = _rows(target.extend_logits(target_feed + proposed)[-(count + 1) :])
+            processor = teacher.processor(target_logits.shape[-1])
+            if draft_probs and draft_probs[0].shape[-1] != target_logits.shape[-1]:
+                raise ValueError("Draft and target vocabulary sizes differ.")
+            target_probs, _ = processor.distribution(target_logits)
+
+            accepted = 0
+            for token, row, draft_row in zip(proposed, target_probs, draft_probs):
+                if rng.random() * draft_row[token] >= row[token]:
+                    break
+                accepted += 1
+            if accepted < count:
+                residual = np.maximum(target_probs[accepted] - draft_probs[accepted], 0.0)
+                total = residual.sum()
+                final = residual / total if total > 0 else target_probs[accepted]
+            else:
+                final = target_probs[count]
+            next_token = int(sample_from_probs(final[None, :], [rng])[0])
+
+            self._rounds += 1
+            self._proposed += count
+            self._accepted += accepted
+            target.rollback(count - accepted)
+            target_feed = [next_token]
+            if accepted < count:
+                draft.rollback(count - 1 - accepted)
+                draft_feed = [next_token]
+            else:
+                # The last proposal (or, with no proposals, the old feed) never reached the draft.
+                draft_feed = (proposed[-1:] if count else draft_feed) + [next_token]
+
+            for token in proposed[:accepted] + [next_token]:
+                input_ids.append(token)
+                self._tokens += 1
+                reason: Optional[str] = teacher.stop_reason(input_ids[prompt_length:])
+                if reason is None and len(input_ids) - prompt_length >= max_tokens:
+                    reason = "length"
+                if reason is not None:
+                    return GenerationResult(token_ids=input_ids, prompt_length=prompt_length, finish_reason=reason)
+
+    def generate(self, prompt: str, rng_seed: int = 0) -> List[int]:
+        """Prompt + completion ids, like ``RedBiasedTeacher.generate``."""
+
+        return self.generate_result(prompt, rng_seed).token_ids
@@ -0,0 +1,362 @@
+"""Threaded producer/consumer pipeline for candidate generation and scoring.
+
+Generation, decoding, oddity flagging and base-model scoring run as stages
+connected by bounded queues, so the model keeps generating while other
+threads decode text, run regexes and batch up scoring passes. The oddity
+stage annotates candidates by default; with ``drop_oddities`` it filters
+flagged ones out before they reach the scoring batcher.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from redwatermark.data import SampleMetadata, compute_base_logprobs, iter_jobs
+from redwatermark.filters import OddityFlags, any_oddities, detect_oddities
+from redwatermark.model import ModelInterface
+from redwatermark.scoring import ScoreWeights, score_candidate
+from redwatermark.teacher import RedBiasedTeacher
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+@dataclass(frozen=True)
+class StageConfig:
+    """Concurrency for one stage and the size of its output queue."""
+
+    workers: int = 1
+    queue_size: int = 64
+
+
+@dataclass(frozen=True)
+class StagedPipelineConfig:
+    generation: StageConfig = StageConfig()
+    decode: StageConfig = StageConfig()
+    oddity: StageConfig = StageConfig()
+    scoring: StageConfig = StageConfig()
+    generation_batch_size: int = 8
+    scoring_batch_size: int = 16
+    flush_interval: float = 0.01
+
+
+@dataclass
+class StageStats:
+    """Per-stage counters.
+
+    ``blocked_seconds`` is time spent waiting on a full output queue
+    (backpressure from downstream); ``starved_seconds`` is time spent waiting
+    on an empty input queue.
+    """
+
+    name: str
+    workers: int
+    processed: int = 0
+    busy_seconds: float = 0.0
+    blocked_seconds: float = 0.0
+    starved_seconds: float = 0.0
+    max_queue_depth: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(
+        self,
+        processed: int = 0,
+        busy: float = 0.0,
+        blocked: float = 0.0,
+        starved: float = 0.0,
+        queue_depth: int = 0,
+    ) -> None:
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            self.processed += processed
+            self.busy_seconds += busy
+            self.blocked_seconds += blocked
+            self.starved_seconds += starved
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "name": self.name,
+                "workers": self.workers,
+                "processed": self.processed,
+                "busy_seconds": self.busy_seconds,
+                "blocked_seconds": self.blocked_seconds,
+                "starved_seconds": self.starved_seconds,
+                "max_queue_depth": self.max_queue_depth,
+            }
+
+
+@dataclass
+class _Candidate:
+    prompt_index: int
+    sample_index: int
+    prompt: str
+    token_ids: List[int]
+    completion: str = ""
+    red_rate: float = 0.0
+    oddities: Optional[OddityFlags] = None
+    base_logprob: Optional[float] = None
+    score: float = 0.0
+    dropped: bool = False
+
+
+class _Failure:
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+class _Stage:
+    """A pool of threads that moves items from ``inbox`` to ``outbox``."""
+
+    def __init__(
+        self,
+        name: str,
+        config: StageConfig,
+        inbox: Optional[queue.Queue],
+        stop: threading.Event,
+    ) -> None:
+        self.name = name
+        self.config = config
+        self.inbox = inbox
+        self.outbox: queue.Queue = queue.Queue(maxsize=config.queue_size)
+        self.stop = stop
+        self.stats = StageStats(name=name, workers=config.workers)
+        self._remaining = config.workers
+        self._remaining_lock = threading.Lock()
+
+    def put(self, item: Any) -> bool:
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.outbox.put(item, timeout=_POLL_SECONDS)
+            except queue.Full:
+                continue
+            self.stats.record(blocked=time.perf_counter() - start, queue_depth=self.outbox.qsize())
+            return True
+        return False
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Return the next inbox item, ``None`` on timeout, or ``_DONE``."""
+
+        assert self.inbox is not None
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        try:
+            while not self.stop.is_set():
+                wait = _POLL_SECONDS if deadline is None else min(_POLL_SECONDS, deadline - time.perf_counter())
+                if wait <= 0:
+                    return None
+                try:
+                    item = self.inbox.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    # Leave the marker for sibling workers of this stage.
+                    self.inbox.put(_DONE)
+                return item
+            return _DONE
+        finally:
+            self.stats.record(starved=time.perf_counter() - start)
+
+    def start(self, target: Callable[[], None]) -> List[threading.Thread]:
+        threads = []
+        for idx in range(self.config.workers):
+            thread = threading.Thread(target=self._run, args=(target,), name=f"{self.name}-{idx}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _run(self, target: Callable[[], None]) -> None:
+        try:
+            target()
+        except BaseException as error:  # surfaced to the consumer
+            self.put(_Failure(error))
+        finally:
+            with self._remaining_lock:
+                self._remaining -= 1
+                last = self._remaining == 0
+            if last:
+                self.put(_DONE)
+
+
+class StagedCandidatePipeline:
+    """Generate and score candidates with overlapping, bounded stages.
+
+    Yields the same ``(prompt_index, samples)`` groups as
+    ``iter_candidate_groups``, in prompt order, regardless of stage
+    concurrency. Call ``stats()`` at any time to see per-stage throughput and
+    where time is lost to backpressure. With ``drop_oddities``, flagged
+    candidates skip base scoring and are left out of their group, which may
+    then hold fewer than ``samples_per_prompt`` samples.
+    """
+
+    def __init__(
+        self,
+        teacher: RedBiasedTeacher,
+        model: ModelInterface,
+        target_red_rate: float,
+        samples_per_prompt: int = 4,
+        scorer: Optional[Callable[[float, float, Optional[float], OddityFlags], float]] = None,
+        score_weights: Optional[ScoreWeights] = None,
+        rng_seed: int = 0,
+        config: Optional[StagedPipelineConfig] = None,
+        drop_oddities: bool = False,
+    ) -> None:
+        self.teacher = teacher
+        self.model = model
+        self.target_red_rate = target_red_rate
+        self.samples_per_prompt = samples_per_prompt
+        self.scorer = scorer
+        self.score_weights = score_weights or ScoreWeights()
+        self.rng_seed = rng_seed
+        self.config = config or StagedPipelineConfig()
+        self.drop_oddities = drop_oddities
+        self._stages: List[_Stage] = []
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [stage.stats.as_dict() for stage in self._stages]
+
+    def _score(self, candidate: _Candidate) -> float:
+        assert candidate.oddities is not None
+        if self.scorer is not None:
+            return self.scorer(candidate.red_rate, self.target_red_rate, candidate.base_logprob, candidate.oddities)
+        return score_candidate(
+            red_rate_value=candidate.red_rate,
+            target_red_rate=self.target_red_rate,
+            base_logprob=candidate.base_logprob,
+            oddities=candidate.oddities,
+            weights=self.score_weights,
+        )
+
+    def run(self, prompts: Iterable[str], start_index: int = 0) -> Iterator[Tuple[int, List[SampleMetadata]]]:
+        config = self.config
+        stop = threading.Event()
+        generation = _Stage("generation", config.generation, None, stop)
+        decode = _Stage("decode", config.decode, generation.outbox, stop)
+        oddity = _Stage("oddity", config.oddity, decode.outbox, stop)
+        scoring = _Stage("scoring", config.scoring, oddity.outbox, stop)
+        self._stages = [generation, decode, oddity, scoring]
+
+        jobs = iter_jobs(prompts, self.samples_per_prompt, self.rng_seed, start_index)
+        jobs_lock = threading.Lock()
+        sample_counter: Dict[int, int] = {}
+
+        def next_job_batch() -> List[Tuple[int, int, str, int]]:
+            batch = []
+            with jobs_lock:
+                for prompt_index, prompt, seed in jobs:
+                    sample_index = sample_counter.get(prompt_index, 0)
+                    sample_counter[prompt_index] = sample_index + 1
+                    if sample_index + 1 == self.samples_per_prompt:
+                        del sample_counter[prompt_index]
+                    batch.append((prompt_index, sample_index, prompt, seed))
+                    if len(batch) == config.generation_batch_size:
+                        break
+            return batch
+
+        def run_generation() -> None:
+            while not stop.is_set():
+                batch = next_job_batch()
+                if not batch:
+                    return
+                start = time.perf_counter()
+                token_batch = self.teacher.generate_batch([job[2] for job in batch], [job[3] for job in batch])
+                generation.stats.record(processed=len(batch), busy=time.perf_counter() - start)
+                for (prompt_index, sample_index, prompt, _), token_ids in zip(batch, token_batch):
+                    if not generation.put(_Candidate(prompt_index, sample_index, prompt, token_ids)):
+                        return
+
+        def map_stage(stage: _Stage, fn: Callable[[_Candidate], None]) -> Callable[[], None]:
+            def run() -> None:
+                while True:
+                    item = stage.get()
+                    if item is _DONE:
+                        return
+                    if isinstance(item, _Candidate):
+                        start = time.perf_counter()
+                        fn(item)
+                        stage.stats.record(processed=1, busy=time.perf_counter() - start)
+                    if not stage.put(item):
+                        return
+
+            return run
+
+        def decode_candidate(candidate: _Candidate) -> None:
+            candidate.completion = self.model.decode(candidate.token_ids)
+            candidate.red_rate = self.teacher.summarize_red_rate(candidate.token_ids)
+
+        def flag_candidate(candidate: _Candidate) -> None:
+            candidate.oddities = detect_oddities(candidate.completion)
+            candidate.dropped = self.drop_oddities and any_oddities(candidate.oddities)
+
+        def run_scoring() -> None:
+            done = False
+            while not done:
+                batch: List[_Candidate] = []
+                while len(batch) < config.scoring_batch_size:
+                    item = scoring.get(timeout=config.flush_interval if batch else None)
+                    if item is None:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    if isinstance(item, _Failure) or item.dropped:
+                        # Dropped candidates still pass through so their prompt's group completes.
+                        scoring.put(item)
+                        continue
+                    batch.append(item)
+                if not batch:
+                    continue
+                start = time.perf_counter()
+                logprobs = compute_base_logprobs(self.model, [candidate.token_ids for candidate in batch])
+                for candidate, base_logprob in zip(batch, logprobs):
+                    candidate.base_logprob = base_logprob
+                    candidate.score = self._score(candidate)
+                scoring.stats.record(processed=len(batch), busy=time.perf_counter() - start)
+                for candidate in batch:
+                    if not scoring.put(candidate):
+                        return
+
+        threads = generation.start(run_generation)
+        threads += decode.start(map_stage(decode, decode_candidate))
+        threads += oddity.start(map_stage(oddity, flag_candidate))
+        threads += scoring.start(run_scoring)
+
+        pending: Dict[int, List[_Candidate]] = {}
+        next_index = start_index
+        try:
+            while True:
+                try:
+                    item = scoring.outbox.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                pending.setdefault(item.prompt_index, []).append(item)
+                while len(pending.get(next_index, ())) == self.samples_per_prompt:
+                    group = sorted(pending.pop(next_index), key=lambda candidate: candidate.sample_index)
+                    yield next_index, [_to_sample(candidate) for candidate in group if not candidate.dropped]
+                    next_index += 1
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def _to_sample(candidate: _Candidate) -> SampleMetadata:
+    assert candidate.oddities is not None
+    return SampleMetadata(
+        prompt=candidate.prompt,
+        completion=candidate.completion,
+        token_ids=candidate.token_ids,
+        red_rate=candidate.red_rate,
+        base_logprob=candidate.base_logprob,
+        oddities=candidate.oddities,
+        score=candidate.score,
+    )
@@ -0,0 +1,205 @@
+"""Sharded JSONL output with a resumable checkpoint manifest."""
+
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+import json
+import os
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+from redwatermark.data import SampleMetadata
+from redwatermark.filters import OddityFlags
+from redwatermark.training import DPOPair, SFTExample
+
+MANIFEST_NAME = "manifest.json"
+STREAMS = ("samples", "sft", "dpo")
+
+
+def sample_to_dict(sample: SampleMetadata) -> Dict[str, Any]:
+    record = asdict(sample)
+    record["token_ids"] = list(sample.token_ids)
+    return record
+
+
+def sample_from_dict(record: Dict[str, Any]) -> SampleMetadata:
+    values = dict(record)
+    values["oddities"] = OddityFlags(**values["oddities"])
+    return SampleMetadata(**values)
+
+
+def write_json_atomic(path: str, payload: Any) -> None:
+    """Write JSON via a temp file and rename, so readers never see a partial file."""
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(payload, handle, indent=2, sort_keys=True)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class ShardRecord:
+    index: int
+    first_prompt: int
+    end_prompt: int
+    files: Dict[str, str]
+    counts: Dict[str, int]
+
+
+@dataclass
+class ShardManifest:
+    """Checkpoint state: every prompt below ``next_prompt`` is in a finished shard."""
+
+    params: Dict[str, Any]
+    next_prompt: int = 0
+    shards: List[ShardRecord] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, payload: Dict[str, Any]) -> ShardManifest:
+        return cls(
+            params=payload["params"],
+            next_prompt=payload["next_prompt"],
+            shards=[ShardRecord(**shard) for shard in payload["shards"]],
+        )
+
+
+def load_manifest(output_dir: str) -> Optional[ShardManifest]:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as handle:
+        return ShardManifest.from_dict(json.load(handle))
+
+
+class ShardedJSONLWriter:
+    """Writes per-prompt results into fixed-size JSONL shards.
+
+    Each shard holds ``shard_size`` prompts and one file per stream
+    (``samples``, ``sft``, ``dpo``). Lines go to a ``.tmp`` file as they are
+    produced; when the shard fills, the files are renamed into place and the
+    manifest is rewritten. A crash loses at most the shard in progress, and
+    reopening the directory resumes from ``manifest.next_prompt``. A new
+    directory starts at prompt ``start_prompt``.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        params: Dict[str, Any],
+        shard_size: int = 1000,
+        start_prompt: int = 0,
+    ) -> None:
+        if shard_size <= 0:
+            raise ValueError("shard_size must be positive.")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        manifest = load_manifest(output_dir)
+        if manifest is None:
+            manifest = ShardManifest(params=params, next_prompt=start_prompt)
+        elif manifest.params != params:
+            raise ValueError(
+                f"Output directory {output_dir} was written with different parameters: "
+                f"{manifest.params} != {params}"
+            )
+        self.manifest = manifest
+        self._handles: Optional[Dict[str, IO[str]]] = None
+        self._counts: Dict[str, int] = {}
+        self._shard_first = manifest.next_prompt
+        self._shard_end = manifest.next_prompt
+
+    @property
+    def resume_index(self) -> int:
+        return self.manifest.next_prompt
+
+    def _shard_path(self, stream: str, index: int) -> str:
+        return os.path.join(self.output_dir, f"{stream}-{index:05d}.jsonl")
+
+    def _open_shard(self) -> Dict[str, IO[str]]:
+        index = len(self.manifest.shards)
+        self._handles = {
+            stream: open(f"{self._shard_path(stream, index)}.tmp", "w", encoding="utf-8") for stream in STREAMS
+        }
+        self._counts = {stream: 0 for stream in STREAMS}
+        return self._handles
+
+    def write(
+        self,
+        prompt_index: int,
+        samples: List[SampleMetadata],
+        sft_examples: List[SFTExample],
+        dpo_pairs: List[DPOPair],
+    ) -> None:
+        if prompt_index != self._shard_end:
+            raise ValueError(f"Expected prompt {self._shard_end}, got {prompt_index}.")
+        handles = self._handles or self._open_shard()
+        records = {
+            "samples": [sample_to_dict(sample) for sample in samples],
+            "sft": [asdict(example) for example in sft_examples],
+            "dpo": [asdict(pair) for pair in dpo_pairs],
+        }
+        for stream, rows in records.items():
+            for row in rows:
+                handles[stream].write(json.dumps({"prompt_index": prompt_index, **row}) + "\n")
+            self._counts[stream] += len(rows)
+        self._shard_end += 1
+        if self._shard_end - self._shard_first >= self.shard_size:
+            self.flush_shard()
+
+    def flush_shard(self) -> None:
+        """Finalize the shard in progress (possibly short) and checkpoint it."""
+
+        if self._handles is None:
+            return
+        index = len(self.manifest.shards)
+        files = {}
+        for stream, handle in self._handles.items():
+            handle.flush()
+            os.fsync(handle.fileno())
+            handle.close()
+            path = self._shard_path(stream, index)
+            os.replace(f"{path}.tmp", path)
+            files[stream] = os.path.basename(path)
+        self.manifest.shards.append(
+            ShardRecord(
+                index=index,
+                first_prompt=self._shard_first,
+                end_prompt=self._shard_end,
+                files=files,
+                counts=dict(self._counts),
+            )
+        )
+        self.manifest.next_prompt = self._shard_end
+        write_json_atomic(os.path.join(self.output_dir, MANIFEST_NAME), self.manifest.to_dict())
+        self._handles = None
+        self._shard_first = self._shard_end
+
+    def close(self) -> None:
+        self.flush_shard()
+
+    def __enter__(self) -> ShardedJSONLWriter:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if exc_info[0] is None:
+            self.close()
+        elif self._handles is not None:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = None
+
+
+def iter_shard_records(output_dir: str, stream: str) -> Iterator[Dict[str, Any]]:
+    """Yield decoded JSON rows of one stream across all finished shards, in order."""
+
+    manifest = load_manifest(output_dir)
+    if manifest is None:
+        return
+    for shard in manifest.shards:
+        with open(os.path.join(output_dir, shard.files[stream]), "r", encoding="utf-8") as handle:
+            for line in handle:
+                yield json.loads(line)
@@ -2,29 +2,162 @@
 
 from __future__ import annotations
 
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Iterable, List, Optional, Sequence, Set
-
-from redwatermark.model import ModelInterface
-from watermark_sampler import (
-    RedBiasConfig as SamplerBiasConfig,
-    apply_red_bias,
-    entropy,
-    red_rate,
-    sample_token,
-    softmax,
-    top_k_indices,
+import threading
+from typing import Any, Collection, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+from redwatermark.model import (
+    BatchDecodeSession,
+    DecodeSession,
+    ModelInterface,
+    RecomputeBatchSession,
+    RecomputeSession,
 )
+from redwatermark import metrics
+from redwatermark.filters import flag_mask, oddity_bits
+from redwatermark.partition import VocabPartition
+from watermark_sampler import RedBiasConfig as SamplerBiasConfig, RedBiasProcessor, red_rate
 
 
 @dataclass(frozen=True)
 class RedBiasConfig:
-    """Configuration for red-biased sampling."""
+    """Configuration for red-biased sampling.
+
+    Attributes:
+        stop_on_eos: End a completion on the model's EOS token (kept as the
+            last id). Ignored for models without an ``eos_token_id``.
+        stop_sequences: End a completion once its decoded text contains any
+            of these strings; the token completing the match is kept.
+    """
 
     delta: float = 1.5
     entropy_threshold: float = 2.0
     top_k: Optional[int] = 50
     max_tokens: int = 256
+    stop_on_eos: bool = True
+    stop_sequences: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class EarlyRejectionConfig:
+    """Rules for abandoning a candidate while it is being decoded.
+
+    Attributes:
+        target_red_rate: If set, abort once the final red rate of prompt +
+            completion (what ``summarize_red_rate`` scores) can no longer land
+            within ``red_rate_tolerance`` of it, even if every remaining
+            token went the right way.
+        red_rate_tolerance: Allowed distance from ``target_red_rate``.
+        oddity_fields: ``OddityFlags`` fields that abort a candidate when
+            they show up in the decoded tail.
+        oddity_window: Number of trailing completion tokens decoded per check.
+        oddity_interval: Check the tail every this many tokens.
+    """
+
+    target_red_rate: Optional[float] = None
+    red_rate_tolerance: float = 0.1
+    oddity_fields: Tuple[str, ...] = ("mixed_script", "number_corruption", "repeated_punct")
+    oddity_window: int = 16
+    oddity_interval: int = 8
+
+
+@dataclass(frozen=True)
+class GenerationResult:
+    """Prompt + completion ids and why decoding stopped.
+
+    ``finish_reason`` is ``"length"`` for a full ``max_tokens`` completion,
+    ``"eos"``/``"stop"`` when it ended on EOS or a stop sequence, or
+    ``"red_rate"``/``"oddity"`` when an ``EarlyRejectionConfig`` rule
+    aborted it.
+    """
+
+    token_ids: List[int]
+    prompt_length: int
+    finish_reason: str = "length"
+
+    @property
+    def rejected(self) -> bool:
+        return self.finish_reason in ("red_rate", "oddity")
+
+
+class _RejectionTracker:
+    """Running red/eligible counts and tail oddity checks for decoding rows."""
+
+    def __init__(
+        self,
+        model: ModelInterface,
+        rejection: EarlyRejectionConfig,
+        max_tokens: int,
+        prompt_lengths: Sequence[int],
+        prompt_counts: Sequence[Tuple[int, int]],
+    ) -> None:
+        self.model = model
+        self.rejection = rejection
+        self.max_tokens = max_tokens
+        self.prompt_lengths = prompt_lengths
+        # Candidates are scored on prompt + completion, so the counts start from the prompt's.
+        self.red = np.array([red for red, _ in prompt_counts], dtype=np.int64)
+        self.eligible = np.array([eligible for _, eligible in prompt_counts], dtype=np.int64)
+        self.oddity_mask = flag_mask(rejection.oddity_fields)
+
+    def update(
+        self,
+        processor: RedBiasProcessor,
+        batch_ids: Sequence[List[int]],
+        rows: Sequence[int],
+        next_tokens: Sequence[int],
+        step: int,
+        finished: Collection[int] = (),
+    ) -> Dict[int, str]:
+        """Record this step's tokens for ``rows``; return rows to abort and why.
+
+        Rows in ``finished`` ended this step, so they are judged on their
+        final counts.
+        """
+
+        rejected: Dict[int, str] = {}
+        rejection = self.rejection
+        if rejection.target_red_rate is not None:
+            row_ids = np.asarray(rows)
+            tokens = np.asarray(next_tokens)
+            self.red[row_ids] += processor.bias_mask[tokens]
+            self.eligible[row_ids] += processor.bias_mask[tokens] | processor.blue_mask[tokens]
+            remaining = np.full(len(rows), self.max_tokens - step)
+            remaining[[idx for idx, row in enumerate(rows) if row in finished]] = 0
+            red, eligible = self.red[row_ids], self.eligible[row_ids] + remaining
+            # Bounds on the final red rate over all ways the remaining tokens can go.
+            lowest = np.divide(red, eligible, out=np.zeros(len(rows)), where=eligible > 0)
+            highest = np.divide(red + remaining, eligible, out=np.zeros(len(rows)), where=eligible > 0)
+            unreachable = (highest < rejection.target_red_rate - rejection.red_rate_tolerance) | (
+                lowest > rejection.target_red_rate + rejection.red_rate_tolerance
+            )
+            rejected.update((rows[idx], "red_rate") for idx in np.flatnonzero(unreachable))
+        if rejection.oddity_fields:
+            check_all = step % rejection.oddity_interval == 0 or step == self.max_tokens
+            for row in rows:
+                if row in rejected or not (check_all or row in finished):
+                    continue
+                completion = batch_ids[row][self.prompt_lengths[row] :]
+                # Drop replacement characters from tokens cut mid-character.
+                tail = self.model.decode(completion[-rejection.oddity_window :]).strip("\ufffd")
+                if oddity_bits(tail) & self.oddity_mask:
+                    rejected[row] = "oddity"
+        return rejected
+
+
+# Servers see one bias config per client setting; keep only a few processors alive.
+_MAX_PROCESSORS = 8
+
+
+def _sampler_config(config: RedBiasConfig) -> SamplerBiasConfig:
+    return SamplerBiasConfig(
+        delta=config.delta,
+        entropy_threshold=config.entropy_threshold,
+        top_k=config.top_k,
+    )
 
 
 class RedBiasedTeacher:
@@ -38,48 +171,357 @@ class RedBiasedTeacher:
         config: RedBiasConfig,
     ) -> None:
         self.model = model
-        self.red_tokens = red_tokens
-        self.eligible_tokens = eligible_tokens
+        self._red_tokens: Optional[Set[int]] = red_tokens
+        self._eligible_tokens: Optional[Set[int]] = eligible_tokens
+        self.partition: Optional[VocabPartition] = None
         self.config = config
+        self._processors: "OrderedDict[SamplerBiasConfig, RedBiasProcessor]" = OrderedDict()
+        # Staged and threaded callers share one teacher across generation threads.
+        self._processors_lock = threading.Lock()
+        self._device_processor: Optional[Any] = None
+
+    @classmethod
+    def from_partition(
+        cls,
+        model: ModelInterface,
+        partition: VocabPartition,
+        config: RedBiasConfig,
+    ) -> RedBiasedTeacher:
+        """Build a teacher on a ``VocabPartition``; token sets are only built if accessed."""
+
+        teacher = cls(model, set(), set(), config)
+        teacher.partition = partition
+        teacher._red_tokens = teacher._eligible_tokens = None
+        return teacher
+
+    @property
+    def red_tokens(self) -> Set[int]:
+        if self._red_tokens is None:
+            assert self.partition is not None
+            self._red_tokens = self.partition.red_tokens()
+        return self._red_tokens
+
+    @property
+    def eligible_tokens(self) -> Set[int]:
+        if self._eligible_tokens is None:
+            assert self.partition is not None
+            self._eligible_tokens = self.partition.eligible_tokens()
+        return self._eligible_tokens
+
+    @property
+    def sampler_config(self) -> SamplerBiasConfig:
+        return _sampler_config(self.config)
+
+    def processor(self, vocab_size: int, config: Optional[RedBiasConfig] = None) -> RedBiasProcessor:
+        """Return the mask-backed logit processor for a vocabulary size.
+
+        ``config`` overrides the teacher's bias settings; processors for
+        different settings share the same token masks. Only the
+        ``_MAX_PROCESSORS`` most recently used settings are kept.
+        """
+
+        sampler_config = _sampler_config(config or self.config)
+        with self._processors_lock:
+            processor = self._processors.get(sampler_config)
+            if processor is not None and processor.vocab_size == vocab_size:
+                self._processors.move_to_end(sampler_config)
+                return processor
+            base = next(iter(self._processors.values()), None)
+            if base is not None and base.vocab_size == vocab_size:
+                processor = base.with_config(sampler_config)
+            elif self.partition is not None:
+                self._processors.clear()
+                processor = RedBiasProcessor.from_masks(
+                    self.partition.red_mask(vocab_size),
+                    self.partition.eligible_mask(vocab_size),
+                    sampler_config,
+                )
+            else:
+                self._processors.clear()
+                processor = RedBiasProcessor(vocab_size, self.red_tokens, self.eligible_tokens, sampler_config)
+            self._processors[sampler_config] = processor
+            self._processors.move_to_end(sampler_config)
+            while len(self._processors) > _MAX_PROCESSORS:
+                self._processors.popitem(last=False)
+            return processor
+
+    @property
+    def eos_token_id(self) -> Optional[int]:
+        return getattr(self.model, "eos_token_id", None)
+
+    def stop_reason(self, completion: Sequence[int], config: Optional[RedBiasConfig] = None) -> Optional[str]:
+        """Return ``"eos"`` or ``"stop"`` if ``completion`` should end at its last token.
+
+        Only the tail that can hold a stop sequence is decoded, so this is
+        cheap enough to call after every sampled token.
+        """
+
+        config = config or self.config
+        if not completion:
+            return None
+        if config.stop_on_eos and completion[-1] == self.eos_token_id:
+            return "eos"
+        if config.stop_sequences:
+            window = max(len(sequence) for sequence in config.stop_sequences) + 1
+            tail = self.model.decode(completion[-window:])
+            if any(sequence in tail for sequence in config.stop_sequences):
+                return "stop"
+        return None
+
+    def truncate(self, token_ids: Sequence[int], prompt_length: int, config: Optional[RedBiasConfig] = None) -> List[int]:
+        """Cut ``token_ids`` after the first completion token where ``stop_reason`` fires."""
+
+        completion = list(token_ids[prompt_length:])
+        for end in range(1, len(completion) + 1):
+            if self.stop_reason(completion[:end], config) is not None:
+                return list(token_ids[: prompt_length + end])
+        return list(token_ids)
 
     def _should_bias(self, logits: Sequence[float]) -> bool:
-        step_entropy = entropy(softmax(logits))
-        if step_entropy < self.config.entropy_threshold:
-            return False
-        if self.config.top_k is None:
-            return True
-        top_k = top_k_indices(logits, self.config.top_k)
-        has_red = any(token in top_k for token in self.red_tokens)
-        has_blue = any(token in top_k for token in self.eligible_tokens.difference(self.red_tokens))
-        return has_red and has_blue
+        return bool(self.processor(len(logits)).should_bias(logits)[0])
+
+    def start_session(self, input_ids: Sequence[int]) -> DecodeSession:
+        """Start a decode session on the model, recomputing if it has no cache support."""
+
+        start_session = getattr(self.model, "start_session", None)
+        if start_session is None:
+            return RecomputeSession(self.model, input_ids)
+        return start_session(input_ids)
+
+    def start_batch_session(self, batch_input_ids: Sequence[Sequence[int]]) -> BatchDecodeSession:
+        """Batched counterpart of ``start_session``."""
+
+        start_batch_session = getattr(self.model, "start_batch_session", None)
+        if start_batch_session is None:
+            return RecomputeBatchSession(self.model, batch_input_ids)
+        return start_batch_session(batch_input_ids)
 
     def generate(
         self,
         prompt: str,
         rng_seed: int = 0,
+        rejection: Optional[EarlyRejectionConfig] = None,
     ) -> List[int]:
-        """Generate a completion as token ids."""
-
-        import random
-
-        rng = random.Random(rng_seed)
-        input_ids = list(self.model.encode(prompt))
-        for _ in range(self.config.max_tokens):
-            logits = self.model.next_logits(input_ids).logits
-            if self._should_bias(logits):
-                logits = apply_red_bias(
-                    logits=logits,
-                    red_tokens=self.red_tokens,
-                    eligible_tokens=self.eligible_tokens,
-                    config=SamplerBiasConfig(
-                        delta=self.config.delta,
-                        entropy_threshold=self.config.entropy_threshold,
-                        top_k=self.config.top_k,
-                    ),
+        """Generate a completion as token ids.
+
+        Decoding ends early on EOS or a stop sequence (see ``RedBiasConfig``).
+        With ``rejection``, it also stops as soon as a rule fires and the
+        partial sequence is returned.
+        """
+
+        with metrics.stage("teacher.generate") as stage:
+            recorder = metrics.active()
+            rng = np.random.default_rng(rng_seed)
+            input_ids = list(self.model.encode(prompt))
+            prompt_length = len(input_ids)
+            session = self.start_session(input_ids)
+            tracker = None
+            if rejection is not None:
+                tracker = _RejectionTracker(
+                    self.model, rejection, self.config.max_tokens, [prompt_length], [self._red_counts(input_ids)]
                 )
-            next_token = sample_token(logits, rng=rng)
-            input_ids.append(next_token)
+            for step in range(1, self.config.max_tokens + 1):
+                logits = session.next_logits().logits
+                processor = self.processor(len(logits))
+                sampled, gated = processor.sample_batch(logits, [rng])
+                next_token = int(sampled[0])
+                if recorder is not None:
+                    recorder.count("gating.steps")
+                    recorder.count("gating.fired", int(gated[0]))
+                input_ids.append(next_token)
+                stopped = self.stop_reason(input_ids[prompt_length:]) is not None
+                if tracker is not None and tracker.update(
+                    processor, [input_ids], [0], [next_token], step, [0] if stopped else ()
+                ):
+                    break
+                if stopped:
+                    break
+                session.append(next_token)
+            stage.add_tokens(len(input_ids) - prompt_length)
         return input_ids
 
+    def generate_batch(
+        self,
+        prompts: Sequence[str],
+        rng_seeds: Sequence[int],
+        rejection: Optional[EarlyRejectionConfig] = None,
+    ) -> List[List[int]]:
+        """Generate completions for several prompts in lockstep.
+
+        Each row keeps its own RNG and entropy gating, so row ``i`` samples
+        the same way ``generate(prompts[i], rng_seeds[i])`` would.
+        """
+
+        return [result.token_ids for result in self.generate_results(prompts, rng_seeds, rejection)]
+
+    def generate_samples(
+        self,
+        prompt: str,
+        rng_seeds: Sequence[int],
+        rejection: Optional[EarlyRejectionConfig] = None,
+    ) -> List[List[int]]:
+        """Generate one completion per seed for a single prompt.
+
+        The prompt is prefilled once and the cached prefix is forked into one
+        branch per seed; branch ``i`` samples like ``generate(prompt, rng_seeds[i])``.
+        Only the prefill is shared: each branch copies the prefix cache on
+        its first step, so memory matches an unshared batch.
+        """
+
+        results = self.generate_results([prompt] * len(rng_seeds), rng_seeds, rejection, share_prefix=True)
+        return [result.token_ids for result in results]
+
+    def generate_results(
+        self,
+        prompts: Sequence[str],
+        rng_seeds: Sequence[int],
+        rejection: Optional[EarlyRejectionConfig] = None,
+        share_prefix: bool = False,
+    ) -> List[GenerationResult]:
+        """Lockstep generation that also reports why each row stopped.
+
+        Rows that hit EOS or a stop sequence, or are aborted by
+        ``rejection``, are dropped from the decode batch (freeing their
+        cache rows) on the step they finish, so the remaining rows keep
+        decoding at a smaller batch size. ``share_prefix`` requires identical prompts and
+        forks one prefilled prompt instead of prefilling each row (see
+        ``generate_samples``).
+        """
+
+        if len(prompts) != len(rng_seeds):
+            raise ValueError("Expected one rng seed per prompt.")
+        if not prompts:
+            return []
+        with metrics.stage("teacher.generate_results") as stage:
+            results = self._generate_results(prompts, rng_seeds, rejection, share_prefix)
+            stage.add_tokens(sum(len(result.token_ids) - result.prompt_length for result in results))
+        return results
+
+    def _generate_results(
+        self,
+        prompts: Sequence[str],
+        rng_seeds: Sequence[int],
+        rejection: Optional[EarlyRejectionConfig],
+        share_prefix: bool,
+    ) -> List[GenerationResult]:
+        if share_prefix:
+            if any(prompt != prompts[0] for prompt in prompts):
+                raise ValueError("share_prefix requires identical prompts.")
+            input_ids = list(self.model.encode(prompts[0]))
+            session = self.start_session(input_ids)
+            fork = getattr(session, "fork", None)
+            if fork is None:
+                branches = self.start_batch_session([input_ids] * len(prompts))
+            else:
+                branches = fork(len(prompts))
+            return self._decode_lockstep(branches, [list(input_ids) for _ in prompts], rng_seeds, rejection)
+        batch_ids = [list(self.model.encode(prompt)) for prompt in prompts]
+        session = self.start_batch_session(batch_ids)
+        return self._decode_lockstep(session, batch_ids, rng_seeds, rejection)
+
+    def _decode_lockstep(
+        self,
+        session: BatchDecodeSession,
+        batch_ids: List[List[int]],
+        rng_seeds: Sequence[int],
+        rejection: Optional[EarlyRejectionConfig] = None,
+    ) -> List[GenerationResult]:
+        rngs = [np.random.default_rng(seed) for seed in rng_seeds]
+        prompt_lengths = [len(input_ids) for input_ids in batch_ids]
+        finish_reasons = ["length"] * len(batch_ids)
+        tracker = None
+        if rejection is not None:
+            tracker = _RejectionTracker(
+                self.model,
+                rejection,
+                self.config.max_tokens,
+                prompt_lengths,
+                [self._red_counts(input_ids) for input_ids in batch_ids],
+            )
+        active = list(range(len(batch_ids)))
+        recorder = metrics.active()
+        for step in range(1, self.config.max_tokens + 1):
+            logits = np.stack([np.asarray(output.logits) for output in session.next_logits()])
+            processor = self.processor(logits.shape[-1])
+            sampled, gated = processor.sample_batch(logits, [rngs[row] for row in active])
+            if recorder is not None:
+                recorder.count("gating.steps", len(active))
+                recorder.count("gating.fired", int(gated.sum()))
+            next_tokens = sampled.tolist()
+            finished: Dict[int, str] = {}
+            for row, next_token in zip(active, next_tokens):
+                batch_ids[row].append(next_token)
+                reason = self.stop_reason(batch_ids[row][prompt_lengths[row] :])
+                if reason is not None:
+                    finished[row] = reason
+            if tracker is not None:
+                finished.update(tracker.update(processor, batch_ids, active, next_tokens, step, finished))
+            if finished:
+                for row, reason in finished.items():
+                    finish_reasons[row] = reason
+                keep = [idx for idx, row in enumerate(active) if row not in finished]
+                if not keep:
+                    break
+                session.select(keep)
+                active = [active[idx] for idx in keep]
+                next_tokens = [next_tokens[idx] for idx in keep]
+            session.append(next_tokens)
+        return [
+            GenerationResult(token_ids=input_ids, prompt_length=prompt_length, finish_reason=reason)
+            for input_ids, prompt_length, reason in zip(batch_ids, prompt_lengths, finish_reasons)
+        ]
+
+    def generate_batch_on_device(
+        self,
+        prompts: Sequence[str],
+        rng_seed: Union[int, Sequence[int]] = 0,
+    ) -> List[List[int]]:
+        """Generate a batch with gating, biasing and sampling kept on the model's device.
+
+        Requires a model exposing ``generate_red_biased`` (e.g. ``HFModel``).
+        ``rng_seed`` is one seed for the batch or one per prompt; sampling uses
+        torch's RNG, so rows do not reproduce ``generate``.
+        Rows are cut at EOS or a stop sequence the same way ``generate`` stops.
+        """
+
+        generate_red_biased = getattr(self.model, "generate_red_biased", None)
+        if generate_red_biased is None:
+            raise TypeError(f"{type(self.model).__name__} does not support on-device generation.")
+        if not prompts:
+            return []
+        if self._device_processor is None:
+            from redwatermark.hf_model import RedBiasLogitsProcessor
+
+            if self.partition is not None:
+                red, eligible = self.partition.red_ids(), self.partition.eligible_ids()
+            else:
+                red, eligible = self.red_tokens, self.eligible_tokens
+            self._device_processor = RedBiasLogitsProcessor(red, eligible, self.sampler_config)
+        batch_ids = [list(self.model.encode(prompt)) for prompt in prompts]
+        eos_token_id = self.eos_token_id if self.config.stop_on_eos else None
+        outputs = generate_red_biased(
+            batch_ids,
+            self._device_processor,
+            self.config.max_tokens,
+            rng_seed,
+            eos_token_id=eos_token_id,
+            stop_strings=self.config.stop_sequences,
+        )
+        if eos_token_id is None and not self.config.stop_sequences:
+            return outputs
+        # Finished rows are padded up to the longest one.
+        return [self.truncate(token_ids, len(input_ids)) for token_ids, input_ids in zip(outputs, batch_ids)]
+
+    def _red_counts(self, tokens: Sequence[int]) -> Tuple[int, int]:
+        """Red and eligible counts behind ``summarize_red_rate``."""
+
+        if self.partition is not None:
+            ids = list(tokens)
+            return int(self.partition.is_red(ids).sum()), int(self.partition.is_eligible(ids).sum())
+        eligible = [token for token in tokens if token in self.eligible_tokens]
+        return sum(1 for token in eligible if token in self.red_tokens), len(eligible)
+
     def summarize_red_rate(self, tokens: Iterable[int]) -> float:
+        if self.partition is not None:
+            return self.partition.red_rate(tokens)
         return red_rate(tokens, self.red_tokens, self.eligible_tokens)
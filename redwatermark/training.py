@@ -3,11 +3,16 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Iterable, List, Sequence
+from typing import TYPE_CHECKING, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
 
 from redwatermark.data import SampleMetadata
 from redwatermark.filters import any_oddities
 
+if TYPE_CHECKING:  # pyarrow is an optional extra
+    from redwatermark.columnar import SampleTable
+
 
 @dataclass(frozen=True)
 class SFTExample:
@@ -26,10 +31,53 @@ def build_sft_dataset(samples: Iterable[SampleMetadata]) -> List[SFTExample]:
     return [SFTExample(prompt=sample.prompt, completion=sample.completion) for sample in samples]
 
 
+def build_sft_dataset_from_table(table: SampleTable, indices: Optional[Sequence[int]] = None) -> List[SFTExample]:
+    """``build_sft_dataset`` over rows of a ``SampleTable`` (all rows by default)."""
+
+    rows = range(len(table)) if indices is None else indices
+    return [SFTExample(prompt=table.prompt(idx), completion=table.completion(idx)) for idx in rows]
+
+
+def _top_margin_pairs(
+    chosen_scores: np.ndarray,
+    rejected_scores: np.ndarray,
+    max_pairs: int,
+) -> Tuple[List[int], List[int]]:
+    margins = chosen_scores[:, None] - rejected_scores[None, :]
+    order = np.argsort(-margins, axis=None, kind="stable")[:max_pairs]
+    chosen_idx, rejected_idx = np.unravel_index(order, margins.shape)
+    return chosen_idx.tolist(), rejected_idx.tolist()
+
+
+def mine_dpo_pairs(
+    prompt: str,
+    chosen: Sequence[SampleMetadata],
+    rejected: Sequence[SampleMetadata],
+    max_pairs: int = 1,
+) -> List[DPOPair]:
+    """Return up to ``max_pairs`` distinct pairs with the largest score margins.
+
+    ``chosen`` should be ordered best first and ``rejected`` worst first;
+    ties in margin keep that order, so the first pair is always
+    ``(chosen[0], rejected[0])``.
+    """
+
+    if not chosen or not rejected or max_pairs <= 0:
+        return []
+    chosen_scores = np.fromiter((item.score for item in chosen), dtype=np.float64, count=len(chosen))
+    rejected_scores = np.fromiter((item.score for item in rejected), dtype=np.float64, count=len(rejected))
+    return [
+        DPOPair(prompt=prompt, chosen=chosen[i].completion, rejected=rejected[j].completion)
+        for i, j in zip(*_top_margin_pairs(chosen_scores, rejected_scores, max_pairs))
+    ]
+
+
 def build_dpo_pairs(
     samples: Iterable[SampleMetadata],
     max_pairs_per_prompt: int = 1,
 ) -> List[DPOPair]:
+    """Pair clean (chosen) and odd (rejected) candidates per prompt; see ``mine_dpo_pairs``."""
+
     grouped: dict[str, List[SampleMetadata]] = {}
     for sample in samples:
         grouped.setdefault(sample.prompt, []).append(sample)
@@ -39,14 +87,39 @@ def build_dpo_pairs(
         sorted_group = sorted(group, key=lambda item: item.score, reverse=True)
         chosen_candidates = [item for item in sorted_group if not any_oddities(item.oddities)]
         rejected_candidates = [item for item in reversed(sorted_group) if any_oddities(item.oddities)]
-        if not chosen_candidates or not rejected_candidates:
+        pairs.extend(mine_dpo_pairs(prompt, chosen_candidates, rejected_candidates, max_pairs_per_prompt))
+    return pairs
+
+
+def build_dpo_pairs_from_table(table: SampleTable, max_pairs_per_prompt: int = 1) -> List[DPOPair]:
+    """``build_dpo_pairs`` over a ``SampleTable``, grouping and ranking on its columns.
+
+    Only the completions that end up in a pair are decoded from the table.
+    """
+
+    if not len(table) or max_pairs_per_prompt <= 0:
+        return []
+    prompts = table.table.column("prompt").combine_chunks().dictionary_encode()
+    codes = prompts.indices.to_numpy(zero_copy_only=False)
+    scores = table.scores
+    clean = table.clean_mask()
+    # By prompt (first-seen order), then score descending, then input order.
+    order = np.lexsort((np.arange(len(table)), -scores, codes))
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    pairs: List[DPOPair] = []
+    for group in np.split(order, bounds):
+        chosen = group[clean[group]]
+        rejected = group[~clean[group]][::-1]
+        if not len(chosen) or not len(rejected):
             continue
-        for _ in range(max_pairs_per_prompt):
-            pairs.append(
-                DPOPair(
-                    prompt=prompt,
-                    chosen=chosen_candidates[0].completion,
-                    rejected=rejected_candidates[0].completion,
-                )
+        prompt = prompts.dictionary[int(codes[group[0]])].as_py()
+        chosen_idx, rejected_idx = _top_margin_pairs(scores[chosen], scores[rejected], max_pairs_per_prompt)
+        pairs.extend(
+            DPOPair(
+                prompt=prompt,
+                chosen=table.completion(int(chosen[i])),
+                rejected=table.completion(int(rejected[j])),
             )
+            for i, j in zip(chosen_idx, rejected_idx)
+        )
     return pairs
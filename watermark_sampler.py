@@ -2,27 +2,53 @@
 
 from __future__ import annotations
 
+import copy
 from dataclasses import dataclass
-import math
 import random
-from typing import Iterable, List, Optional, Sequence, Set
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+_MIN_SHIFTED_LOGIT = -1e30
+
+
+def _as_logits(logits: Sequence[float]) -> np.ndarray:
+    return np.asarray(logits, dtype=np.float64)
+
+
+def _top_k(logits: np.ndarray, k: int) -> np.ndarray:
+    """Return the column indices of the ``k`` largest logits in each row."""
+
+    vocab_size = logits.shape[-1]
+    if k >= vocab_size:
+        return np.broadcast_to(np.arange(vocab_size), logits.shape)
+    return np.argpartition(logits, vocab_size - k, axis=-1)[..., vocab_size - k :]
+
+
+def _token_mask(tokens: Iterable[int], vocab_size: int) -> np.ndarray:
+    ids = np.fromiter(tokens, dtype=np.int64)
+    mask = np.zeros(vocab_size, dtype=bool)
+    mask[ids[(ids >= 0) & (ids < vocab_size)]] = True
+    return mask
 
 
 def softmax(logits: Sequence[float]) -> List[float]:
-    max_logit = max(logits)
-    exp_vals = [math.exp(logit - max_logit) for logit in logits]
-    total = sum(exp_vals)
-    return [val / total for val in exp_vals]
+    values = _as_logits(logits)
+    exp_vals = np.exp(values - values.max())
+    return (exp_vals / exp_vals.sum()).tolist()
 
 
 def entropy(probs: Sequence[float]) -> float:
-    return -sum(p * math.log(p) for p in probs if p > 0.0)
+    values = np.asarray(probs, dtype=np.float64)
+    values = values[values > 0.0]
+    return float(-(values * np.log(values)).sum())
 
 
 def top_k_indices(logits: Sequence[float], k: int) -> Set[int]:
     if k <= 0:
         return set()
-    return {idx for idx, _ in sorted(enumerate(logits), key=lambda x: x[1], reverse=True)[:k]}
+    return set(_top_k(_as_logits(logits), k).tolist())
 
 
 def red_rate(tokens: Iterable[int], red_tokens: Set[int], eligible_tokens: Set[int]) -> float:
@@ -54,6 +80,154 @@ class RedBiasConfig:
     top_k: Optional[int] = 50
 
 
+class RedBiasProcessor:
+    """Array-backed red-bias engine for a fixed vocabulary.
+
+    Red/blue/eligible sets are turned into boolean masks once, so a decoding
+    step is a fused softmax + entropy, an ``argpartition`` top-k check and a
+    cumulative-sum sample. Methods accept a single ``[vocab]`` row or a
+    ``[batch, vocab]`` matrix.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        red_tokens: Iterable[int],
+        eligible_tokens: Iterable[int],
+        config: RedBiasConfig,
+    ) -> None:
+        self._set_masks(_token_mask(red_tokens, vocab_size), _token_mask(eligible_tokens, vocab_size), config)
+
+    @classmethod
+    def from_masks(cls, red_mask: np.ndarray, eligible_mask: np.ndarray, config: RedBiasConfig) -> RedBiasProcessor:
+        """Build from ``[vocab]`` boolean masks instead of token sets."""
+
+        processor = cls.__new__(cls)
+        processor._set_masks(np.asarray(red_mask, dtype=bool), np.asarray(eligible_mask, dtype=bool), config)
+        return processor
+
+    def _set_masks(self, red_mask: np.ndarray, eligible_mask: np.ndarray, config: RedBiasConfig) -> None:
+        self.vocab_size = int(red_mask.shape[0])
+        self.config = config
+        self.red_mask = red_mask
+        self.blue_mask = eligible_mask & ~red_mask
+        self.bias_mask = eligible_mask & red_mask
+        self._set_bias()
+
+    def _set_bias(self) -> None:
+        self._bias_logits = np.where(self.bias_mask, self.config.delta, 0.0)
+        self._bias_scale = np.exp(self._bias_logits)
+
+    def with_config(self, config: RedBiasConfig) -> RedBiasProcessor:
+        """Return a processor for other bias settings that shares these masks."""
+
+        clone = copy.copy(self)
+        clone.config = config
+        clone._set_bias()
+        return clone
+
+    def _rows(self, logits: Sequence[float]) -> np.ndarray:
+        rows = np.atleast_2d(_as_logits(logits))
+        if rows.shape[-1] != self.vocab_size:
+            raise ValueError(f"Expected {self.vocab_size} logits, got {rows.shape[-1]}.")
+        return rows
+
+    def softmax_entropy(self, logits: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return per-row probabilities and entropies from one exponentiation."""
+
+        return self._softmax_entropy(self._rows(logits))
+
+    def _softmax_entropy(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        shifted = rows - rows.max(axis=-1, keepdims=True)
+        probs = np.exp(shifted)
+        totals = probs.sum(axis=-1, keepdims=True)
+        probs /= totals
+        # H = log Z - sum(p * shifted); clamping keeps masked (-inf) logits at 0 * finite.
+        np.maximum(shifted, _MIN_SHIFTED_LOGIT, out=shifted)
+        entropies = np.log(totals[:, 0]) - np.einsum("ij,ij->i", probs, shifted)
+        return probs, entropies
+
+    def gate(self, logits: Sequence[float], entropies: np.ndarray) -> np.ndarray:
+        """Return a per-row flag telling whether the bias should be applied."""
+
+        return self._gate(self._rows(logits), entropies)
+
+    def _gate(self, rows: np.ndarray, entropies: np.ndarray) -> np.ndarray:
+        gated = entropies >= self.config.entropy_threshold
+        if self.config.top_k is None or not gated.any():
+            return gated
+        if self.config.top_k <= 0:
+            return np.zeros_like(gated)
+        top_k = _top_k(rows, self.config.top_k)
+        has_red = self.red_mask[top_k].any(axis=-1)
+        has_blue = self.blue_mask[top_k].any(axis=-1)
+        return gated & has_red & has_blue
+
+    def should_bias(self, logits: Sequence[float]) -> np.ndarray:
+        rows = self._rows(logits)
+        _, entropies = self._softmax_entropy(rows)
+        return self._gate(rows, entropies)
+
+    def bias_logits(self, logits: Sequence[float]) -> np.ndarray:
+        """Return logits with ``delta`` added to eligible red tokens on gated rows."""
+
+        rows = self._rows(logits)
+        gated = self.should_bias(rows)
+        biased = rows.copy()
+        biased[gated] += self._bias_logits
+        return biased.reshape(np.shape(logits))
+
+    def distribution(self, logits: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the sampling distribution per row and whether the bias fired.
+
+        The bias is applied by rescaling the already computed probabilities,
+        which equals a softmax over the biased logits without a second pass.
+        """
+
+        rows = self._rows(logits)
+        probs, entropies = self._softmax_entropy(rows)
+        gated = self._gate(rows, entropies)
+        if gated.any():
+            biased = probs[gated] * self._bias_scale
+            biased /= biased.sum(axis=-1, keepdims=True)
+            probs[gated] = biased
+        return probs, gated
+
+    def sample_batch(
+        self,
+        logits: Sequence[float],
+        rngs: Sequence[np.random.Generator],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Sample one token per row, each row drawing from its own generator.
+
+        Returns the sampled ids and the per-row gating flags.
+        """
+
+        probs, gated = self.distribution(logits)
+        return sample_from_probs(probs, rngs), gated
+
+    def sample(self, logits: Sequence[float], rng: np.random.Generator) -> int:
+        tokens, _ = self.sample_batch(logits, [rng])
+        return int(tokens[0])
+
+
+def sample_from_probs(probs: np.ndarray, rngs: Sequence[np.random.Generator]) -> np.ndarray:
+    """Sample one token per row of a ``[batch, vocab]`` probability matrix."""
+
+    if len(rngs) != probs.shape[0]:
+        raise ValueError("Expected one generator per row.")
+    thresholds = np.array([rng.random() for rng in rngs])
+    return _sample_rows(probs, thresholds)
+
+
+def _sample_rows(probs: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """Inverse-CDF sampling: first index whose cumulative mass reaches the threshold."""
+
+    cumulative = np.cumsum(probs, axis=-1)
+    tokens = (cumulative < thresholds[:, None]).sum(axis=-1)
+    return np.minimum(tokens, probs.shape[-1] - 1)
+
+
 def apply_red_bias(
     logits: Sequence[float],
     red_tokens: Set[int],
@@ -62,6 +236,9 @@ def apply_red_bias(
 ) -> List[float]:
     """Apply a red-token logit bias with entropy gating.
 
+    Thin list wrapper around ``RedBiasProcessor``; build a processor once when
+    biasing many steps over the same vocabulary.
+
     Args:
         logits: Raw model logits.
         red_tokens: Token ids classified as red.
@@ -69,22 +246,8 @@ def apply_red_bias(
         config: Red-bias configuration.
     """
 
-    probs = softmax(logits)
-    step_entropy = entropy(probs)
-    if step_entropy < config.entropy_threshold:
-        return list(logits)
-
-    if config.top_k is not None:
-        top_k = top_k_indices(logits, config.top_k)
-        has_red = any(token in top_k for token in red_tokens)
-        has_blue = any(token in top_k for token in eligible_tokens.difference(red_tokens))
-        if not (has_red and has_blue):
-            return list(logits)
-
-    adjusted = list(logits)
-    for token in red_tokens.intersection(eligible_tokens):
-        adjusted[token] += config.delta
-    return adjusted
+    processor = RedBiasProcessor(len(logits), red_tokens, eligible_tokens, config)
+    return processor.bias_logits(logits).tolist()
 
 
 def sample_token(
@@ -95,11 +258,7 @@ def sample_token(
 
     if rng is None:
         rng = random.Random()
-    probs = softmax(logits)
-    threshold = rng.random()
-    cumulative = 0.0
-    for idx, prob in enumerate(probs):
-        cumulative += prob
-        if cumulative >= threshold:
-            return idx
-    return len(probs) - 1
+    values = _as_logits(logits)
+    exp_vals = np.exp(values - values.max())
+    probs = exp_vals / exp_vals.sum()
+    return int(_sample_rows(probs[None, :], np.array([rng.random()]))[0])